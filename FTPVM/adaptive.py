@@ -0,0 +1,116 @@
+"""
+Latency-budget-driven downsample ratio for live (webcam) & deadline-bound inference.
+The frame time of each chunk is measured and the ratio is adjusted between the bounds to meet the target,
+the RNN memories are resampled to (or reset at) the new working size.
+"""
+import csv
+import math
+import time
+
+from .roi import ROIInference, resample_rec
+from util.device import synchronize
+
+class AdaptiveDownsampler:
+    """
+    `frame_size`: (h, w) of the input frames\n
+    `target_ms`: target time per frame in milliseconds\n
+    `min_ratio`, `max_ratio`: bounds of the downsample ratio, the initial `ratio` defaults to `max_ratio`\n
+    `tolerance`: relative deviation of the frame time from the target tolerated before changing the ratio\n
+    `smoothing`: factor of the exponential moving average of the frame time\n
+    `max_step`: max. relative change of the ratio at once\n
+    `warmup`: chunks not measured after a change, which include the allocations & kernel selection of the new size\n
+    `rec_mode`: 'rescale' resamples the RNN memories to the new working size, 'reset' drops them\n
+    `quantize`: maps (ratio, h, w) to a ratio supported by the model, e.g. `CompiledMatting.quantize_ratio`
+    """
+    def __init__(self,
+        model, frame_size, target_ms,
+        min_ratio=0.25, max_ratio=1., ratio=None,
+        tolerance=0.1, smoothing=0.3, max_step=0.25, warmup=2,
+        rec_mode='rescale', device=None, verbose=True, quantize=None,
+    ):
+        assert 0 < min_ratio <= max_ratio <= 1, 'Downsample ratio bounds must be in (0, 1]'
+        assert rec_mode in ['rescale', 'reset']
+        self.model = model
+        self.h, self.w = frame_size
+        self.target_ms = target_ms
+        self.min_ratio = min_ratio
+        self.max_ratio = max_ratio
+        self.quantize = quantize
+        self.ratio = self.bound(max_ratio if ratio is None else ratio)
+        self.prev_ratio = self.ratio
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.max_step = max_step
+        self.warmup = warmup
+        self.rec_mode = rec_mode
+        self.device = next(model.parameters()).device if device is None else device
+        self.verbose = verbose
+
+        self.skip = warmup
+        self.frame_ms = None # moving average
+        self.frames = 0
+        self.t = None
+        self.start_time = time.time()
+        # (seconds, frame index, ratio, working h, working w, frame ms) of every change
+        self.log = [self._entry()]
+        self.stats = {'changes': 0}
+
+    def _entry(self):
+        return (
+            round(time.time()-self.start_time, 3), self.frames, self.ratio,
+            *self.model.working_size(self.h, self.w, self.ratio),
+            None if self.frame_ms is None else round(self.frame_ms, 2),
+        )
+
+    def bound(self, ratio):
+        ratio = min(max(ratio, self.min_ratio), self.max_ratio)
+        return ratio if self.quantize is None else self.quantize(ratio, self.h, self.w)
+
+    def start(self):
+        synchronize(self.device)
+        self.t = time.perf_counter()
+
+    def stop(self, frames):
+        """ measure the chunk of `frames` frames since `start`, return `True` if the ratio is changed """
+        synchronize(self.device)
+        ms = (time.perf_counter()-self.t) * 1000 / frames
+        self.frames += frames
+        if self.skip > 0:
+            self.skip -= 1
+            return False
+        self.frame_ms = ms if self.frame_ms is None else (1-self.smoothing)*self.frame_ms + self.smoothing*ms
+        if abs(self.frame_ms/self.target_ms - 1) <= self.tolerance:
+            return False
+
+        # the cost scales with the working area
+        scale = math.sqrt(self.target_ms / self.frame_ms)
+        scale = min(max(scale, 1-self.max_step), 1+self.max_step)
+        ratio = self.bound(self.ratio*scale)
+        if self.model.working_size(self.h, self.w, ratio) == self.model.working_size(self.h, self.w, self.ratio):
+            return False
+
+        self.prev_ratio, self.ratio = self.ratio, ratio
+        self.skip = self.warmup
+        self.log.append(self._entry())
+        self.frame_ms = None
+        self.stats['changes'] += 1
+        if self.verbose:
+            _, frame, ratio, h, w, ms = self.log[-1]
+            print(f'[frame {frame}] {ms} ms/frame -> downsample ratio {ratio:.3f} ({w}x{h})')
+        return True
+
+    def adapt_rec(self, rec):
+        """ RNN memories `rec` of the previous ratio for the current ratio """
+        if self.rec_mode == 'reset':
+            return self.model.default_rec
+        region = (0, 0, self.h, self.w)
+        old = ROIInference.working_geometry(region, self.prev_ratio)
+        new = ROIInference.working_geometry(region, self.ratio)
+        return resample_rec(rec, old, new, self.model.rec_strides)
+
+    def save_log(self, path):
+        """ write the ratio & working size over time as csv """
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['seconds', 'frame', 'ratio', 'height', 'width', 'frame_ms'])
+            writer.writerows(self.log + [self._entry()])
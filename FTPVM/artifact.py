@@ -0,0 +1,83 @@
+"""
+Packaged model: architecture config & weights in 1 file (zip format of `torch.save`),
+which is memory-mapped at loading, so the weights are read lazily without copies,
+and the network is built on the meta device without initialization or pretrained downloads.
+"""
+import inspect
+import itertools
+import pickle
+import torch
+from torch import nn
+
+from .model import FastTrimapPropagationVideoMatting
+
+ARTIFACT_VERSION = 1
+
+MODELS = {
+    'FTPVM': FastTrimapPropagationVideoMatting,
+}
+
+def load_weights(path):
+    """ `torch.load` on CPU, memory-mapped (torch >= 2.1) when the file is in the zip format of `torch.save` """
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except TypeError:
+        # torch < 2.1
+        return torch.load(path, map_location='cpu')
+    except (RuntimeError, pickle.UnpicklingError):
+        # legacy format or pickled objects
+        return torch.load(path, map_location='cpu', weights_only=False)
+
+def is_artifact(state):
+    return isinstance(state, dict) and 'version' in state and 'config' in state and 'state_dict' in state
+
+def build_model(model_cls, state_dict, device='cpu', dtype=None, drop=(), **config):
+    """
+    `model_cls(**config)` with the weights `state_dict`, the backbone is never pretrained.\n
+    The network is built on the meta device & the weights are assigned (no initialization, no copy of mapped weights),
+    or built normally on older torch (< 2.1) or if some tensors are not in `state_dict`.\n
+    `drop`: unknown keys of `state_dict` containing any of them are removed, e.g. `('refiner',)` of older checkpoints
+    """
+    if 'backbone_pretrained' in inspect.signature(model_cls).parameters:
+        config['backbone_pretrained'] = False
+    try:
+        with torch.device('meta'):
+            model = model_cls(**config)
+        state_dict = _drop_keys(model, state_dict, drop)
+        model.load_state_dict(state_dict, assign=True)
+        if any(t.is_meta for t in itertools.chain(model.parameters(), model.buffers())):
+            raise NotImplementedError('Tensors not in the state dict')
+    except (AttributeError, TypeError, NotImplementedError):
+        model = model_cls(**config)
+        model.load_state_dict(_drop_keys(model, state_dict, drop))
+    model = model.to(device)
+    return model if dtype is None else model.to(dtype)
+
+def _drop_keys(model: nn.Module, state_dict, drop):
+    unknown = set(state_dict.keys()) - set(model.state_dict().keys())
+    removed = [k for k in unknown if any(d in k for d in drop)]
+    for k in removed:
+        print('remove', k)
+    return {k: v for k, v in state_dict.items() if k not in removed}
+
+def save_artifact(path, model: FastTrimapPropagationVideoMatting, model_name='FTPVM'):
+    """ config (`model.config`) & weights of `model` in 1 file """
+    torch.save({
+        'version': ARTIFACT_VERSION,
+        'model': model_name,
+        'config': model.config,
+        'state_dict': {k: v.detach().cpu().contiguous() for k, v in model.state_dict().items()},
+    }, path)
+
+def load_artifact(path, device='cpu', dtype=None):
+    """ the model of the artifact `path`, offline """
+    state = load_weights(path)
+    if not is_artifact(state):
+        raise ValueError(f'{path} is not a model artifact, see `save_artifact`')
+    return from_artifact(state, device, dtype)
+
+def from_artifact(state, device='cpu', dtype=None):
+    """ the model of a loaded artifact """
+    if state['version'] != ARTIFACT_VERSION:
+        raise ValueError(f"Unsupported artifact version: {state['version']}")
+    return build_model(MODELS[state['model']], state['state_dict'], device, dtype, **state['config'])
@@ -140,8 +140,33 @@ class ConvGRU(nn.Module):
         else:
             return self.forward_single_frame(x, h)
 
+class BatchedConvGRU(ConvGRU):
+    """
+    ConvGRU with the input-to-hidden convolutions computed for all frames at once.\n
+    The `ih` & `hh` kernels are split into the x part and the h part (convolution is linear),
+    so only the recurrent part is left in the time loop.\n
+    Parameters are shared with `ConvGRU`, so the checkpoints are loaded unchanged.
+    """
+    def forward_time_series(self, x, h):
+        B, T = x.shape[:2]
+        ch = self.channels
+        conv_ih, conv_hh = self.ih[0], self.hh[0]
+        x = x.flatten(0, 1)
+        x_ih = F.conv2d(x, conv_ih.weight[:, :ch], conv_ih.bias, padding=conv_ih.padding).unflatten(0, (B, T))
+        x_hh = F.conv2d(x, conv_hh.weight[:, :ch], conv_hh.bias, padding=conv_hh.padding).unflatten(0, (B, T))
+        w_ih = conv_ih.weight[:, ch:]
+        w_hh = conv_hh.weight[:, ch:]
+        o = []
+        for t in range(T):
+            r, z = self.ih[1](x_ih[:, t] + F.conv2d(h, w_ih, padding=conv_ih.padding)).split(ch, dim=1)
+            c = self.hh[1](x_hh[:, t] + F.conv2d(r * h, w_hh, padding=conv_hh.padding))
+            h = (1 - z) * h + z * c
+            o.append(h)
+        o = torch.stack(o, dim=1)
+        return o, h
+
 class GRUBottleneckBlock(nn.Module):
-    def __init__(self, channels, gru=ConvGRU):
+    def __init__(self, channels, gru=BatchedConvGRU):
         super().__init__()
         self.channels = channels
         self.gru = gru(channels // 2)
@@ -153,7 +178,7 @@ class GRUBottleneckBlock(nn.Module):
         return x, r
 
 class GRUUpsamplingBlock(nn.Module):
-    def __init__(self, in_channels, skip_channels, src_channels, out_channels, gru=ConvGRU):
+    def __init__(self, in_channels, skip_channels, src_channels, out_channels, gru=BatchedConvGRU):
         super().__init__()
         self.out_channels = out_channels
         self.upsample = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=False)
@@ -196,7 +221,7 @@ class GRUUpsamplingBlock(nn.Module):
             return self.forward_single_frame(x, f, s, r)
 
 class GRUUpsamplingBlockWithoutSkip(GRUUpsamplingBlock):
-    def __init__(self, in_channels, src_channels, out_channels, gru=ConvGRU):
+    def __init__(self, in_channels, src_channels, out_channels, gru=BatchedConvGRU):
         super().__init__(in_channels, 0, src_channels, out_channels, gru)
 
     def forward_single_frame(self, x, s, r: Optional[Tensor]):
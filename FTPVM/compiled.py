@@ -0,0 +1,173 @@
+"""
+torch.compile execution path of the streaming model.
+The frames are padded into resolution buckets and the chunks are split into power-of-2 lengths,
+so only a handful of graphs are compiled for any video,
+and the compiled artifacts are cached on disk to be reused by the next processes.
+"""
+import os
+import torch
+from torch import Tensor
+from torch.nn import functional as F
+
+from .model import FastTrimapPropagationVideoMatting
+from .roi import ROIInference
+
+ARTIFACTS_NAME = 'ftpvm_compile_artifacts.bin'
+
+def setup_compile_cache(cache_dir):
+    """
+    Persistent inductor caches (FX graphs & kernels) under `cache_dir`,
+    call it before the first compilation
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(os.path.join(cache_dir, 'inductor'))
+    os.environ['TORCHINDUCTOR_FX_GRAPH_CACHE'] = '1'
+    os.environ['TORCHINDUCTOR_AUTOGRAD_CACHE'] = '1'
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        pass
+
+def load_cache_artifacts(path):
+    """ preload the portable compile artifacts (torch >= 2.7), return whether they are loaded """
+    if not os.path.isfile(path) or not hasattr(torch.compiler, 'load_cache_artifacts'):
+        return False
+    with open(path, 'rb') as f:
+        torch.compiler.load_cache_artifacts(f.read())
+    return True
+
+def save_cache_artifacts(path):
+    """ save the compile artifacts of this process (torch >= 2.7), return whether they are saved """
+    if not hasattr(torch.compiler, 'save_cache_artifacts'):
+        return False
+    artifacts = torch.compiler.save_cache_artifacts()
+    if artifacts is None:
+        return False
+    with open(path, 'wb') as f:
+        f.write(artifacts[0])
+    return True
+
+def split_chunk(t, max_chunk):
+    """ split `t` frames into power-of-2 lengths <= `max_chunk`, e.g. 7 -> [4, 2, 1] """
+    lengths = []
+    size = 1 << (max_chunk.bit_length()-1)
+    while t > 0:
+        while size > t:
+            size >>= 1
+        lengths.append(size)
+        t -= size
+    return lengths
+
+class CompiledMatting:
+    """
+    Compiled `forward_with_memory` & `encode_imgs_to_value` with the same signatures & outputs.\n
+    `bucket`: the frames are padded (replicated borders) to multiples of `bucket` pixels of each side\n
+    `max_chunk`: chunks are split into power-of-2 lengths up to it, the RNN memories are carried over\n
+    The downsample ratio is quantized so the working size of the larger side is a multiple of `bucket` (see `quantize_ratio`),
+    a graph is compiled per ratio\n
+    `cache_dir`: persistent compile cache shared between processes, call `save_cache` after the warm up\n
+    The full-resolution outputs are cropped back to the frames, the low-resolution outputs (`downsample_ratio` < 1)
+    are cropped to the frame content without the padding to multiples of 16\n
+    `mode`, `backend`: of `torch.compile`
+    """
+    def __init__(self,
+        model: FastTrimapPropagationVideoMatting,
+        bucket=128, max_chunk=8, cache_dir=None, mode=None, backend='inductor',
+    ):
+        assert bucket % 16 == 0, 'Bucket size must be a multiple of 16'
+        if not hasattr(torch, 'compile'):
+            raise RuntimeError(f'torch.compile needs torch >= 2.0, found {torch.__version__}')
+        self.model = model
+        self.bucket = bucket
+        self.max_chunk = max_chunk
+        self.cache_dir = cache_dir
+        self.cache_loaded = False
+        if cache_dir is not None:
+            setup_compile_cache(cache_dir)
+            self.cache_loaded = load_cache_artifacts(os.path.join(cache_dir, ARTIFACTS_NAME))
+        # 1 graph per (bucket, chunk length, downsample ratio)
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+        self._forward = torch.compile(model.forward_with_memory, mode=mode, backend=backend, dynamic=False)
+        self._encode = torch.compile(model.encode_imgs_to_value, mode=mode, backend=backend, dynamic=False)
+        self.shapes = set() # compiled input shapes
+
+    def __getattr__(self, name):
+        # default_rec, rec_strides, parameters, ...
+        return getattr(self.model, name)
+
+    def save_cache(self):
+        if self.cache_dir is not None:
+            return save_cache_artifacts(os.path.join(self.cache_dir, ARTIFACTS_NAME))
+        return False
+
+    def pad(self, x: Tensor):
+        """ pad the bottom & right of (b, t, c, h, w) to the bucket """
+        if x is None:
+            return None
+        h, w = x.shape[-2:]
+        ph, pw = -h % self.bucket, -w % self.bucket
+        if ph == 0 and pw == 0:
+            return x
+        return F.pad(x.flatten(0, 1), (0, pw, 0, ph), mode='replicate').unflatten(0, x.shape[:2])
+
+    def padded_size(self, h, w):
+        """ (h, w) of the frames padded to the bucket, the RNN memories are of this size """
+        return h + -h % self.bucket, w + -w % self.bucket
+
+    def quantize_ratio(self, downsample_ratio, h, w):
+        """ the downsample ratio of the frames (`h`, `w`) whose larger working side is a multiple of `bucket` """
+        if downsample_ratio == 1:
+            return 1
+        size = max(self.padded_size(h, w))
+        steps = max(round(downsample_ratio * size / self.bucket), 1)
+        return min(steps * self.bucket / size, 1)
+
+    def encode_imgs_to_value(self, imgs, masks, downsample_ratio=1):
+        downsample_ratio = self.quantize_ratio(downsample_ratio, *imgs.shape[-2:])
+        return self._encode(self.pad(imgs), self.pad(masks), downsample_ratio)
+
+    def forward_with_memory(self,
+        qimgs: Tensor, m_feat16: Tensor, m_value: Tensor,
+        rec_seg=None, rec_mat=None,
+        downsample_ratio: float = 1,
+        segmentation_pass: bool = False,
+        replace_seg=None,
+        **kwargs,
+    ):
+        h, w = qimgs.shape[-2:]
+        downsample_ratio = self.quantize_ratio(downsample_ratio, h, w)
+        qimgs = self.pad(qimgs)
+        if rec_seg is None or rec_seg[0] is None or rec_mat is None or rec_mat[0] is None:
+            # fixed tensor signature instead of `None` or `default_rec` ([None, None])
+            zero_seg, zero_mat = self.model.zero_rec(qimgs.size(0),
+                *self.model.working_size(*qimgs.shape[-2:], downsample_ratio), device=qimgs.device, dtype=qimgs.dtype)
+            rec_seg = zero_seg if rec_seg is None or rec_seg[0] is None else rec_seg
+            rec_mat = zero_mat if rec_mat is None or rec_mat[0] is None else rec_mat
+
+        outs, start = [], 0
+        for t in split_chunk(qimgs.size(1), self.max_chunk):
+            self.shapes.add((tuple(qimgs[:, start:start+t].shape), downsample_ratio))
+            *out, rec = self._forward(
+                qimgs[:, start:start+t], m_feat16, m_value, rec_seg, rec_mat,
+                downsample_ratio=downsample_ratio, segmentation_pass=segmentation_pass,
+                replace_seg=self.pad(replace_seg) if start == 0 else None, **kwargs)
+            rec_seg, rec_mat = rec if not segmentation_pass else (rec, rec_mat)
+            outs.append(out)
+            start += t
+
+        outs = [None if o[0] is None else self.crop(torch.cat(o, dim=1), h, w, qimgs.shape[-2:], downsample_ratio) for o in zip(*outs)]
+        return [*outs, rec_seg if segmentation_pass else [rec_seg, rec_mat]]
+
+    @staticmethod
+    def crop(x: Tensor, h, w, padded_size, downsample_ratio):
+        """ crop the output `x` of the padded frames (`padded_size`) to the frames (`h`, `w`) """
+        if tuple(x.shape[-2:]) == tuple(padded_size):
+            return x[..., :h, :w]
+        # working resolution (or its stride)
+        geometry = ROIInference.working_geometry((0, 0, *padded_size), downsample_ratio)
+        slices = []
+        for (_, length, scaled, padded, lo), size, n in zip(geometry, x.shape[-2:], (h, w)):
+            k = size / padded
+            slices.append(slice(round(lo*k), round((lo + n*scaled/length)*k)))
+        return x[..., slices[0], slices[1]]
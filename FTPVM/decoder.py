@@ -4,10 +4,10 @@ import torch.nn.functional as F
 from .basic_block import *
 
 class SegmentationDecoderTo4x(nn.Module):
-    def __init__(self, feature_channels, decoder_channels, gru=ConvGRU):
+    def __init__(self, feature_channels, decoder_channels, gru=BatchedConvGRU):
         super().__init__()
         assert len(feature_channels) == 4
-        self.decode4 = GRUBottleneckBlock(feature_channels[3])
+        self.decode4 = GRUBottleneckBlock(feature_channels[3], gru=gru)
         self.decode3 = GRUUpsamplingBlock(feature_channels[3], feature_channels[2], 3, decoder_channels[0], gru=gru)
         # self.decode2 = GRUUpsamplingBlockWithoutSkip(decoder_channels[0], 3, decoder_channels[1], gru=gru)
         self.decode2 = UpsampleBlock(3, decoder_channels[0], decoder_channels[1])
@@ -28,7 +28,7 @@ class SegmentationDecoderTo4x(nn.Module):
     
 
 class MattingDecoderFrom4x(nn.Module):
-    def __init__(self, feature_channels, ch_skips, ch_decode, gru=ConvGRU):
+    def __init__(self, feature_channels, ch_skips, ch_decode, gru=BatchedConvGRU):
         super().__init__()
         assert len(ch_decode) == 4
         def get_conv_relu_bn(ch_in, ch_out, kernel, stride=1, padding=0):
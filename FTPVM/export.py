@@ -0,0 +1,124 @@
+"""
+Stateful TorchScript export of the streaming model.
+`forward_with_memory` is wrapped with a fixed tensor signature (zero RNN memories instead of `None`),
+traced, frozen and saved with its metadata, so it can run without the Python model code.
+"""
+import json
+import torch
+from torch import nn
+from torch import Tensor
+
+from .model import FastTrimapPropagationVideoMatting
+
+class StreamingMatting(nn.Module):
+    """
+    `forward`: query frames, memory key & value, RNN memories (r8, r16, r1, r2)
+    -> trimap logits, boundary mattes, full mattes, updated RNN memories (r8, r16, r1, r2)\n
+    `encode`: memory frames & trimaps -> memory key & value
+    """
+    def __init__(self, model: FastTrimapPropagationVideoMatting, downsample_ratio: float = 1.):
+        super().__init__()
+        self.model = model
+        self.downsample_ratio = downsample_ratio
+
+    def forward(self,
+        qimgs: Tensor, m_feat16: Tensor, m_value: Tensor,
+        rec_seg8: Tensor, rec_seg16: Tensor, rec_mat1: Tensor, rec_mat2: Tensor,
+    ):
+        seg, mat, collab, (rec_seg, rec_mat) = self.model.forward_with_memory(
+            qimgs, m_feat16, m_value,
+            [rec_seg8, rec_seg16], [rec_mat1, rec_mat2],
+            downsample_ratio=self.downsample_ratio)
+        return seg, mat, collab, rec_seg[0], rec_seg[1], rec_mat[0], rec_mat[1]
+
+    def encode(self, mimgs: Tensor, masks: Tensor):
+        return self.model.encode_imgs_to_value(mimgs, masks, downsample_ratio=self.downsample_ratio)
+
+def flat_zero_rec(model: FastTrimapPropagationVideoMatting, qimgs: Tensor, downsample_ratio: float = 1.):
+    h, w = model.working_size(*qimgs.shape[-2:], downsample_ratio)
+    rec_seg, rec_mat = model.zero_rec(qimgs.size(0), h, w, device=qimgs.device, dtype=qimgs.dtype)
+    return [*rec_seg, *rec_mat]
+
+@torch.no_grad()
+def export_torchscript(
+    model: FastTrimapPropagationVideoMatting, path: str,
+    qimgs: Tensor, mimgs: Tensor, masks: Tensor,
+    downsample_ratio: float = 1., check=True, atol=1e-3,
+):
+    """
+    Trace & freeze the streaming model with example inputs and save to `path`.\n
+    The artifact is specialized to the example shapes: batch, frames per chunk (seq_chunk) and resolution.
+    """
+    model = model.eval()
+    wrapper = StreamingMatting(model, downsample_ratio).eval()
+    m_feat16, m_value = wrapper.encode(mimgs, masks)
+    rec = flat_zero_rec(model, qimgs, downsample_ratio)
+    traced = torch.jit.trace_module(wrapper, {
+        'forward': (qimgs, m_feat16, m_value, *rec),
+        'encode': (mimgs, masks),
+    }, check_trace=False)
+    frozen = torch.jit.freeze(traced, preserved_attrs=['encode'])
+
+    meta = {
+        'batch': qimgs.size(0),
+        'seq_chunk': qimgs.size(1),
+        'size': list(qimgs.shape[-2:]),
+        'downsample_ratio': downsample_ratio,
+        'rec_shapes': [list(r.shape) for r in rec],
+    }
+    torch.jit.save(frozen, path, _extra_files={'meta.json': json.dumps(meta)})
+    print('TorchScript model saved to %s.' % path)
+
+    if check:
+        print('Parity (max abs. diff.): ', check_parity(model, path, qimgs, mimgs, masks, downsample_ratio, atol=atol))
+    return meta
+
+def load_torchscript(path: str, device='cpu'):
+    """ return the frozen module & its metadata """
+    extra_files = {'meta.json': ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    return module, json.loads(extra_files['meta.json'])
+
+def zero_rec_from_meta(meta: dict, device='cpu', dtype=torch.float32):
+    """ initial RNN memories of an exported model, (r8, r16, r1, r2) """
+    return [torch.zeros(s, device=device, dtype=dtype) for s in meta['rec_shapes']]
+
+@torch.no_grad()
+def check_parity(
+    model: FastTrimapPropagationVideoMatting, path: str,
+    qimgs: Tensor, mimgs: Tensor, masks: Tensor,
+    downsample_ratio: float = 1., steps=3, atol=1e-3, seed=0,
+):
+    """
+    Compare the exported model with eager mode over `steps` chunks with threaded RNN memories,
+    the eager model starts from `default_rec` (None).\n
+    return max abs. difference of each output (mean abs. difference of the full mattes)
+    """
+    scripted, meta = load_torchscript(path, qimgs.device)
+    model = model.eval()
+    diffs = {}
+    def update(name, a, b):
+        diffs[name] = max(diffs.get(name, 0.), (a-b).abs().max().item())
+
+    memory = model.encode_imgs_to_value(mimgs, masks, downsample_ratio=downsample_ratio)
+    memory_s = scripted.encode(mimgs, masks)
+    update('m_feat16', memory[0], memory_s[0])
+    update('m_value', memory[1], memory_s[1])
+
+    gen = torch.Generator().manual_seed(seed)
+    rec = model.default_rec
+    rec_s = zero_rec_from_meta(meta, qimgs.device, qimgs.dtype)
+    for _ in range(steps):
+        q = torch.rand(qimgs.shape, generator=gen).to(qimgs.device, qimgs.dtype)
+        seg, mat, collab, rec = model.forward_with_memory(q, *memory, *rec, downsample_ratio=downsample_ratio)
+        seg_s, mat_s, collab_s, *rec_s = scripted(q, *memory_s, *rec_s)
+        update('seg', seg, seg_s)
+        update('mat', mat, mat_s)
+        # trimap classes can flip on ties after the numerics of freezing, compare the full mattes on average
+        diffs['collab'] = max(diffs.get('collab', 0.), (collab-collab_s).abs().mean().item())
+        for i, (r, r_s) in enumerate(zip([*rec[0], *rec[1]], rec_s)):
+            update(f'rec{i}', r, r_s)
+
+    for k, v in diffs.items():
+        assert v <= atol, f'Exported model mismatches on {k}: {v} > {atol}'
+    return diffs
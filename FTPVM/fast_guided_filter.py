@@ -1,15 +1,16 @@
 import torch
 from torch import nn
 from torch.nn import functional as F
+from .util import float32_region, region_dtype
 
 """
 Adopted from <https://github.com/wuhuikai/DeepGuidedFilter/>
 """
 
 class FastGuidedFilterRefiner(nn.Module):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, radius=1, box_filter='conv', **kwargs):
         super().__init__()
-        self.guilded_filter = FastGuidedFilter(1)
+        self.guilded_filter = FastGuidedFilter(radius, box_filter=box_filter)
     
     def forward_single_frame(self, fine_src, base_src, base_pha):
         return self.guilded_filter(base_src.mean(1, keepdim=True), base_pha, fine_src.mean(1, keepdim=True))
@@ -21,24 +22,39 @@ class FastGuidedFilterRefiner(nn.Module):
             base_pha.flatten(0, 1)).unflatten(0, fine_src.shape[:2])
     
     def forward(self, fine_src, base_src, base_pha):
-        if fine_src.ndim == 5:
-            return self.forward_time_series(fine_src, base_src, base_pha)
-        else:
-            return self.forward_single_frame(fine_src, base_src, base_pha)
+        # keep the guided filter in float32, `var_x + eps` underflows in half precision,
+        # the mattes are cast back to the dtype of a half model (float32 under autocast)
+        dtype = region_dtype(base_pha)
+        with float32_region(fine_src.device.type):
+            fine_src, base_src, base_pha = fine_src.float(), base_src.float(), base_pha.float()
+            if fine_src.ndim == 5:
+                out = self.forward_time_series(fine_src, base_src, base_pha)
+            else:
+                out = self.forward_single_frame(fine_src, base_src, base_pha)
+        return out.to(dtype)
 
 
 class FastGuidedFilter(nn.Module):
-    def __init__(self, r: int, eps: float = 1e-5):
+    def __init__(self, r: int, eps: float = 1e-5, box_filter: str = 'conv'):
+        """
+        `box_filter`: 'conv' for separable convolutions (cost grows with `r`),
+        'integral' for cumulative sums (constant cost per pixel regardless of `r`)
+        """
         super().__init__()
         self.r = r
         self.eps = eps
-        self.boxfilter = BoxFilter(r)
+        self.boxfilter = {
+            'conv': BoxFilter,
+            'integral': IntegralBoxFilter,
+        }[box_filter](r)
 
     def forward(self, lr_x, lr_y, hr_x):
-        mean_x = self.boxfilter(lr_x)
-        mean_y = self.boxfilter(lr_y)
-        cov_xy = self.boxfilter(lr_x * lr_y) - mean_x * mean_y
-        var_x = self.boxfilter(lr_x * lr_x) - mean_x * mean_x
+        # filter the 4 statistics in 1 call
+        mean_x, mean_y, mean_xy, mean_xx = self.boxfilter(
+            torch.cat([lr_x, lr_y, lr_x * lr_y, lr_x * lr_x], dim=1)
+        ).split([lr_x.size(1), lr_y.size(1), lr_x.size(1), lr_x.size(1)], dim=1)
+        cov_xy = mean_xy - mean_x * mean_y
+        var_x = mean_xx - mean_x * mean_x
         A = cov_xy / (var_x + self.eps)
         b = mean_y - A * mean_x
         A = F.interpolate(A, hr_x.shape[2:], mode='bilinear', align_corners=False)
@@ -54,10 +70,38 @@ class BoxFilter(nn.Module):
     def forward(self, x):
         # Note: The original implementation at <https://github.com/wuhuikai/DeepGuidedFilter/>
         #       uses faster box blur. However, it may not be friendly for ONNX export.
-        #       We are switching to use simple convolution for box blur.
+        #       Separable average pooling (zero padding, divided by the full window) has no kernels to build or keep,
+        #       the same result as convolutions with 1 / kernel_size kernels.
         kernel_size = 2 * self.r + 1
-        kernel_x = torch.full((x.data.shape[1], 1, 1, kernel_size), 1 / kernel_size, device=x.device, dtype=x.dtype)
-        kernel_y = torch.full((x.data.shape[1], 1, kernel_size, 1), 1 / kernel_size, device=x.device, dtype=x.dtype)
-        x = F.conv2d(x, kernel_x, padding=(0, self.r), groups=x.data.shape[1])
-        x = F.conv2d(x, kernel_y, padding=(self.r, 0), groups=x.data.shape[1])
-        return x
\ No newline at end of file
+        x = F.avg_pool2d(x, (1, kernel_size), stride=1, padding=(0, self.r), count_include_pad=True)
+        x = F.avg_pool2d(x, (kernel_size, 1), stride=1, padding=(self.r, 0), count_include_pad=True)
+        return x
+
+
+class IntegralBoxFilter(nn.Module):
+    """
+    Box filter by integral image (cumulative sums), O(1) per pixel regardless of `r`.\n
+    Same result as `BoxFilter`: zero padding and divided by the full window size.\n
+    The sums are accumulated in `acc_dtype` to limit the cancellation error of large cumsums,
+    by default float64 on CPU & float32 on the other devices (slow float64 on consumer GPUs, not supported by MPS).
+    """
+    def __init__(self, r, acc_dtype=None):
+        super().__init__()
+        self.r = r
+        self.acc_dtype = acc_dtype
+
+    def _box_sum(self, x, dim):
+        r = self.r
+        length = x.size(dim)
+        # pad r+1 zeros before & r zeros after, window sum of i = c[i+2r+1] - c[i]
+        pad = (r+1, r, 0, 0) if dim == 3 else (0, 0, r+1, r)
+        c = F.pad(x, pad).cumsum(dim)
+        return c.narrow(dim, 2*r+1, length) - c.narrow(dim, 0, length)
+
+    def forward(self, x):
+        kernel_size = 2 * self.r + 1
+        acc_dtype = self.acc_dtype
+        if acc_dtype is None:
+            acc_dtype = torch.float64 if x.device.type == 'cpu' else torch.float32
+        y = self._box_sum(self._box_sum(x.to(acc_dtype), 3), 2)
+        return (y / (kernel_size * kernel_size)).to(x.dtype)
@@ -8,9 +8,12 @@ from torch.nn import functional as F
 
 from .model import *
 from .memory_bank import MemoryBank
+from .session import MattingSession
+from .util import autocast_context, to_channels_last
 from dataset.vm108_dataset import VM108ValidationDataset
 
 from util.tensor_util import pad_divide_by, unpad
+from util.timeline import Timeline, span
 from torch.utils.data import DataLoader
 from time import time
 from tqdm import tqdm, trange
@@ -18,9 +21,21 @@ import mediapy as media
 
 class InferenceCore:
     def __init__(self, 
-        model, dataset:VM108ValidationDataset, loader_iter, pad=16, last_data=None, downsample_ratio=1.
+        model, dataset:VM108ValidationDataset, loader_iter, pad=16, last_data=None, downsample_ratio=1., device='cuda',
+        channels_last=False, autocast_dtype=None, dtype=torch.float32, timeline: Timeline=None,
     ):
-
+        """
+        `device`, `dtype`: where & in which dtype the model runs, the outputs are stored on CPU in float32\n
+        `channels_last`: convert the model & frames to channels-last memory format\n
+        `autocast_dtype`: run the model under autocast, e.g. bfloat16 on CPU\n
+        `timeline`: records the spans of each chunk (load, transfer, encode, forward, readback, store)
+        """
+        self.timeline = timeline
+        self.chunk = (0, 0)
+        self.channels_last = channels_last
+        self.autocast_dtype = autocast_dtype
+        if channels_last:
+            model = model.to(memory_format=torch.channels_last)
         self.model = model.eval()
         self.dataset = dataset
         self.loader_iter = loader_iter
@@ -67,7 +82,9 @@ class InferenceCore:
         self.kh = self.nh//pad
         self.kw = self.nw//pad
 
-        self.device = 'cuda'
+        self.device = device
+        self.device_type = torch.device(device).type
+        self.dtype = dtype
 
         self.last_data = None
         self.is_vid_overload = False
@@ -75,6 +92,14 @@ class InferenceCore:
         self.save_start_idx = 0
         print('Process video %s with %d frames' % (self.name.replace('/', '_'), self.total_frames))
 
+    def span(self, name):
+        """ span of the current chunk in `self.timeline` """
+        return span(self.timeline, name, video=self.name, start=self.chunk[0], end=self.chunk[1])
+
+    def to_device(self, x: torch.Tensor):
+        x = x.to(self.device, self.dtype)
+        return to_channels_last(x) if self.channels_last else x
+
     def tensor_aloc(self, tensor: torch.Tensor, start=0):
         if tensor is None:
             return None
@@ -98,9 +123,13 @@ class InferenceCore:
         return tensor
 
     def tensor_repeat_indices(self, tensor: torch.Tensor,):
+        return tensor[self.repeat_indices(tensor.shape[0])]
+
+    def repeat_indices(self, length):
+        """ index of the last annotated frame of each of `length` frames """
         assert self.partial_annot
-        idx = torch.LongTensor(self.annotated + [tensor.shape[0]])
-        return torch.repeat_interleave(tensor[self.annotated], idx[1:]-idx[:-1], dim=0)
+        idx = torch.LongTensor(self.annotated + [length])
+        return torch.repeat_interleave(torch.LongTensor(self.annotated), idx[1:]-idx[:-1], dim=0)
 
     def pad_imgs(self, imgs):
         return pad_divide_by(imgs, self.pad_size)[0]
@@ -159,22 +188,41 @@ class InferenceCore:
     def propagate(self):
         raise NotImplementedError
 
-    def save_video(self, path):
+    def video_panels(self):
+        """ rows of panels of the comparison video, (frames (T, c, H, W), frame indices or `None`) """
+        gt_idx = self.repeat_indices(self.gts.shape[0]) if self.partial_annot else None
+        return [[(self.images, None), (self.masks, None), (self.gts, gt_idx)]]
+
+    def video_chunk(self, rows, start, end):
+        """ frames [`start`, `end`) of the comparison video, (t, rows*H, 3W, 3) in uint8 at the preview width """
+        frames = []
+        for row in rows:
+            panels = []
+            for imgs, idx in row:
+                imgs = self.unpad_downsample(imgs[start:end] if idx is None else imgs[idx[start:end]])
+                panels.append(imgs.expand(-1, 3, -1, -1)) # gray to rgb
+            frames.append(torch.cat(panels, dim=3))
+        # as `media.write_video`
+        return torch.cat(frames, dim=2).clamp(0, 1).mul(255).add(0.5).byte().permute(0, 2, 3, 1).numpy()
+
+    def save_video(self, path, chunk=32):
+        """ encode the comparison video `chunk` frames at a time, without the whole video in memory """
         if self.save_start_idx > 0:
             return
         name = self.name.replace('/', '_')
         print(f"Save video: {path}, {name} ")
-        # T, 3, H, W
         T = self.current_out_t
-        masks = torch.repeat_interleave(self.masks[:T], 3, dim=1)
-        gts = self.gts[:T]
-        if self.partial_annot:
-            gts = self.tensor_repeat_indices(self.gts)
-        gts = torch.repeat_interleave(gts, 3, dim=1)
-        vid_arr = [self.unpad_downsample(i) for i in [self.images[:T], masks, gts]]
-        vid = torch.cat(vid_arr, axis=3).permute(0, 2, 3, 1) # T, H, 3W, 3
+        if T == 0:
+            return
+        rows = self.video_panels()
         os.makedirs(path, exist_ok=True)
-        media.write_video(os.path.join(path, f'{name}.mp4'), vid.numpy(), fps=15)
+        frames = self.video_chunk(rows, 0, min(chunk, T))
+        with media.VideoWriter(os.path.join(path, f'{name}.mp4'), shape=frames.shape[1:3], fps=15) as writer:
+            for start in range(0, T, chunk):
+                if start > 0:
+                    frames = self.video_chunk(rows, start, min(start+chunk, T))
+                for frame in frames:
+                    writer.add_image(frame)
 
     def unpad_downsample(self, imgs, target_width=512):
         # t, c, h, w
@@ -268,8 +316,14 @@ class InferenceCoreRecurrent(InferenceCore):
         memory_save_iter=-1,
         memory_bank_size=5,
         replace_by_given_tri=False,
+        device='cuda',
+        channels_last=False,
+        autocast_dtype=None,
+        dtype=torch.float32,
+        timeline=None,
     ):
-        super().__init__(model, dataset, loader_iter, pad, last_data, downsample_ratio=downsample_ratio)
+        super().__init__(model, dataset, loader_iter, pad, last_data, downsample_ratio=downsample_ratio, device=device,
+            channels_last=channels_last, autocast_dtype=autocast_dtype, dtype=dtype, timeline=timeline)
         self.disable_recurrent = disable_recurrent
         self.model = model
         self.gru_mems = model.default_rec if 'default_rec' in dir(model) else [None] * 4
@@ -292,7 +346,8 @@ class InferenceCoreRecurrent(InferenceCore):
     
     def _forward(self, query_imgs, memory_img, memory_mask, replace_tri=False):
         # ret = self.model.forward(query_imgs, memory_img, memory_mask, *self.gru_mems, downsample_ratio=self.downsample_ratio)
-        ret = self.model.forward_with_memory(query_imgs, *self.memory_bank.get_memory(), *self.gru_mems, self.downsample_ratio)
+        with self.span('forward'):
+            ret = self.model.forward_with_memory(query_imgs, *self.memory_bank.get_memory(), *self.gru_mems, self.downsample_ratio)
         if self.disable_recurrent:
             pha, _ = ret[:2]
         else:
@@ -300,54 +355,71 @@ class InferenceCoreRecurrent(InferenceCore):
 
         if pha.size(2) > 1:
             pha = pha[:, :, [0]]
-        if self.masks is None:
-            self.masks = pha[0].cpu() 
-        else:
-            self.masks = torch.cat([self.masks, pha[0].cpu()], 0)
+        with self.span('readback'):
+            out = pha[0].cpu().float()
+        with self.span('store'):
+            if self.masks is None:
+                self.masks = out
+            else:
+                self.masks = torch.cat([self.masks, out], 0)
         return pha
 
     def propagate(self, frame_idx=0, end_idx=-1):
+        with autocast_context(self.device_type, self.autocast_dtype):
+            return self._propagate(frame_idx, end_idx)
+
+    def _propagate(self, frame_idx=0, end_idx=-1):
         if end_idx < 0:
             end_idx = self.total_frames
         
         this_range = self.get_frame_stamps(frame_idx, end_idx, self.clip_size)
 
         # take GT if input mask is not given
-        while self.current_t <= frame_idx:
-                self.add_images_from_loader()
+        self.chunk = (frame_idx, frame_idx+1)
+        with self.span('load'):
+            while self.current_t <= frame_idx:
+                    self.add_images_from_loader()
         mask_idx = frame_idx
 
         mask = self.get_memory_mask(mask_idx).unsqueeze(0)
         # =====================
 
         # Initial memory mask
-        mem_mask = mask.unsqueeze(0).cuda() # 1, 1, 1, H, W
-        mem_rgb = self.get_memory_img(mask_idx).unsqueeze(0).unsqueeze(0).cuda() # 1, 1, C, H, W
+        with self.span('transfer'):
+            mem_mask = self.to_device(mask.unsqueeze(0)) # 1, 1, 1, H, W
+            mem_rgb = self.to_device(self.get_memory_img(mask_idx).unsqueeze(0).unsqueeze(0)) # 1, 1, C, H, W
         frame_count = 0
         frame_count_savemem = 0
         total_time = 0
-        self.memory_bank.add_gt_memory(*self.model.encode_imgs_to_value(mem_rgb, mem_mask, self.downsample_ratio))
+        with self.span('encode'):
+            self.memory_bank.add_gt_memory(*self.model.encode_imgs_to_value(mem_rgb, mem_mask, self.downsample_ratio))
 
         for i in tqdm(range(len(this_range)-1)):
             # batch processing
             start, end = this_range[i:i+2]
-            while self.current_t < end:
-                self.add_images_from_loader()
-            rgb = self.images[start:end].unsqueeze(0).cuda() # 1 T 3 H W
+            self.chunk = (start, end)
+            with self.span('load'):
+                while self.current_t < end:
+                    self.add_images_from_loader()
+            with self.span('transfer'):
+                rgb = self.to_device(self.images[start:end].unsqueeze(0)) # 1 T 3 H W
             replace_tri = False
 
             if self.memory_iter >= 0 and frame_count >= self.memory_iter:
                 # Feed memory mask
-                mem_rgb = self.get_memory_img(start).unsqueeze(0).unsqueeze(0).cuda()
-                mem_mask = self.get_memory_mask(start).unsqueeze(0).unsqueeze(0).cuda()
-                self.memory_bank.add_gt_memory(*self.model.encode_imgs_to_value(mem_rgb, mem_mask, self.downsample_ratio))
+                with self.span('transfer'):
+                    mem_rgb = self.to_device(self.get_memory_img(start).unsqueeze(0).unsqueeze(0))
+                    mem_mask = self.to_device(self.get_memory_mask(start).unsqueeze(0).unsqueeze(0))
+                with self.span('encode'):
+                    self.memory_bank.add_gt_memory(*self.model.encode_imgs_to_value(mem_rgb, mem_mask, self.downsample_ratio))
                 frame_count = 0
                 replace_tri = True
             
             if self.memory_save_iter > 0 and frame_count_savemem >= self.memory_save_iter:
                 # Self-feed memory mask from output trimap
                 frame_count_savemem = frame_count_savemem-self.memory_save_iter
-                self.add_memory_bank(start-frame_count_savemem-1)
+                with self.span('encode'):
+                    self.add_memory_bank(start-frame_count_savemem-1)
             time_start = time()
             out = self.forward(rgb, mem_rgb, mem_mask, replace_tri=(replace_tri and self.replace_by_given_tri))
             total_time += time()-time_start
@@ -371,31 +443,34 @@ class InferenceCoreRecurrent(InferenceCore):
         raise NotImplementedError
 
 class InferenceCoreRecurrentMemory(InferenceCoreRecurrent):
-    def __init__(self, model: FastTrimapPropagationVideoMatting, dataset: VM108ValidationDataset, loader_iter, pad=16, last_data=None, memory_gt=False, memory_iter=False, memory_bg=False, downsample_ratio=1., memory_save_iter=-1, memory_bank_size=5, replace_by_given_tri=False,):
-        super().__init__(model, dataset, loader_iter, pad, last_data, memory_gt, memory_iter, memory_bg=memory_bg, downsample_ratio=downsample_ratio, memory_save_iter=memory_save_iter, memory_bank_size=memory_bank_size, replace_by_given_tri=replace_by_given_tri)
+    def __init__(self, model: FastTrimapPropagationVideoMatting, dataset: VM108ValidationDataset, loader_iter, pad=16, last_data=None, memory_gt=False, memory_iter=False, memory_bg=False, downsample_ratio=1., memory_save_iter=-1, memory_bank_size=5, replace_by_given_tri=False, device='cuda', channels_last=False, autocast_dtype=None, dtype=torch.float32, timeline=None,):
+        super().__init__(model, dataset, loader_iter, pad, last_data, memory_gt, memory_iter, memory_bg=memory_bg, downsample_ratio=downsample_ratio, memory_save_iter=memory_save_iter, memory_bank_size=memory_bank_size, replace_by_given_tri=replace_by_given_tri, device=device, channels_last=channels_last, autocast_dtype=autocast_dtype, dtype=dtype, timeline=timeline)
 
         self.glance_outs = None
         self.focus_outs = None
         self.save_bg = False
+        # reusable buffers of the RNN memories & trimaps, shares the memory bank
+        self.session = MattingSession(self.model, downsample_ratio, memory_bank=self.memory_bank, recurrent=not self.disable_recurrent)
 
     def add_memory_bank(self, idx):
         self.mem_idx = idx
-        rgb = self.images[idx].unsqueeze(0).unsqueeze(0).cuda()
-        tri = self.glance_outs[idx].unsqueeze(0).unsqueeze(0).cuda()
+        rgb = self.to_device(self.images[idx].unsqueeze(0).unsqueeze(0))
+        tri = self.to_device(self.glance_outs[idx].unsqueeze(0).unsqueeze(0))
         self.memory_bank.add_memory(*self.model.encode_imgs_to_value(rgb, tri), self.downsample_ratio)
 
     def _forward(self, query_imgs, memory_img, memory_mask, replace_tri=False):
-        if self.memory_save_iter < 0 and replace_tri:
-            glance, focus, pha, gru_mems = self.model.forward(query_imgs, memory_img, memory_mask, *self.gru_mems, downsample_ratio=self.downsample_ratio, replace_given_seg=replace_tri)
-        else:
-            glance, focus, pha, gru_mems = self.model.forward_with_memory(query_imgs, *self.memory_bank.get_memory(), *self.gru_mems, downsample_ratio=self.downsample_ratio)
-
-        if not self.disable_recurrent:
-            self.gru_mems = gru_mems
-        glance = self.seg_to_trimap(glance)
-        self.masks = self.tensor_cat(self.masks, pha[0].cpu(), self.current_out_t)
-        self.glance_outs = self.tensor_cat(self.glance_outs, glance[0].cpu(), self.current_out_t)
-        self.focus_outs = self.tensor_cat(self.focus_outs, focus[0].cpu(), self.current_out_t)
+        # the given memory frame is already encoded in the memory bank (its only entry without self-fed memory),
+        # so only its trimap is needed to replace the first output trimap
+        replace_seg = memory_mask if self.memory_save_iter < 0 and replace_tri else None
+        with self.span('forward'):
+            out = self.session.push(query_imgs, replace_seg=replace_seg)
+        focus, pha, glance = out['mat'], out['pha'], out['trimap']
+        with self.span('readback'):
+            outs = [x[0].cpu().float() for x in (pha, glance, focus)]
+        with self.span('store'):
+            self.masks = self.tensor_cat(self.masks, outs[0], self.current_out_t)
+            self.glance_outs = self.tensor_cat(self.glance_outs, outs[1], self.current_out_t)
+            self.focus_outs = self.tensor_cat(self.focus_outs, outs[2], self.current_out_t)
         return pha
 
     def _forward_fg(self, query_imgs, memory_img, memory_mask):
@@ -437,32 +512,10 @@ class InferenceCoreRecurrentMemory(InferenceCoreRecurrent):
     #         media.write_image(os.path.join(tri_path, f'{i:04d}_trimap.png'), tris[i])
     #     return
 
-    def save_video(self, path):
-        if self.save_start_idx > 0:
-            return
-        name = self.name.replace('/', '_')
-        print(f"Save video: {path}, {name} ")
-        # T, 3, H, W
-        T = self.current_out_t
-        masks = torch.repeat_interleave(self.masks[:T], 3, dim=1)
-        gts = self.gts[:T]
-        if self.partial_annot:
-            gts = self.tensor_repeat_indices(gts)
-        gts = torch.repeat_interleave(gts, 3, dim=1)
-        vid_arr = [self.unpad_downsample(i) for i in [self.images[:T], masks, gts]]
-        vid = torch.cat(vid_arr, axis=3).permute(0, 2, 3, 1) # T, H, 3W, 3
-        
+    def video_panels(self):
+        # 2nd row: boundary mattes, output trimaps & given trimaps
+        rows = super().video_panels()
         if self.glance_outs is not None:
-            glance = torch.repeat_interleave(self.glance_outs[:T], 3, dim=1)
-            focus = torch.repeat_interleave(self.focus_outs[:T], 3, dim=1)
-            trimap = self.trimaps[:T]
-            if self.partial_annot:
-                trimap = self.tensor_repeat_indices(trimap)
-            trimap = torch.repeat_interleave(trimap, 3, dim=1)
-            vid_arr = [self.unpad_downsample(i) for i in [focus, glance, trimap]]
-            vid2 = torch.cat(vid_arr, axis=3).permute(0, 2, 3, 1) # T, H, 3W, 3
-            vid = torch.cat([vid, vid2], axis=1) # T, 2H, 3W, 3
-        
-        
-        os.makedirs(path, exist_ok=True)
-        media.write_video(os.path.join(path, f'{name}.mp4'), vid.numpy(), fps=15)
+            tri_idx = self.repeat_indices(self.trimaps.shape[0]) if self.partial_annot else None
+            rows.append([(self.focus_outs, None), (self.glance_outs, None), (self.trimaps, tri_idx)])
+        return rows
@@ -1,7 +1,9 @@
+import math
 import torch
 from torch import Tensor
 from torch import nn
 from torch.nn import functional as F
+from typing import Optional, Set
 
 from .backbone import *
 from .fast_guided_filter import FastGuidedFilterRefiner
@@ -21,9 +23,16 @@ class FastTrimapPropagationVideoMatting(nn.Module):
         ch_seg=[96, 48, 16],
         ch_mat=[64, 32, 16, 8],
         ch_mask=1,
+        refiner_kwargs=None,
     ):
-
+        """
+        `refiner_kwargs`: of `FastGuidedFilterRefiner`, e.g. {'box_filter': 'integral', 'radius': 2}, without weights
+        """
         super().__init__()
+        refiner_kwargs = dict(refiner_kwargs or {})
+        # architecture, saved with the weights by `artifact.save_artifact`
+        self.config = dict(backbone_arch=backbone_arch, ch_bottleneck=ch_bottleneck, ch_key=ch_key,
+            ch_seg=list(ch_seg), ch_mat=list(ch_mat), ch_mask=ch_mask, refiner_kwargs=refiner_kwargs)
 
         # Encoder
         self.backbone = Backbone(backbone_arch, backbone_pretrained, (0, 1, 2, 3), in_chans=3)
@@ -48,12 +57,18 @@ class FastTrimapPropagationVideoMatting(nn.Module):
         self.mat_decoder = MattingDecoderFrom4x(
             self.feat_channels, 
             [ch_bottleneck] + self.ch_seg, 
-            self.ch_mat, gru=ConvGRU
+            self.ch_mat, gru=BatchedConvGRU
         )
         self.mat_project = Projection(self.ch_mat[-1], 1)
         self.default_rec = [self.seg_decoder.default_rec, self.mat_decoder.default_rec]
+        # [[r8, r16], [r1, r2]], strides are w.r.t. the (downsampled) working resolution
+        self.rec_channels = [
+            [self.seg_decoder.decode3.gru.channels, self.seg_decoder.decode4.gru.channels],
+            [self.mat_decoder.decode2.gru.channels, self.mat_decoder.decode1.gru.channels],
+        ]
+        self.rec_strides = [[8, 16], [1, 2]]
 
-        self.refiner = FastGuidedFilterRefiner(self.ch_mat)
+        self.refiner = FastGuidedFilterRefiner(self.ch_mat, **refiner_kwargs)
         
 
     def forward(self, 
@@ -63,6 +78,8 @@ class FastTrimapPropagationVideoMatting(nn.Module):
         downsample_ratio: float = 1,
         segmentation_pass: bool = False,
         replace_given_seg: bool = False,
+        tran_threshold: Optional[float] = None,
+        outputs: Optional[Set[str]] = None,
     ):
         """
         `qimgs`: query frames (b, t, 3, h, w),\n
@@ -72,7 +89,9 @@ class FastTrimapPropagationVideoMatting(nn.Module):
         `rec_mat`: RNN memory of matting decoder, which is the output of decoder, default = `None`,\n
         `downsample_ratio`: downsample to process high-res frames, and recovered by Fast Guided Filter, default = `1`,\n
         `segmentation_pass`: output segmentation only, default = `False`,\n
-        `replace_given_seg`: use the memory trimap as the result trimap in the first frame, default = `False`
+        `replace_given_seg`: use the memory trimap as the result trimap in the first frame, default = `False`,\n
+        `tran_threshold`: skip the matting decoder if the fraction of transition pixels is below it, see `decode`, default = `None`,\n
+        `outputs`: outputs to be computed, subset of {'trimap', 'alpha'}, see `decode`, default = `None` (all)
         """
         if rec_seg is None:
             rec_seg, rec_mat = self.default_rec
@@ -88,7 +107,7 @@ class FastTrimapPropagationVideoMatting(nn.Module):
         value_m = self.trimap_fuse(mimg_sm, mask_sm, feats_m) # b, c, t, h, w
         feats_q[-1] = self.bottleneck_fuse(feats_q[-1], feats_m[-1], value_m)
         replace_seg = mask_sm if replace_given_seg else None
-        return self.decode(qimgs, qimg_sm, feats_q, segmentation_pass, is_refine, rec_seg, rec_mat, replace_seg=replace_seg)
+        return self.decode(qimgs, qimg_sm, feats_q, segmentation_pass, is_refine, rec_seg, rec_mat, replace_seg=replace_seg, tran_threshold=tran_threshold, outputs=outputs)
 
     def forward_with_memory(self, 
         qimgs: Tensor, m_feat16: Tensor, m_value: Tensor,
@@ -96,6 +115,9 @@ class FastTrimapPropagationVideoMatting(nn.Module):
         rec_mat = None,
         downsample_ratio: float = 1,
         segmentation_pass: bool = False,
+        tran_threshold: Optional[float] = None,
+        replace_seg: Optional[Tensor] = None,
+        outputs: Optional[Set[str]] = None,
     ):
         """
         `qimgs`: query frames (b, t, 3, h, w),
@@ -105,12 +127,18 @@ class FastTrimapPropagationVideoMatting(nn.Module):
         `rec_mat`: RNN memory of matting decoder, which is the output of decoder, default = None,
         `downsample_ratio`: downsample to process high-res frames, and recovered by Fast Guided Filter, default = 1,
         `segmentation_pass`: output segmentation only, default = False,
+        `tran_threshold`: skip the matting decoder if the fraction of transition pixels is below it, see `decode`, default = None,
+        `replace_seg`: given trimap (b, 1, 1, h, w) of the memory frame used as the result trimap in the first frame,
+        as `replace_given_seg` of `forward` but without encoding the memory frame again, default = None,
+        `outputs`: outputs to be computed, subset of {'trimap', 'alpha'}, see `decode`, default = None (all),
         """
         if rec_mat is None:
             rec_seg, rec_mat = self.default_rec
         
         if is_refine := (downsample_ratio != 1):
             qimg_sm = self._interpolate(qimgs, scale_factor=downsample_ratio)
+            if replace_seg is not None and (outputs is None or 'alpha' in outputs):
+                replace_seg = self._interpolate(replace_seg, scale_factor=downsample_ratio)
         else:
             qimg_sm = qimgs
 
@@ -118,7 +146,7 @@ class FastTrimapPropagationVideoMatting(nn.Module):
         feats_q = self.backbone(qimg_sm)
         feats_q[-1] = self.bottleneck_fuse(feats_q[-1], m_feat16, m_value)
     
-        return self.decode(qimgs, qimg_sm, feats_q, segmentation_pass, is_refine, rec_seg, rec_mat)
+        return self.decode(qimgs, qimg_sm, feats_q, segmentation_pass, is_refine, rec_seg, rec_mat, replace_seg=replace_seg, tran_threshold=tran_threshold, outputs=outputs)
 
     def decode(self, 
         qimgs, qimg_sm, feats_q, 
@@ -127,10 +155,18 @@ class FastTrimapPropagationVideoMatting(nn.Module):
         rec_seg = None,
         rec_mat = None,
         replace_seg = None,
+        tran_threshold: Optional[float] = None,
+        outputs: Optional[Set[str]] = None,
     ):
         """
         Decode query & fused features to trimaps & mattes\n
         (and upsample the resulting mattes back to the original resolution).\n
+        `tran_threshold`: if the fraction of transition pixels of every frame in the chunk is below it,
+        the matting decoder is skipped, the boundary mattes come from the trimap probabilities
+        and the RNN memory of the matting decoder is held, the callers count it by `is_fast_path` of the trimap logits\n
+        `outputs`: subset of {'trimap', 'alpha'}, `None` for all. The trimaps are always decoded (the mattes are fused from them),
+        without 'alpha' the matting decoder, the fusion & the guided filter are skipped,
+        the RNN memory of the matting decoder is held and `out_mat`, `out_collab` are `None`\n
         return\n
         `out_seg`: output trimaps (logits) (b, t, 3, h, w)\n
         `out_mat`: output boundary mattes (b, t, 1, h, w)\n
@@ -151,21 +187,27 @@ class FastTrimapPropagationVideoMatting(nn.Module):
             out_seg = F.interpolate(out_seg.flatten(0, 1), scale_factor=self.seg_stride, mode='bilinear', align_corners=False).unflatten(0, out_seg.shape[:2])
         if segmentation_pass:
             return [out_seg, rec_seg]
+        if outputs is not None and 'alpha' not in outputs:
+            return [out_seg, None, None, [rec_seg, rec_mat]]
 
         # Matting
-        hid, *remain = self.mat_decoder(
-            qimg_sm, *qimg_sm_avg[:2], 
-            *feats_q[:2],
-            feat_seg[0], feat_seg[2],
-            *rec_mat
-        )
-        rec_mat, feats = remain[:-1], remain[-1]
-        out_mat = torch.sigmoid(self.mat_project(hid))
+        if is_fast_path(out_seg, tran_threshold):
+            # Fast path: (almost) pure background / foreground, the matting result is discarded by `collaborate_fuse` anyway
+            out_mat = seg_to_soft_alpha(out_seg)
+        else:
+            hid, *remain = self.mat_decoder(
+                qimg_sm, *qimg_sm_avg[:2], 
+                *feats_q[:2],
+                feat_seg[0], feat_seg[2],
+                *rec_mat
+            )
+            rec_mat, feats = remain[:-1], remain[-1]
+            out_mat = torch.sigmoid(self.mat_project(hid))
         if replace_seg is None:
             out_collab = collaborate_fuse(out_seg, out_mat)
         else:
             t = replace_seg.size(1)
-            out_collab = torch.zeros_like(out_mat)
+            out_collab = torch.zeros_like(out_mat, dtype=torch.float32) # see `collaborate_fuse`
             out_collab[:, :t] = collaborate_fuse_trimap(replace_seg, out_mat[:, :t])
             if out_mat.size(1) > t:
                 out_collab[:, t:] = collaborate_fuse(out_seg[:, t:], out_mat[:, t:])
@@ -194,6 +236,26 @@ class FastTrimapPropagationVideoMatting(nn.Module):
             mask_sm = memory_mask
         return is_refine, qimg_sm, mimg_sm, mask_sm
 
+    def working_size(self, h: int, w: int, downsample_ratio: float = 1):
+        """ (h, w) of the frames fed into the backbone, see `_interpolate` """
+        if downsample_ratio != 1:
+            h = math.ceil(int(h*downsample_ratio)/16)*16
+            w = math.ceil(int(w*downsample_ratio)/16)*16
+        return h, w
+
+    def zero_rec(self, batch: int, h: int, w: int, device=None, dtype=None):
+        """
+        Zero RNN memories for the working size (h, w), equivalent to `default_rec`
+        but with fixed tensor shapes, [[r8, r16], [r1, r2]]
+        """
+        return [
+            [
+                torch.zeros((batch, ch, math.ceil(h/s), math.ceil(w/s)), device=device, dtype=dtype)
+                for ch, s in zip(chs, strides)
+            ]
+            for chs, strides in zip(self.rec_channels, self.rec_strides)
+        ]
+
     def encode_key(self, imgs):
         """ encode to feats and query key """
         feats = self.backbone(imgs)
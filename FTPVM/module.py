@@ -7,6 +7,7 @@ from torch import Tensor
 from typing import Optional, List
 from .basic_block import ResBlock, Projection, GatedConv2d, AvgPool
 from . import cbam
+from .util import float32_region
 
 class FeatureFusion(nn.Module):
     def __init__(self, indim, outdim, is_resblk=True):
@@ -63,10 +64,16 @@ class PSP(nn.Module):
 class MemoryReader(nn.Module):
     def __init__(self, affinity='dotproduct'):
         super().__init__()
-        self.get_affinity = {
+        self._get_affinity = {
             'l2': self.affinity_l2,
             'dotproduct': self.affinity_dotproduct,
         }[affinity]
+
+    def get_affinity(self, mk, qk):
+        # the softmax is sensitive to precision, keep it in float32 under autocast
+        with float32_region(qk.device.type):
+            affinity = self._get_affinity(mk.float(), qk.float())
+        return affinity.to(qk.dtype)
  
     def affinity_l2(self, mk, qk):
         # L2 distance
@@ -97,8 +104,10 @@ class MemoryReader(nn.Module):
         affinity = ab / math.sqrt(CK)
         return F.softmax(affinity, dim=1)
 
-    def readout(self, affinity, mv):
+    def readout(self, affinity, mv, size=None):
+        """ `size`: (h, w) of the query, which can differ from the memory, default = the memory size """
         B, CV, T, H, W = mv.shape
+        H, W = (H, W) if size is None else size
         mv = mv.reshape(B, CV, -1) # b, ch_val, nm
         val = torch.bmm(mv, affinity) # b, ch_val, nq
         val = rearrange(val, 'b c (t h w) -> b t c h w', h=H, w=W)
@@ -154,7 +163,7 @@ class BottleneckFusion(nn.Module):
         qk = self.encode_key(f16_q)
         mk = self.encode_key(f16_m)
         A = self.reader.get_affinity(mk, qk)
-        return self.reader.readout(A, value_m) # value_m.shape == (b, c, t, h, w)
+        return self.reader.readout(A, value_m, qk.shape[-2:]) # value_m.shape == (b, c, t, h, w)
 
     def encode_key(self, feat16):
         # b, t, c, h, w -> b, ch_key, t, h, w
@@ -0,0 +1,129 @@
+"""
+Inference graph optimization for FTPVM:
+fold BatchNorm into the neighbouring convolutions and strip no-op modules.
+"""
+import copy
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+class ChannelShift(nn.Module):
+    """ Per-channel bias left by a BatchNorm whose scale is moved into the conv before ReLU """
+    def __init__(self, shift):
+        super().__init__()
+        self.register_buffer('shift', shift.detach().view(1, -1, 1, 1))
+
+    def forward(self, x):
+        return x + self.shift
+
+def _bn_scale_shift(bn: nn.BatchNorm2d):
+    weight = bn.weight if bn.affine else torch.ones_like(bn.running_var)
+    bias = bn.bias if bn.affine else torch.zeros_like(bn.running_mean)
+    scale = weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bias - bn.running_mean * scale
+    return scale.detach(), shift.detach()
+
+def _scale_conv(conv: nn.Conv2d, scale):
+    conv = copy.deepcopy(conv)
+    with torch.no_grad():
+        conv.weight.mul_(scale.view(-1, 1, 1, 1))
+        if conv.bias is None:
+            conv.bias = nn.Parameter(torch.zeros_like(scale))
+        else:
+            conv.bias.mul_(scale)
+    return conv
+
+def _is_noop(m: nn.Module):
+    return isinstance(m, nn.Identity) or (isinstance(m, nn.Dropout) and not m.training)
+
+def _fold_sequence(mods):
+    """
+    Conv -> BN: fold BN into conv\n
+    Conv -> ReLU -> BN: if all BN scales are positive, ReLU(x)*s = ReLU(x*s),
+    so the scale is folded into conv and only the shift is left after ReLU
+    """
+    mods = [m for m in mods if not _is_noop(m)]
+    out = []
+    i = 0
+    while i < len(mods):
+        m = mods[i]
+        if type(m) is nn.Conv2d and i+1 < len(mods) and type(mods[i+1]) is nn.BatchNorm2d:
+            out.append(fuse_conv_bn_eval(m, mods[i+1]))
+            i += 2
+            continue
+        if type(m) is nn.Conv2d and i+2 < len(mods) \
+            and type(mods[i+1]) is nn.ReLU and type(mods[i+2]) is nn.BatchNorm2d:
+            scale, shift = _bn_scale_shift(mods[i+2])
+            if (scale > 0).all():
+                out.extend([_scale_conv(m, scale), mods[i+1], ChannelShift(shift)])
+                i += 3
+                continue
+        out.append(m)
+        i += 1
+    return out
+
+def _fold_module(module: nn.Module):
+    # post-order, so the nested sequences are folded before their parents are rebuilt
+    count = 0
+    for name, child in list(module.named_children()):
+        count += _fold_module(child)
+        if type(child) is nn.Sequential:
+            folded = _fold_sequence(list(child))
+            count += len(child) - len(folded)
+            setattr(module, name, nn.Sequential(*folded))
+    return count
+
+def _fuse_backbone(backbone: nn.Module):
+    """ timm blocks call BN by attributes instead of nn.Sequential, trace them with torch.fx """
+    try:
+        from torch.fx.experimental.optimization import fuse
+        backbone.backbone = fuse(backbone.backbone)
+        return True
+    except Exception as e:
+        print('Backbone BatchNorm folding is skipped: ', repr(e))
+        return False
+
+@torch.no_grad()
+def verify_equivalence(ref: nn.Module, model: nn.Module, size=(256, 256), seq_len=4, downsample_ratio=1., atol=1e-3, seed=0):
+    """
+    Run both models on the same random inputs and compare the outputs.\n
+    return max abs. difference of trimap logits & boundary mattes, mean abs. difference of full mattes
+    """
+    param = next(model.parameters())
+    gen = torch.Generator().manual_seed(seed)
+    qimgs = torch.rand((1, seq_len, 3, *size), generator=gen).to(param.device, param.dtype)
+    mimgs = torch.rand((1, 1, 3, *size), generator=gen).to(param.device, param.dtype)
+    masks = torch.rand((1, 1, 1, *size), generator=gen).to(param.device, param.dtype)
+
+    seg_ref, mat_ref, collab_ref, _ = ref(qimgs, mimgs, masks, downsample_ratio=downsample_ratio)
+    seg, mat, collab, _ = model(qimgs, mimgs, masks, downsample_ratio=downsample_ratio)
+    diffs = {
+        'seg': (seg-seg_ref).abs().max().item(),
+        'mat': (mat-mat_ref).abs().max().item(),
+        # trimap classes can flip on ties, compare the full mattes on average
+        'collab': (collab-collab_ref).abs().mean().item(),
+    }
+    for k, v in diffs.items():
+        assert v <= atol, f'Optimized model mismatches on {k}: {v} > {atol}'
+    return diffs
+
+def optimize_for_inference(model: nn.Module, verify=True, inplace=False, **verify_kwargs):
+    """
+    Fold every foldable BatchNorm and strip `nn.Identity` & no-op modules.\n
+    The result is for inference only (eval mode, state dict keys are changed).\n
+    `verify`: check output equivalence on random inputs, `verify_kwargs` are passed to `verify_equivalence`
+    """
+    model = model.eval()
+    ref = copy.deepcopy(model) if (verify and inplace) else model
+    if not inplace:
+        model = copy.deepcopy(model)
+
+    with torch.no_grad():
+        n_removed = _fold_module(model)
+        if isinstance(getattr(model, 'backbone', None), nn.Module) and hasattr(model.backbone, 'backbone'):
+            _fuse_backbone(model.backbone)
+    print(f'Optimize for inference: {n_removed} modules are folded or removed.')
+
+    if verify:
+        print('Output difference: ', verify_equivalence(ref, model, **verify_kwargs))
+    return model
@@ -0,0 +1,133 @@
+"""
+Post-training static int8 quantization for CPU inference.
+The backbone and the convolution blocks of the decoders are quantized by torch.fx one by one,
+while the memory affinity (softmax), the ConvGRUs, the output projections
+and the guided filter stay in float.
+"""
+import copy
+import torch
+from torch import nn
+
+try:
+    from torch.ao.quantization import get_default_qconfig
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+except ImportError:
+    from torch.quantization import get_default_qconfig
+    from torch.quantization.quantize_fx import prepare_fx, convert_fx
+
+from .model import FastTrimapPropagationVideoMatting
+from .basic_block import ResBlock, GRUUpsamplingBlock
+from util.tensor_util import pad_divide_by
+
+def get_quantization_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ['x86', 'fbgemm', 'qnnpack']:
+        if engine in engines:
+            return engine
+    raise RuntimeError(f'No supported quantization engine in {engines}')
+
+def get_quantization_targets(model: FastTrimapPropagationVideoMatting):
+    """
+    return {name: (parent module, attribute name)} of the blocks to be quantized,
+    all of them take single-frame (4D) tensors
+    """
+    targets = {'backbone.backbone': (model.backbone, 'backbone')}
+    for prefix, decoder in [
+        ('seg_decoder', model.seg_decoder),
+        ('mat_decoder', model.mat_decoder),
+        ('bottleneck_fuse', model.bottleneck_fuse),
+    ]:
+        for name, m in decoder.named_modules():
+            for child_name, child in m.named_children():
+                full_name = '.'.join(filter(None, [prefix, name, child_name]))
+                if isinstance(child, ResBlock) \
+                    or (isinstance(m, GRUUpsamplingBlock) and child_name == 'conv') \
+                    or child_name in ['gated_s16', 'gated_s4']:
+                    targets[full_name] = (m, child_name)
+    return targets
+
+def _prepare(module: nn.Module, qconfig, example_inputs):
+    # `example_inputs` is required since torch 1.13
+    try:
+        return prepare_fx(module, {'': qconfig}, example_inputs=example_inputs)
+    except TypeError:
+        return prepare_fx(module, {'': qconfig})
+
+def _prepare_frames(data):
+    rgb = pad_divide_by(data['rgb'], 16)[0] # 1, t, 3, h, w
+    trimap = pad_divide_by(data['trimap'], 16)[0]
+    return rgb, trimap
+
+@torch.no_grad()
+def run_calibration(model: FastTrimapPropagationVideoMatting, batches, downsample_ratio=1.):
+    """ Stream the clips like inference, the first frame & trimap of each video is the memory """
+    name = None
+    for data in batches:
+        rgb, trimap = _prepare_frames(data)
+        if (vid := data['info']['name'][0]) != name:
+            name = vid
+            memory = model.encode_imgs_to_value(rgb[:, [0]], trimap[:, [0]], downsample_ratio=downsample_ratio)
+            rec = model.default_rec
+        rec = model.forward_with_memory(rgb, *memory, *rec, downsample_ratio=downsample_ratio)[-1]
+
+@torch.no_grad()
+def quantize_model(model: FastTrimapPropagationVideoMatting, loader, num_items=32, downsample_ratio=1., engine=None):
+    """
+    `loader`: DataLoader of `VM108ValidationDataset` / `ValidationDataset` with batch size 1\n
+    `num_items`: number of loaded items (chunks of frames) for calibration\n
+    return the int8 model on CPU, names of the quantized blocks
+    """
+    engine = get_quantization_engine() if engine is None else engine
+    torch.backends.quantized.engine = engine
+    qconfig = get_default_qconfig(engine)
+    model = copy.deepcopy(model).cpu().float().eval()
+
+    batches = []
+    for i, data in enumerate(loader):
+        if i >= num_items:
+            break
+        batches.append(data)
+
+    # Capture the example inputs of each block
+    targets = get_quantization_targets(model)
+    example_inputs = {}
+    def capture(name):
+        def hook(module, inputs):
+            example_inputs.setdefault(name, inputs)
+        return hook
+    hooks = [
+        getattr(parent, attr).register_forward_pre_hook(capture(name))
+        for name, (parent, attr) in targets.items()
+    ]
+    run_calibration(model, batches[:1], downsample_ratio)
+    for h in hooks:
+        h.remove()
+
+    prepared = []
+    for name, (parent, attr) in targets.items():
+        if name not in example_inputs:
+            continue
+        try:
+            setattr(parent, attr, _prepare(getattr(parent, attr), qconfig, example_inputs[name]))
+            prepared.append(name)
+        except Exception as e:
+            print(f'Keep {name} in float: ', repr(e))
+
+    print(f'Calibrate {len(prepared)} blocks with {len(batches)} items, engine: {engine}')
+    run_calibration(model, batches, downsample_ratio)
+
+    for name in prepared:
+        parent, attr = targets[name]
+        setattr(parent, attr, convert_fx(getattr(parent, attr)))
+    return model, prepared
+
+def save_quantized(model: nn.Module, path):
+    # fx GraphModules are saved as the whole module
+    torch.save(model, path)
+
+def load_quantized(path):
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        # `weights_only` is unavailable before torch 1.13
+        return torch.load(path, map_location='cpu')
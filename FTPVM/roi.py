@@ -0,0 +1,173 @@
+"""
+Subject-tracking ROI inference.
+The model runs on a crop around the subject of the previous frame (its alpha & transition pixels),
+which gets a higher effective resolution for the same working size,
+and the results are pasted back into the full frame.
+"""
+import math
+import torch
+from torch import Tensor
+from torch.nn import functional as F
+
+from .model import FastTrimapPropagationVideoMatting
+from .util import get_tran_fg_mask_from_logits, is_fast_path
+from util.tensor_util import pad_divide_by, unpad
+
+class ROIInference:
+    """
+    `target_size`: the larger side of the working size of each crop, as `auto_downsample_ratio`\n
+    `margin`: padding of the subject box w.r.t. its larger side, at least `min_margin` pixels\n
+    `full_frame_area`: fall back to the full frame if the box covers more than this fraction of it\n
+    `alpha_threshold`: alpha of the subject pixels
+    """
+    def __init__(self,
+        model: FastTrimapPropagationVideoMatting, frame_size,
+        target_size=1024, margin=0.25, min_margin=32, full_frame_area=0.6, alpha_threshold=0.05,
+    ):
+        self.model = model
+        self.h, self.w = frame_size
+        self.target_size = target_size
+        self.margin = margin
+        self.min_margin = min_margin
+        self.full_frame_area = full_frame_area
+        self.alpha_threshold = alpha_threshold
+
+        self.box = None # (y0, x0, y1, x1), None for the full frame
+        self.geometry = None
+        self.rec = model.default_rec
+        self.stats = {'roi': 0, 'full': 0, 'moves': 0, 'lost': 0, 'fast': 0}
+
+    def reset(self):
+        self.box = None
+        self.geometry = None
+        self.rec = self.model.default_rec
+
+    def __call__(self, src: Tensor, m_feat16: Tensor, m_value: Tensor, **kwargs):
+        """
+        `src`: full frames (b, t, 3, h, w), `kwargs` are passed to `forward_with_memory`\n
+        return full-frame trimap logits, boundary mattes & full mattes as `forward_with_memory`
+        """
+        y0, x0, y1, x1 = (0, 0, self.h, self.w) if self.box is None else self.box
+        crop, pad = pad_divide_by(src[..., y0:y1, x0:x1], 16)
+        # the padded crop covers a region out of the frame
+        region = (y0-pad[2], x0-pad[0], y1+pad[3], x1+pad[1])
+        ratio = min(self.target_size / max(region[2]-region[0], region[3]-region[1]), 1)
+        geometry = self.working_geometry(region, ratio)
+        if self.geometry is not None and geometry != self.geometry:
+            self.rec = self.warp_rec(self.rec, self.geometry, geometry)
+            self.stats['moves'] += 1
+        self.geometry = geometry
+
+        seg, mat, pha, self.rec = self.model.forward_with_memory(
+            crop, m_feat16, m_value, *self.rec, downsample_ratio=ratio, **kwargs)
+        self.stats['full' if self.box is None else 'roi'] += src.size(1)
+        if is_fast_path(seg, kwargs.get('tran_threshold')):
+            self.stats['fast'] += src.size(1)
+
+        # the trimaps & boundary mattes are at the working resolution, the full mattes at the crop resolution
+        seg, mat = [self.to_crop(x, geometry, crop.shape[-2:]) for x in [seg, mat]]
+        seg, mat, pha = [unpad(x, pad) for x in [seg, mat, pha]]
+        seg = self.paste(seg, (y0, x0, y1, x1), fill=[10., -10., -10.]) # background
+        mat = self.paste(mat, (y0, x0, y1, x1))
+        pha = self.paste(pha, (y0, x0, y1, x1))
+        self.box = self.next_box(seg[:, -1], pha[:, -1])
+        return seg, mat, pha
+
+    @staticmethod
+    def to_crop(x: Tensor, geometry, size):
+        """ resize the output `x` of the working tensor `geometry` (or its stride) to the padded crop `size`, without the working padding """
+        if x is None or tuple(x.shape[-2:]) == tuple(size):
+            return x
+        slices = []
+        for (_, length, scaled, padded, lo), n in zip(geometry, x.shape[-2:]):
+            k = n / padded
+            slices.append(slice(round(lo*k), round((lo+scaled)*k)))
+        x = x[..., slices[0], slices[1]]
+        return F.interpolate(x.flatten(0, 1), size=tuple(size), mode='bilinear', align_corners=False).unflatten(0, x.shape[:2])
+
+    def paste(self, x: Tensor, box, fill=None):
+        if self.box is None:
+            return x
+        out = x.new_zeros((*x.shape[:-2], self.h, self.w))
+        if fill is not None:
+            out[:] = torch.tensor(fill, device=x.device, dtype=x.dtype).view(-1, 1, 1)
+        y0, x0, y1, x1 = box
+        out[..., y0:y1, x0:x1] = x
+        return out
+
+    def next_box(self, seg: Tensor, pha: Tensor):
+        """ padded box of the subject in the last frame, aligned to the 16-pixel grid """
+        tran_mask, _ = get_tran_fg_mask_from_logits(seg.unsqueeze(1))
+        mask = ((pha > self.alpha_threshold) | tran_mask[:, 0]).flatten(0, 1).any(0) # h, w
+        rows = torch.nonzero(mask.any(1)).flatten()
+        cols = torch.nonzero(mask.any(0)).flatten()
+        if rows.numel() == 0:
+            # subject lost
+            if self.box is not None:
+                self.stats['lost'] += 1
+            return None
+        y0, y1 = rows[0].item(), rows[-1].item()+1
+        x0, x1 = cols[0].item(), cols[-1].item()+1
+
+        # keep the current box if it still contains the subject and is not too large, so the RNN memory is not resampled
+        if self.box is not None:
+            by0, bx0, by1, bx1 = self.box
+            m = self.min_margin // 2
+            if by0 <= max(y0-m, 0) and bx0 <= max(x0-m, 0) and by1 >= min(y1+m, self.h) and bx1 >= min(x1+m, self.w) \
+                and (by1-by0)*(bx1-bx0) <= 2*(y1-y0+2*self.min_margin)*(x1-x0+2*self.min_margin):
+                return self.box
+
+        m = max(self.min_margin, int(self.margin * max(y1-y0, x1-x0)))
+        y0 = max(y0-m, 0) // 16 * 16
+        x0 = max(x0-m, 0) // 16 * 16
+        y1 = min(math.ceil((y1+m)/16)*16, self.h)
+        x1 = min(math.ceil((x1+m)/16)*16, self.w)
+        if (y1-y0)*(x1-x0) > self.full_frame_area*self.h*self.w:
+            return None
+        return (y0, x0, y1, x1)
+
+    @staticmethod
+    def working_geometry(region, ratio):
+        """
+        (origin, length, scaled length, padded length, low padding) of each dim (y, x),
+        which maps the frame pixels to the working tensor, see `FastTrimapPropagationVideoMatting._interpolate`
+        & `working_size`, the frames are not padded at ratio 1
+        """
+        geometry = []
+        for o, length in [(region[0], region[2]-region[0]), (region[1], region[3]-region[1])]:
+            scaled = int(length*ratio) if ratio != 1 else length
+            padded = math.ceil(scaled/16)*16 if ratio != 1 else length
+            geometry.append((o, length, scaled, padded, (padded-scaled)//2))
+        return tuple(geometry)
+
+    def warp_rec(self, rec, old, new):
+        """ Resample the RNN memories from the old working tensor to the new one, uncovered areas are zeros """
+        return resample_rec(rec, old, new, self.model.rec_strides)
+
+def resample_rec(rec, old, new, rec_strides):
+    """
+    Resample the RNN memories `rec` from the `old` working tensor to the `new` one (see `ROIInference.working_geometry`),
+    uncovered areas are zeros
+    """
+    theta = []
+    for (o0, l0, s0, p0, lo0), (o1, l1, s1, p1, lo1) in zip(old, new):
+        # new normalized coord. -> new working pixel -> frame pixel -> old working pixel -> old normalized coord.
+        k1, k0 = l1/s1, s0/l0
+        theta.append((
+            p1*k1*k0/p0,
+            2/p0*(lo0 + (o1 + (p1/2-lo1)*k1 - o0)*k0) - 1,
+        ))
+    (ay, by), (ax, bx) = theta
+
+    def warp(r: Tensor, stride):
+        if r is None:
+            return None
+        t = torch.tensor([[ax, 0., bx], [0., ay, by]], device=r.device, dtype=r.dtype)
+        size = (r.size(0), r.size(1), math.ceil(new[0][3]/stride), math.ceil(new[1][3]/stride))
+        grid = F.affine_grid(t.expand(r.size(0), 2, 3), size, align_corners=False)
+        return F.grid_sample(r, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+    return [
+        [warp(r, s) for r, s in zip(recs, strides)]
+        for recs, strides in zip(rec, rec_strides)
+    ]
@@ -0,0 +1,194 @@
+"""
+Shared matting engine of many concurrent streaming sessions.
+Each session holds its own memory bank, RNN memories & downsample ratio,
+the scheduler gathers the pending frames of the active sessions within a small latency window
+and runs them through `forward_with_memory` as batches.
+"""
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+import torch
+
+from .memory_bank import MemoryBank
+from .util import autocast_context
+
+class Session:
+    """ state of a stream, only touched by the engine """
+    def __init__(self, downsample_ratio=1., memory_bank_size=5):
+        self.id = uuid.uuid4().hex
+        self.downsample_ratio = downsample_ratio
+        self.memory_bank = MemoryBank(memory_bank_size)
+        self.rec = None # [[r8, r16], [r1, r2]] of batch 1, zeros if None
+        self.frame_size = None
+        self.frames = 0
+        self.last_active = time.time()
+
+    def reset(self):
+        self.rec = None
+
+class MattingEngine:
+    """
+    `max_batch`: max. frames (of different sessions) in a batch\n
+    `window_ms`: time to wait for more frames after the first pending frame\n
+    `session_timeout`: seconds of inactivity before a session is dropped, 0 to keep
+    """
+    def __init__(self,
+        model, device, dtype=torch.float32, autocast_dtype=None,
+        max_batch=8, window_ms=5., session_timeout=300.,
+    ):
+        self.model = model.eval()
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.autocast_dtype = autocast_dtype
+        self.max_batch = max_batch
+        self.window = window_ms / 1000
+        self.session_timeout = session_timeout
+
+        self.sessions = {}
+        self.sessions_lock = threading.Lock() # the handler threads & the scheduler add / drop sessions
+        self.requests = queue.Queue()
+        self.pending = [] # deferred requests, before the queued ones
+        self.lock = threading.Lock() # model calls
+        self.stats = {'frames': 0, 'batches': 0, 'max_batch': 0}
+        self.running = True
+        self.thread = threading.Thread(target=self.schedule, daemon=True)
+        self.thread.start()
+
+    # ===== sessions =====
+    def create_session(self, downsample_ratio=1., memory_bank_size=5):
+        session = Session(downsample_ratio, memory_bank_size)
+        with self.sessions_lock:
+            self.sessions[session.id] = session
+        return session.id
+
+    def close_session(self, sid):
+        with self.sessions_lock:
+            return self.sessions.pop(sid, None) is not None
+
+    def get_session(self, sid):
+        with self.sessions_lock:
+            session = self.sessions[sid]
+        session.last_active = time.time()
+        return session
+
+    def drop_inactive(self):
+        if self.session_timeout <= 0:
+            return
+        now = time.time()
+        with self.sessions_lock:
+            for sid in [sid for sid, s in self.sessions.items() if now-s.last_active > self.session_timeout]:
+                self.sessions.pop(sid, None)
+
+    def to_device(self, x):
+        return x.to(self.device, self.dtype, non_blocking=True)
+
+    @torch.no_grad()
+    def add_memory(self, sid, img, mask):
+        """ encode the memory frame `img` (3, h, w) & its trimap `mask` (1, h, w) in [0, 1] into the session """
+        session = self.get_session(sid)
+        img, mask = self.to_device(img[None, None]), self.to_device(mask[None, None])
+        with self.lock, autocast_context(self.device.type, self.autocast_dtype):
+            key, value = self.model.encode_imgs_to_value(img, mask, downsample_ratio=session.downsample_ratio)
+            session.memory_bank.add_memory(key, value)
+
+    def submit(self, sid, img):
+        """ queue the frame `img` (3, h, w) in [0, 1] of the session, return a `Future` of its alpha (1, h, w) """
+        session = self.get_session(sid)
+        if session.memory_bank.get_memory() is None:
+            raise ValueError('The session has no memory frame')
+        future = Future()
+        self.requests.put((session, img, future))
+        return future
+
+    def close(self):
+        self.running = False
+        self.requests.put(None)
+        self.thread.join()
+
+    # ===== scheduler =====
+    def gather(self):
+        """ the pending frames within the latency window, at most 1 frame per session """
+        pending, self.pending = self.pending, []
+        batch, sessions = [], set()
+        def take(item):
+            if id(item[0]) in sessions or len(batch) >= self.max_batch:
+                # frames of a session depend on its previous frame, keep the order for the next batch
+                self.pending.append(item)
+            else:
+                batch.append(item)
+                sessions.add(id(item[0]))
+
+        for item in pending:
+            take(item)
+        if len(batch) == 0:
+            item = self.requests.get()
+            if item is None:
+                return batch
+            take(item)
+        deadline = time.time() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                item = self.requests.get(timeout=max(deadline-time.time(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                break
+            take(item)
+        return batch
+
+    def schedule(self):
+        while self.running:
+            batch = self.gather()
+            with self.lock, autocast_context(self.device.type, self.autocast_dtype):
+                # group the frames which can be stacked: frame size, downsample ratio & memory size
+                groups = {}
+                for item in batch:
+                    session, img, _ = item
+                    mk, mv = session.memory_bank.get_memory()
+                    key = (tuple(img.shape), session.downsample_ratio, tuple(mk.shape), tuple(mv.shape))
+                    groups.setdefault(key, []).append(item)
+                for items in groups.values():
+                    try:
+                        self.run_batch(items)
+                    except Exception as e:
+                        for _, _, future in items:
+                            if not future.done():
+                                future.set_exception(e)
+            self.drop_inactive()
+
+    @torch.no_grad()
+    def run_batch(self, items):
+        """ run the frames of different sessions as a batch, under `lock` """
+        sessions = [s for s, _, _ in items]
+        ratio = sessions[0].downsample_ratio
+        qimgs = self.to_device(torch.stack([img for _, img, _ in items])[:, None]) # b, 1, 3, h, w
+        h, w = self.model.working_size(*qimgs.shape[-2:], ratio)
+        memory = [s.memory_bank.get_memory() for s in sessions]
+        m_feat16 = torch.cat([m[0] for m in memory], 0)
+        m_value = torch.cat([m[1] for m in memory], 0)
+
+        # new sessions start from zeros, so all the RNN memories can be stacked
+        recs = []
+        for s in sessions:
+            if s.rec is None or s.frame_size != tuple(qimgs.shape[-2:]):
+                s.rec = self.model.zero_rec(1, h, w, device=self.device, dtype=qimgs.dtype)
+                s.frame_size = tuple(qimgs.shape[-2:])
+            recs.append(s.rec)
+        rec = [
+            [torch.cat([r[i][j] for r in recs], 0) for j in range(len(recs[0][i]))]
+            for i in range(len(recs[0]))
+        ]
+
+        _, _, pha, rec = self.model.forward_with_memory(qimgs, m_feat16, m_value, *rec, downsample_ratio=ratio)
+        pha = pha[:, 0].clamp(0, 1).float().cpu()
+
+        for b, (s, _, future) in enumerate(items):
+            s.rec = [[r[b:b+1] for r in recs_i] for recs_i in rec]
+            s.frames += 1
+            future.set_result(pha[b])
+        self.stats['frames'] += len(items)
+        self.stats['batches'] += 1
+        self.stats['max_batch'] = max(self.stats['max_batch'], len(items))
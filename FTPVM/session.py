@@ -0,0 +1,319 @@
+"""
+Streaming matting sessions & their persistent state.
+`MattingSession` pushes chunks of a stream through `forward_with_memory` with reusable output buffers,
+and `save_session` / `load_session` keep the encoded memory, the RNN memories & the downsample ratio,
+so a stream can be resumed in another process (or machine) without re-encoding the memory frames
+or re-warming the RNNs.
+"""
+import hashlib
+import warnings
+import torch
+from torch import nn
+from torch import Tensor
+
+from .memory_bank import MemoryBank
+from .util import is_fast_path
+
+SESSION_VERSION = 1
+
+def _weights_key(state):
+    # changes with any in-place update (version counter) or replaced tensor (data pointer) of the weights
+    return tuple((name, value.data_ptr(), value._version) if isinstance(value, torch.Tensor) else (name, repr(value))
+        for name, value in state.items())
+
+def model_hash(model: nn.Module):
+    """ hash of the weights, the state is only valid for the same weights (cached until they change) """
+    state = model.state_dict()
+    key = _weights_key(state)
+    cached = getattr(model, '_state_hash', None)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    h = hashlib.sha1()
+    for name, value in state.items():
+        h.update(name.encode())
+        if isinstance(value, torch.Tensor):
+            value = value.detach().cpu()
+            if value.is_floating_point():
+                value = value.float()
+            h.update(value.contiguous().numpy().tobytes())
+        else:
+            h.update(repr(value).encode())
+    digest = h.hexdigest()[:16]
+    try:
+        model._state_hash = (key, digest)
+    except AttributeError:
+        pass
+    return digest
+
+def _pack(x, half):
+    # clone, so the views of batched tensors don't save their whole storage
+    if x is None:
+        return None
+    if isinstance(x, (list, tuple)):
+        return [_pack(i, half) for i in x]
+    x = x.detach().to('cpu', memory_format=torch.contiguous_format).clone()
+    return x.half() if half and x.is_floating_point() else x
+
+def _unpack(x, device, dtype):
+    if x is None:
+        return None
+    if isinstance(x, (list, tuple)):
+        return [_unpack(i, device, dtype) for i in x]
+    return x.to(device, dtype if x.is_floating_point() else x.dtype)
+
+def save_session(path, model: nn.Module, memory_bank: MemoryBank, rec, downsample_ratio,
+    frame_size=None, frames=0, half=False):
+    """
+    `rec`: RNN memories [[r8, r16], [r1, r2]] (`None` entries are kept)\n
+    `frame_size`: (h, w) of the input frames, the RNN memories are only valid for the same working size\n
+    `half`: store the tensors in float16 to halve the file
+    """
+    torch.save({
+        'version': SESSION_VERSION,
+        'model_hash': model_hash(model),
+        'downsample_ratio': downsample_ratio,
+        'frame_size': None if frame_size is None else tuple(frame_size),
+        'frames': frames,
+        'memory': {
+            'top_k': memory_bank.top_k,
+            'mem_k': _pack(memory_bank.mem_k, half),
+            'mem_v': _pack(memory_bank.mem_v, half),
+            'temp_k': _pack(memory_bank.temp_k, half),
+            'temp_v': _pack(memory_bank.temp_v, half),
+        },
+        'rec': _pack(rec, half),
+    }, path)
+
+def load_session(path, model: nn.Module = None, device='cpu', dtype=torch.float32, strict=True):
+    """
+    return {'memory_bank', 'rec', 'downsample_ratio', 'frame_size', 'frames'} on `device` in `dtype`\n
+    `model`: check the state was saved with the same weights, raise `ValueError` if not `strict`, warn otherwise
+    """
+    state = torch.load(path, map_location='cpu')
+    if state.get('version') != SESSION_VERSION:
+        raise ValueError(f"Unsupported session version: {state.get('version')}")
+    if model is not None and state['model_hash'] != model_hash(model):
+        message = f"Session {path} was saved with different weights ({state['model_hash']} != {model_hash(model)})"
+        if strict:
+            raise ValueError(message)
+        warnings.warn(message)
+
+    memory = state['memory']
+    memory_bank = MemoryBank(memory['top_k'])
+    for k in ['mem_k', 'mem_v', 'temp_k', 'temp_v']:
+        setattr(memory_bank, k, _unpack(memory[k], device, dtype))
+    return {
+        'memory_bank': memory_bank,
+        'rec': _unpack(state['rec'], device, dtype),
+        'downsample_ratio': state['downsample_ratio'],
+        'frame_size': state['frame_size'],
+        'frames': state['frames'],
+    }
+
+def count_allocations(fn, device):
+    """
+    number of tensor allocations on `device` made by `fn()`,
+    the allocations of the CUDA caching allocator (cached blocks included) or the memory events of the profiler
+    """
+    device = torch.device(device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        before = torch.cuda.memory_stats(device).get('allocation.all.allocated', 0)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.memory_stats(device).get('allocation.all.allocated', 0) - before
+    from torch.profiler import profile
+    with profile(profile_memory=True) as prof:
+        fn()
+    return sum(1 for e in prof.events() if e.name == '[memory]' and e.cpu_memory_usage > 0)
+
+class MattingSession:
+    """
+    Streaming matting of 1 stream: `push` chunks of frames & get the outputs,
+    the memory bank & the RNN memories are kept inside.\n
+    The RNN memories & the outputs (trimap logits, mattes, trimaps & compositions) live in preallocated buffers
+    reused by every chunk of the same shape, the returned buffers are overwritten by the next `push` / `compose`, clone them to keep.
+    The eager forward still allocates its own results, which are copied into the buffers.
+    With `cuda_graph` (CUDA frames, no `tran_threshold`), the forward, the copies & the trimaps are captured once
+    in a CUDA graph over static input buffers and replayed, so the steady-state chunks allocate nothing (see `check_steady_state`),
+    the graph is recaptured when the shapes or the downsample ratio change.\n
+    `memory_bank`: an existing memory bank, a new one of `memory_bank_size` by default\n
+    `recurrent`: carry the RNN memories to the next chunk\n
+    `bgr`: background color of `compose` in [0, 255]\n
+    `outputs`: outputs of `push`, subset of {'trimap', 'alpha'}, `None` for all, see `decode` of the model\n
+    `cuda_graph`: replay the chunks by a CUDA graph, the chunks with `replace_seg` run eagerly\n
+    `forward_kwargs`: passed to `forward_with_memory`, e.g. `tran_threshold`,
+    the frames of the fast path & the matting decoder are counted in `mat_stats`
+    """
+    def __init__(self, model, downsample_ratio=1., memory_bank: MemoryBank = None, memory_bank_size=5,
+        recurrent=True, bgr=(120, 255, 155), outputs=None, cuda_graph=False, **forward_kwargs):
+        self.model = model
+        self.downsample_ratio = downsample_ratio
+        self.memory_bank = MemoryBank(memory_bank_size) if memory_bank is None else memory_bank
+        self.recurrent = recurrent
+        self.bgr = bgr
+        self.outputs = outputs
+        self.forward_kwargs = forward_kwargs
+        self.cuda_graph = cuda_graph
+        self.graph = None
+        self.graph_key = None
+        self.graph_out = None
+        self.buffers = {}
+        self.rec = model.default_rec
+        self.frames = 0
+        self.frame_size = None # (h, w) of the pushed frames, or of the loaded RNN memories
+        self.mat_stats = {'fast': 0, 'full': 0}
+        self.allocations = 0 # of the buffers
+
+    def buffer(self, name, like: Tensor, shape=None, dtype=None):
+        """ the preallocated tensor `name`, reallocated only if the shape, dtype or device changes """
+        shape = tuple(like.shape if shape is None else shape)
+        dtype = like.dtype if dtype is None else dtype
+        buf = self.buffers.get(name)
+        if buf is None or tuple(buf.shape) != shape or buf.dtype != dtype or buf.device != like.device:
+            buf = self.buffers[name] = torch.empty(shape, dtype=dtype, device=like.device)
+            self.allocations += 1
+        return buf
+
+    def add_memory(self, imgs, masks):
+        """ encode memory frames (b, t, 3, h, w) & their trimaps (b, t, 1, h, w) """
+        self.memory_bank.add_memory(*self.model.encode_imgs_to_value(imgs, masks, downsample_ratio=self.downsample_ratio))
+
+    def set_rec(self, rec):
+        """ copy the RNN memories [[r8, r16], [r1, r2]] into the buffers, `None` entries are kept """
+        self.rec = [
+            [None if r is None else self.buffer(f'rec_{i}_{j}', r).copy_(r) for j, r in enumerate(recs)]
+            for i, recs in enumerate(rec)
+        ]
+
+    def reset(self):
+        """ clear the RNN memories """
+        self.rec = self.model.default_rec
+
+    def push(self, frames: Tensor, replace_seg: Tensor = None):
+        """
+        `frames`: query frames (b, t, 3, h, w) on the model device\n
+        `replace_seg`: given trimap of the first frame, see `forward_with_memory`\n
+        return {'seg': trimap logits, 'mat': boundary mattes, 'pha': mattes, 'trimap': trimaps in {0, 0.5, 1}},
+        'mat' & 'pha' are `None` without 'alpha' in `outputs`, 'trimap' only with 'trimap'
+        """
+        memory = self.memory_bank.get_memory()
+        assert memory is not None, 'No memory frame, call `add_memory` first'
+        if self.cuda_graph and replace_seg is None:
+            out = self.replay(frames, memory)
+        else:
+            out = self.forward(frames, memory, replace_seg)
+        self.frames += frames.size(1)
+        self.frame_size = tuple(frames.shape[-2:])
+        tran_threshold = self.forward_kwargs.get('tran_threshold')
+        if tran_threshold is not None and out['mat'] is not None:
+            self.mat_stats['fast' if is_fast_path(out['seg'], tran_threshold) else 'full'] += frames.size(1)
+        return out
+
+    def forward(self, frames: Tensor, memory, replace_seg: Tensor = None):
+        """ eager forward, the results are copied into the buffers """
+        seg, mat, pha, rec = self.model.forward_with_memory(frames, *memory, *self.rec,
+            downsample_ratio=self.downsample_ratio, replace_seg=replace_seg, outputs=self.outputs, **self.forward_kwargs)
+        if self.recurrent:
+            self.set_rec(rec)
+        out = {k: None if v is None else self.buffer(k, v).copy_(v) for k, v in [('seg', seg), ('mat', mat), ('pha', pha)]}
+        if self.outputs is None or 'trimap' in self.outputs:
+            out['trimap'] = self.to_trimap(out['seg'])
+        return out
+
+    def replay(self, frames: Tensor, memory):
+        """ copy the inputs into the static buffers & replay the CUDA graph, captured first if the shapes changed """
+        assert frames.is_cuda, 'CUDA graphs need CUDA frames'
+        assert self.forward_kwargs.get('tran_threshold') is None, 'The fast path is data-dependent, not in CUDA graphs'
+        if any(r is None for recs in self.rec for r in recs):
+            # zeros instead of `None`, the graph reads fixed tensors
+            h, w = self.model.working_size(*frames.shape[-2:], self.downsample_ratio)
+            self.set_rec(self.model.zero_rec(frames.size(0), h, w, device=frames.device, dtype=frames.dtype))
+        frames = self.buffer('frames', frames).copy_(frames)
+        memory = [self.buffer(f'memory_{i}', m).copy_(m) for i, m in enumerate(memory)]
+        key = (
+            tuple(frames.shape), frames.dtype, self.downsample_ratio,
+            *(tuple(m.shape) for m in memory), *(tuple(r.shape) for recs in self.rec for r in recs),
+        )
+        if key != self.graph_key:
+            self.capture(frames, memory)
+            self.graph_key = key
+        self.graph.replay()
+        return self.graph_out
+
+    def capture(self, frames: Tensor, memory):
+        """ capture `forward` of the static buffers, the RNN memories are restored after the warm up """
+        rec = [[r.clone() for r in recs] for recs in self.rec]
+        stream = torch.cuda.Stream(frames.device)
+        stream.wait_stream(torch.cuda.current_stream(frames.device))
+        with torch.cuda.stream(stream):
+            # allocates the buffers & selects the kernels outside the graph
+            for _ in range(2):
+                self.forward(frames, memory)
+        torch.cuda.current_stream(frames.device).wait_stream(stream)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.graph_out = self.forward(frames, memory)
+        for recs, saved in zip(self.rec, rec):
+            for r, s in zip(recs, saved):
+                r.copy_(s)
+
+    def to_trimap(self, seg: Tensor):
+        """ trimap logits (b, t, 3, h, w) -> trimaps (b, t, 1, h, w) in {0, 0.5, 1} """
+        # (bg, tran, fg) -> (0, 0.5, 1), argmax of the probabilities as `seg_to_trimap` (saturated ties included)
+        shape = (*seg.shape[:2], 1, *seg.shape[3:])
+        prob = torch.sigmoid(seg, out=self.buffer('prob', seg))
+        index = torch.argmax(prob, dim=2, keepdim=True, out=self.buffer('index', seg, shape, torch.long))
+        return self.buffer('trimap', seg, shape).copy_(index).mul_(0.5)
+
+    def compose(self, frames: Tensor, pha: Tensor):
+        """ composition of `frames` (b, t, 3, h, w) on the background color by the mattes `pha` (b, t, 1, h, w) """
+        bgr = self.buffers.get('bgr')
+        if bgr is None or bgr.dtype != frames.dtype or bgr.device != frames.device:
+            bgr = self.buffers['bgr'] = torch.tensor(self.bgr, device=frames.device, dtype=frames.dtype).div(255).view(1, 1, 3, 1, 1)
+            self.allocations += 1
+        # frames * pha + bgr * (1 - pha)
+        fgr = torch.sub(frames, bgr, out=self.buffer('fgr', frames))
+        return fgr.mul_(pha).add_(bgr)
+
+    def save(self, path, frame_size=None, half=False):
+        """ `frame_size`: `self.frame_size` by default """
+        save_session(path, self.model, self.memory_bank, self.rec, self.downsample_ratio,
+            frame_size=self.frame_size if frame_size is None else frame_size, frames=self.frames, half=half)
+
+    @classmethod
+    def load(cls, path, model, device='cpu', dtype=torch.float32, strict=True, **kwargs):
+        state = load_session(path, model, device, dtype, strict)
+        session = cls(model, state['downsample_ratio'], memory_bank=state['memory_bank'], **kwargs)
+        if state['rec'] is not None:
+            session.set_rec(state['rec'])
+        session.frames = state['frames']
+        session.frame_size = state['frame_size']
+        return session
+
+def check_steady_state(session: MattingSession, frames: Tensor, warmup=2, iters=5):
+    """
+    Push `frames` repeatedly, return after `warmup` chunks\n
+    `buffers`: new buffers (should be 0)\n
+    `push`: device allocations per chunk of `push`, 0 with `cuda_graph`, the intermediate tensors of the eager forward otherwise\n
+    `post`: device allocations per chunk of the trimaps & compositions (should be 0)
+    """
+    out = {}
+    def push():
+        out.update(session.push(frames))
+    def post():
+        session.to_trimap(out['seg'])
+        session.compose(frames, out['pha'])
+    for _ in range(warmup):
+        push()
+        post()
+    buffers = session.allocations
+    push_allocations = post_allocations = 0
+    for _ in range(iters):
+        push_allocations += count_allocations(push, frames.device)
+        post_allocations += count_allocations(post, frames.device)
+    return {
+        'buffers': session.allocations - buffers,
+        'push': push_allocations / iters,
+        'post': post_allocations / iters,
+    }
@@ -0,0 +1,168 @@
+"""
+Temporal shortcuts of streaming inference, which decide the frames to be computed by the network
+and fill in the outputs of the others.
+"""
+import numpy as np
+import torch
+from torch import Tensor
+from torch.nn import functional as F
+
+class StaticFrameGate:
+    """
+    Reuse the outputs (and keep the RNN memories) of the last computed frame for near-identical frames.\n
+    `threshold`: mean abs. difference of the downsampled gray frames (in [0, 1]) below which a frame is static\n
+    `max_run`: compute a frame after at most `max_run` reused frames\n
+    `size`: larger side of the downsampled frames
+    """
+    def __init__(self, threshold=0.005, max_run=30, size=64):
+        self.threshold = threshold
+        self.max_run = max_run
+        self.size = size
+        self.ref = None # downsampled last computed frame
+        self.run = 0
+        self.last = None # outputs of the last computed frame
+        self.stats = {'computed': 0, 'reused': 0}
+
+    def thumbnail(self, x: Tensor):
+        # b, t, 3, h, w -> b*t, 1, h', w'
+        h, w = x.shape[-2:]
+        scale = self.size / max(h, w)
+        size = (max(round(h*scale), 1), max(round(w*scale), 1))
+        return F.adaptive_avg_pool2d(x.float().mean(2, keepdim=True).flatten(0, 1), size)
+
+    def select(self, src: Tensor):
+        """ return the indices of the frames in the chunk `src` (b, t, 3, h, w) to be computed """
+        b, t = src.shape[:2]
+        thumbs = self.thumbnail(src).unflatten(0, (b, t))
+        keep = []
+        for i in range(t):
+            if self.ref is not None and self.run < self.max_run \
+                and (thumbs[:, i]-self.ref).abs().mean().item() < self.threshold:
+                self.run += 1
+            else:
+                keep.append(i)
+                self.ref = thumbs[:, i]
+                self.run = 0
+        self.stats['computed'] += len(keep)
+        self.stats['reused'] += t-len(keep)
+        return keep
+
+    def assemble(self, keep, t, outputs=None):
+        """
+        `outputs`: outputs (b, len(`keep`), ...) of the computed frames, `None` if no frame is computed\n
+        return the outputs of all the `t` frames, the others are copied from the last computed frame
+        """
+        index, j = [], -1
+        for i in range(t):
+            if j+1 < len(keep) and keep[j+1] == i:
+                j += 1
+            index.append(j)
+
+        offset = 0 if self.last is None else 1
+        results = []
+        for k in range(len(outputs if outputs is not None else self.last)):
+            pool = ([] if self.last is None else [self.last[k]]) + ([] if outputs is None else [outputs[k]])
+            if pool[0] is None:
+                # not requested
+                results.append(None)
+                continue
+            pool = torch.cat(pool, dim=1)
+            results.append(pool[:, [offset+j for j in index]])
+        self.last = [None if r is None else r[:, -1:] for r in results]
+        return results
+
+class KeyframeInterpolator:
+    """
+    Run the network on every `interval`-th frame (and the last frame) only,
+    the alphas of the in-between frames are synthesized by warping the outputs of both neighbouring keyframes
+    with optical flow (Farneback on CPU at low resolution) and blended by the temporal distance.\n
+    The in-between frames are held until the next keyframe is computed, so the outputs are delayed.\n
+    `num_frames`: total frames of the video, to make the last frame a keyframe\n
+    `flow_size`: larger side of the frames for the optical flow
+    """
+    def __init__(self, interval, num_frames, flow_size=320):
+        assert interval >= 1
+        self.interval = interval
+        self.num_frames = num_frames
+        self.flow_size = flow_size
+        self.t = 0 # index of the first frame of the next chunk
+        self.pending = [] # (index, frame) of the in-between frames
+        self.prev = None # (index, frame, outputs) of the last keyframe
+        self.stats = {'key': 0, 'interpolated': 0}
+
+    def select(self, src: Tensor):
+        """ return the indices of the keyframes in the chunk `src` (b, t, 3, h, w) """
+        keep = [
+            i for i in range(src.size(1))
+            if (self.t+i) % self.interval == 0 or self.t+i == self.num_frames-1
+        ]
+        self.stats['key'] += len(keep)
+        return keep
+
+    def assemble(self, keep, src: Tensor, outputs=None):
+        """
+        `outputs`: outputs (b, len(`keep`), ...) of the keyframes, `None` if there is no keyframe\n
+        return the frames & their outputs ready in order (b, t', ...), (None, None) if all frames are held
+        """
+        ready_src, ready_out = [], []
+        k = 0
+        for i in range(src.size(1)):
+            idx, frame = self.t+i, src[:, i]
+            if k < len(keep) and keep[k] == i:
+                # kept until the next keyframe, the outputs may be reused buffers
+                out = [None if o is None else o[:, k].clone() for o in outputs]
+                k += 1
+                for p_idx, p_frame in self.pending:
+                    ready_src.append(p_frame)
+                    ready_out.append(self.interpolate(p_idx, p_frame, idx, frame, out))
+                self.stats['interpolated'] += len(self.pending)
+                self.pending = []
+                ready_src.append(frame)
+                ready_out.append(out)
+                self.prev = (idx, frame, out)
+            else:
+                self.pending.append((idx, frame))
+        self.t += src.size(1)
+
+        if len(ready_src) == 0:
+            return None, None
+        return torch.stack(ready_src, 1), [None if o[0] is None else torch.stack(o, 1) for o in zip(*ready_out)]
+
+    def interpolate(self, idx, frame: Tensor, next_idx, next_frame: Tensor, next_out):
+        prev_idx, prev_frame, prev_out = self.prev
+        w = (idx-prev_idx) / (next_idx-prev_idx)
+        flow_prev = self.flow(frame, prev_frame)
+        flow_next = self.flow(frame, next_frame)
+        return [
+            None if p is None else (1-w)*self.warp(p, flow_prev) + w*self.warp(n, flow_next)
+            for p, n in zip(prev_out, next_out)
+        ]
+
+    def flow(self, src: Tensor, dst: Tensor):
+        """ low-res flow (b, 2, h', w') in pixels, `dst`(x + flow(x)) ~ `src`(x) """
+        import cv2 # only for the keyframes, keeps the import of the module light
+        h, w = src.shape[-2:]
+        scale = min(self.flow_size / max(h, w), 1)
+        size = (max(round(h*scale), 1), max(round(w*scale), 1))
+        def gray(x):
+            x = F.interpolate(x.float().mean(1, keepdim=True), size=size, mode='area')
+            return (x[:, 0].clamp(0, 1)*255).byte().cpu().numpy()
+        src, dst = gray(src), gray(dst)
+        flows = [
+            cv2.calcOpticalFlowFarneback(s, d, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+            for s, d in zip(src, dst)
+        ]
+        return torch.from_numpy(np.stack(flows)).permute(0, 3, 1, 2)
+
+    @staticmethod
+    def warp(x: Tensor, flow: Tensor):
+        """ backward warp `x` (b, c, h, w) by the low-res `flow` """
+        b, c, h, w = x.shape
+        fh, fw = flow.shape[-2:]
+        flow = F.interpolate(flow.to(x.device, torch.float32), size=(h, w), mode='bilinear', align_corners=False)
+        gy, gx = torch.meshgrid(
+            (torch.arange(h, device=x.device, dtype=torch.float32)*2+1) / h - 1,
+            (torch.arange(w, device=x.device, dtype=torch.float32)*2+1) / w - 1,
+        )
+        grid = torch.stack([gx + flow[:, 0]*2/fw, gy + flow[:, 1]*2/fh], dim=-1)
+        return F.grid_sample(x.float(), grid, mode='bilinear', padding_mode='border', align_corners=False).to(x.dtype)
@@ -1,11 +1,44 @@
 import torch
+from contextlib import nullcontext
+from typing import Optional
+
+def autocast_context(device_type: str, dtype: Optional[torch.dtype] = None):
+    """ autocast to `dtype` (e.g. bfloat16 on CPU), nothing if `dtype` is None """
+    if dtype is None:
+        return nullcontext()
+    return torch.autocast(device_type, dtype=dtype)
+
+def float32_region(device_type: str):
+    """ Disable autocast, the precision-sensitive ops inside run in float32 after `.float()` """
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type, enabled=False)
+    return nullcontext()
+
+def is_autocast(device_type: str):
+    """ whether autocast is enabled for `device_type` """
+    try:
+        return torch.is_autocast_enabled(device_type)
+    except TypeError: # before torch 2.4
+        return torch.is_autocast_cpu_enabled() if device_type == 'cpu' else torch.is_autocast_enabled()
+
+def region_dtype(x: torch.Tensor):
+    """ dtype of the results of a `float32_region` on `x`: float32 under autocast, the dtype of `x` otherwise """
+    return torch.float32 if is_autocast(x.device.type) else x.dtype
+
+def to_channels_last(x: torch.Tensor):
+    """ channels-last memory format for frames (b, c, h, w) or (b, t, c, h, w) """
+    if x.ndim == 5:
+        return x.flatten(0, 1).contiguous(memory_format=torch.channels_last).unflatten(0, x.shape[:2])
+    return x.contiguous(memory_format=torch.channels_last)
 
 def collaborate_fuse(out_glance, out_focus):
-    val, idx = torch.sigmoid(out_glance).max(dim=2, keepdim=True) # ch
-    # (bg, t, fg)
-    tran_mask = idx.clone() == 1
-    fg_mask = idx.clone() == 2
-    return out_focus*tran_mask + fg_mask
+    dtype = region_dtype(out_focus)
+    with float32_region(out_focus.device.type):
+        val, idx = torch.sigmoid(out_glance.float()).max(dim=2, keepdim=True) # ch
+        # (bg, t, fg)
+        tran_mask = idx.clone() == 1
+        fg_mask = idx.clone() == 2
+        return (out_focus.float()*tran_mask + fg_mask).to(dtype)
 
 def get_tran_fg_mask_from_logits(logits):
     val, idx = torch.sigmoid(logits).max(dim=2, keepdim=True) # ch
@@ -14,6 +47,20 @@ def get_tran_fg_mask_from_logits(logits):
     fg_mask = idx.clone() == 2
     return tran_mask, fg_mask
 
+def transition_fraction(logits):
+    """ fraction of the transition pixels of each frame (b, t) """
+    tran_mask, _ = get_tran_fg_mask_from_logits(logits)
+    return tran_mask.float().mean((2, 3, 4))
+
+def is_fast_path(logits, tran_threshold):
+    """ whether `decode` skips the matting decoder for the trimap logits (b, t, 3, h, w) of a chunk """
+    return tran_threshold is not None and transition_fraction(logits).max() < tran_threshold
+
+def seg_to_soft_alpha(logits):
+    """ cheap mattes from the trimap logits, p(fg) / (p(fg) + p(bg)) """
+    prob = torch.sigmoid(logits.float())
+    return prob[:, :, [2]] / (prob[:, :, [0]] + prob[:, :, [2]] + 1e-5)
+
 def get_tran_fg_mask_from_trimap(trimap):
     fg_mask = trimap > (1-1e-5)
     tran_mask = (~fg_mask) & (trimap > 1e-5) # ~fg & ~bg
@@ -1,3 +1,4 @@
+import os
 import cv2
 cv2.setNumThreads(0)
 import numpy as np
@@ -27,6 +28,44 @@ def get_dilated_trimaps(phas, kernel_size, eps=5e-3, random_kernel=False):
         trimaps.append(trimap)
     return torch.from_numpy(np.stack(trimaps)).unsqueeze(1) # T, 1, H, W
 
+class TrimapCache:
+    """
+    Generated trimaps (`get_dilated_trimaps`) stored in `root`/`dataset`/`clip`/`size`_w`width`/`frame`.png
+    as {0, 1, 2} (trimap*2, lossless), computed on the first use & read back afterwards.\n
+    `size`: (h, w) of the GT the trimaps are made from, `None` for the original size
+    """
+    def __init__(self, root, dataset, trimap_width, size=None):
+        size = 'full' if size is None or size[0] <= 0 else f'{size[0]}x{size[1]}'
+        self.root = os.path.join(root, dataset)
+        self.key = f'{size}_w{trimap_width}'
+        self.trimap_width = trimap_width
+
+    def path(self, clip, frame):
+        frame = os.path.splitext(os.path.basename(frame))[0]
+        return os.path.join(self.root, clip, self.key, frame+'.png')
+
+    def load(self, clip, frames, gts=None):
+        """ trimaps (T, 1, H, W) of `frames` of `clip`, made from `gts` (T, 1, H, W) (or a function returning them) if not cached """
+        paths = [self.path(clip, f) for f in frames]
+        if all(os.path.isfile(p) for p in paths):
+            trimaps = [cv2.imread(p, cv2.IMREAD_GRAYSCALE) for p in paths]
+            if all(t is not None for t in trimaps):
+                return torch.from_numpy(np.stack(trimaps)).unsqueeze(1).float().div_(2)
+        if callable(gts):
+            gts = gts()
+        trimaps = get_dilated_trimaps(gts, self.trimap_width)
+        self.save(paths, trimaps)
+        return trimaps
+
+    @staticmethod
+    def save(paths, trimaps):
+        os.makedirs(os.path.dirname(paths[0]), exist_ok=True)
+        for p, t in zip(paths, (trimaps[:, 0]*2).round().byte().numpy()):
+            # atomic, other workers may read it
+            tmp = f'{p}.{os.getpid()}.tmp.png'
+            cv2.imwrite(tmp, t)
+            os.replace(tmp, p)
+
 def get_dilated_trimaps_np_uint8(pha, kernel_size):
     # H, W
     kernel = _get_kernel(kernel_size)
@@ -8,7 +8,7 @@ import numpy as np
 import json
 import itertools
 import random
-from dataset.util import get_dilated_trimaps
+from dataset.util import get_dilated_trimaps, TrimapCache
 
 class VM108ValidationDataset(Dataset):
     FG_FOLDER = 'FG_done'
@@ -16,13 +16,17 @@ class VM108ValidationDataset(Dataset):
     def __init__(self,
         root='../dataset_mat/VideoMatting108', 
         size=512, frames_per_item=0, 
-        mode='train', is_subset=False, video_list_path=None, video_list=None, trimap_width=25
+        mode='train', is_subset=False, video_list_path=None, video_list=None, trimap_width=25,
+        trimap_cache=None,
     ):
+        """ `trimap_cache`: directory to store the generated trimaps, see `TrimapCache` """
         assert mode in ['train', 'val']
         self.trimap_width = trimap_width
         self.root = root
         self.mode = mode
         self.size = (size, size) if type(size) == int else size
+        self.trimap_cache = None if trimap_cache is None \
+            else TrimapCache(trimap_cache, os.path.basename(os.path.normpath(root)), trimap_width, self.size)
         self.frames_per_item = frames_per_item
         self.is_subset = is_subset
         assert video_list is None or video_list_path is None, 'only one of them should be given'
@@ -110,6 +114,20 @@ class VM108ValidationDataset(Dataset):
         bg = self.read_bg(self.frame_corr[name])
         return fg, gt, bg
 
+    def read_gts(self, frames):
+        return torch.stack([self.to_tensor(self.crop(self.read_fg_gt(name)[1])) for name in frames], 0)
+
+    def get_trimaps(self, video, frames, gts):
+        if self.trimap_cache is None:
+            return get_dilated_trimaps(gts, self.trimap_width)
+        return self.trimap_cache.load(video, frames, gts)
+
+    def cache_trimaps(self, idx):
+        """ fill the trimap cache of the item `idx` (only the GT is read), return the frames """
+        video, frames = self.idx_to_vid_and_chunk[idx]
+        self.trimap_cache.load(video, frames, lambda: self.read_gts(frames))
+        return len(frames)
+
     def __getitem__(self, idx):
         # video = self.videos[idx]
         video, frames = self.idx_to_vid_and_chunk[idx]
@@ -150,7 +168,7 @@ class VM108ValidationDataset(Dataset):
             'fg': fgs,
             'bg': bgs,
             'gt': gts,
-            'trimap': get_dilated_trimaps(gts, self.trimap_width),
+            'trimap': self.get_trimaps(video, frames, gts),
             'info': info
         }
         return data
@@ -163,12 +181,16 @@ class ValidationDataset(Dataset):
     """ Just read the imgs, can be used in any dataset """
     def __init__(self, 
         root='../dataset_mat/videomatte_motion_sd', 
-        size=-1, frames_per_item=0, trimap_width=25, get_bgr=False
+        size=-1, frames_per_item=0, trimap_width=25, get_bgr=False,
+        trimap_cache=None,
     ):
+        """ `trimap_cache`: directory to store the generated trimaps of the clips without `trimap_{width}`, see `TrimapCache` """
         super().__init__()
         self.trimap_width = trimap_width
         self.root = root
         self.size = (size, size) if type(size) == int else size
+        self.trimap_cache = None if trimap_cache is None \
+            else TrimapCache(trimap_cache, os.path.basename(os.path.normpath(root)), trimap_width, self.size)
         self.set_frames_per_item(frames_per_item)
         self.resize_mode = F.InterpolationMode.BILINEAR
         self.resize = self.size[0] > 0
@@ -267,7 +289,7 @@ class ValidationDataset(Dataset):
         data = {
             'rgb': rgbs,
             'gt': gts,
-            'trimap': get_dilated_trimaps(gts, self.trimap_width) if trimaps is None else trimaps,
+            'trimap': self.get_trimaps(video, frames, gts) if trimaps is None else trimaps,
             'info': info
         }
         if self.get_bgr:
@@ -281,6 +303,26 @@ class ValidationDataset(Dataset):
     def get_num_frames(self, video):
         return self.num_frames_of_video[video]
 
+    def read_gts(self, video, frames):
+        gts = torch.stack([F.to_tensor(Image.open(os.path.join(self.root, video, 'pha', name+".png")).copy().convert('L')) for name in frames])
+        if self.resize:
+            gts = F.resize(gts, self.size, interpolation=self.resize_mode)
+        return gts
+
+    def get_trimaps(self, video, frames, gts):
+        if self.trimap_cache is None:
+            return get_dilated_trimaps(gts, self.trimap_width)
+        return self.trimap_cache.load(video, frames, gts)
+
+    def cache_trimaps(self, idx):
+        """ fill the trimap cache of the item `idx` (only the GT is read), return the frames """
+        video, frames = self.idx_to_vid_and_chunk[idx]
+        if os.path.isdir(os.path.join(self.root, video, f'trimap_{self.trimap_width}')):
+            # given trimaps
+            return 0
+        self.trimap_cache.load(video, frames, lambda: self.read_gts(video, frames))
+        return len(frames)
+
 class ClipShuffleValidationDataset(ValidationDataset):
     """
     Shuffle the split clips in the video with given clip-length
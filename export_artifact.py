@@ -0,0 +1,25 @@
+"""
+Package a checkpoint into a model artifact (config & weights, memory-mappable), loaded offline by `FTPVM.artifact.load_artifact`
+or as the weights of `model.which_model.load_model`, e.g.
+python export_artifact.py --checkpoint saves/ftpvm.pth --out saves/ftpvm.pt
+"""
+import argparse
+import time
+from FTPVM.artifact import save_artifact, load_artifact
+from model.which_model import load_model
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='FTPVM')
+    parser.add_argument('--checkpoint', type=str, default=None, help='weights, default: the path of `inference_models`')
+    parser.add_argument('--out', type=str, required=True)
+    args = parser.parse_args()
+
+    model = load_model(args.model, 'cpu', args.checkpoint)
+    save_artifact(args.out, model, args.model)
+
+    t = time.perf_counter()
+    loaded = load_artifact(args.out)
+    print(f'Saved {args.out}, loaded in {(time.perf_counter()-t)*1000:.0f} ms')
+    for (k, v), (_, u) in zip(model.state_dict().items(), loaded.state_dict().items()):
+        assert (v == u).all(), k
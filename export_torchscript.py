@@ -0,0 +1,32 @@
+"""
+Export the streaming model to a frozen TorchScript file, e.g.
+python export_torchscript.py --checkpoint saves/ftpvm.pth --resolution 1920 1080 --downsample-ratio 0.5 --out saves/ftpvm_1080p.ts
+"""
+import argparse
+import torch
+from FTPVM.export import export_torchscript
+from model.which_model import load_model
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name', type=str, default='FTPVM')
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--out', type=str, required=True)
+    parser.add_argument('--resolution', help='w, h of the input frames', type=int, nargs=2, default=[1024, 576])
+    parser.add_argument('--seq-chunk', help='frames per forward', type=int, default=1)
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--downsample-ratio', type=float, default=1)
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--disable-check', help='skip the parity check against eager mode', action='store_true')
+    args = parser.parse_args()
+
+    model = load_model(args.model_name, args.device, args.checkpoint).eval()
+
+    w, h = args.resolution
+    qimgs = torch.rand((args.batch, args.seq_chunk, 3, h, w), device=args.device)
+    mimgs = torch.rand((args.batch, 1, 3, h, w), device=args.device)
+    masks = torch.rand((args.batch, 1, 1, h, w), device=args.device)
+    meta = export_torchscript(
+        model, args.out, qimgs, mimgs, masks,
+        downsample_ratio=args.downsample_ratio, check=not args.disable_check)
+    print(meta)
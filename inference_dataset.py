@@ -2,6 +2,7 @@
 Validate various model on VM108, VM240k and RealHuman Dataset
 """
 from argparse import ArgumentParser
+from util.device import add_device_args, setup_device
 
 parser = ArgumentParser()
 parser.add_argument('--size', help='eval video size: sd, 1024, hd, 4k', default='1024', type=str)
@@ -9,18 +10,22 @@ parser.add_argument('--batch_size', help='frames in a batch', default=8, type=in
 parser.add_argument('--n_workers', help='num workers', default=8, type=int)
 parser.add_argument('--gpu', default=0, type=int)
 parser.add_argument('--trimap_width', default=25, type=int)
+parser.add_argument('--trimap_cache', help='cache directory of the generated trimaps, see precompute_trimaps.py', default=None, type=str)
 parser.add_argument('--disable_video', help='Without savinig videos', action='store_true')
+parser.add_argument('--trace', help='Save per-chunk spans (load, transfer, encode, forward, readback, store) as <model>_trace.json (Chrome trace) & print their summary', action='store_true')
 parser.add_argument('--downsample_ratio', default=1, type=float)
 parser.add_argument('--out_root', default=".", type=str)
 parser.add_argument('--dataset_root', default="../dataset_mat", type=str)
 parser.add_argument('--disable_vm108', help='Without VM108', action='store_true')
 parser.add_argument('--disable_realhuman', help='Without RealHuman', action='store_true')
 parser.add_argument('--disable_vm240k', help='Without VM240k', action='store_true')
+add_device_args(parser)
 
 args = parser.parse_args()
 
 import os
 os.environ['CUDA_VISIBLE_DEVICES']=str(args.gpu)
+device = setup_device(args)
 
 from torch.utils.data import DataLoader
 
@@ -79,7 +84,8 @@ if not disable_vm108 and args.size != '4k':
     flg = True
     dataset = VM108ValidationDataset(
         root = os.path.join(args.dataset_root, 'VideoMatting108'),
-        size=size, frames_per_item=frames_per_item, mode='val', trimap_width=trimap_width
+        size=size, frames_per_item=frames_per_item, mode='val', trimap_width=trimap_width,
+        trimap_cache=args.trimap_cache,
     )
 
     # For pre-composed data
@@ -110,7 +116,8 @@ if not disable_vm240k:
     flg = True
     dataset = ValidationDataset(
         root=os.path.join(args.dataset_root, 'videomatte_motion_4k'),
-        frames_per_item=frames_per_item, trimap_width=trimap_width, size=size)
+        frames_per_item=frames_per_item, trimap_width=trimap_width, size=size,
+        trimap_cache=args.trimap_cache)
     
     # For pre-composed data
     # if args.size == '1024':
@@ -178,7 +185,7 @@ if not disable_realhuman and args.size != '4k':
 # =========================
 
 def get_dataloader(dataset):
-    loader = DataLoader(dataset, batch_size=1, num_workers=args.n_workers, shuffle=False, pin_memory=True)
+    loader = DataLoader(dataset, batch_size=1, num_workers=args.n_workers, shuffle=False, pin_memory=(device.type == 'cuda'))
     return loader
 
 gt_name = 'GT'
@@ -199,5 +206,7 @@ for root, dataset_name, dataset in dataset_list:
             model_name=model_name, model_func=model_func, model_path=model_path, 
             inference_core_func=inference_core,
             dataset_name=dataset_name, dataset=dataset, dataloader=loader, gt_name=gt_name,
-            downsample_ratio=downsample_ratio, save_video=not args.disable_video
+            downsample_ratio=downsample_ratio, save_video=not args.disable_video,
+            device=device,
+            trace_path=os.path.join(root, model_name+'_trace.json') if args.trace else None,
             )
@@ -3,6 +3,7 @@ Validate various model on VM108 Dataset
 with various memory update period
 """
 from argparse import ArgumentParser
+from util.device import add_device_args, setup_device
 
 parser = ArgumentParser()
 parser.add_argument('--size', help='eval video size: sd, 1024', default='1024', type=str)
@@ -16,10 +17,12 @@ parser.add_argument('--replace_tri', help='Replace the output seg by mem trimap'
 parser.add_argument('--trimap_width', default=25, type=int)
 parser.add_argument('--memory_freq', help='update memory in n frames, 1 for every frames', nargs='+', type=int,
     default=[30, 60, 120, 240, 480, 1])
+add_device_args(parser)
 args = parser.parse_args()
 
 import os
 os.environ['CUDA_VISIBLE_DEVICES']=str(args.gpu)
+device = setup_device(args)
 
 from torch.utils.data import DataLoader
 from fastai.data.load import DataLoader as FAIDataLoader
@@ -80,7 +83,7 @@ dataset_list.append((root, dataset_name, dataset))
 print([d[1] for d in dataset_list])
 
 def get_dataloader(dataset):
-    loader = DataLoader(dataset, batch_size=1, num_workers=8, shuffle=False, pin_memory=True)
+    loader = DataLoader(dataset, batch_size=1, num_workers=8, shuffle=False, pin_memory=(device.type == 'cuda'))
     return loader
 
 gt_name = 'GT'
@@ -107,4 +110,5 @@ for mem_freq in memory_freqs:
                 model_name=model_name_freq, model_func=model_func, model_path=model_path,
                 inference_core_func=inference_core,
                 dataset_name=dataset_name, dataset=dataset, dataloader=loader, 
-                memory_freq=mem_freq, memory_gt=True, gt_name=gt_name, save_video=not args.disable_video, replace_by_given_tri=args.replace_tri)
\ No newline at end of file
+                memory_freq=mem_freq, memory_gt=True, gt_name=gt_name, save_video=not args.disable_video, replace_by_given_tri=args.replace_tri,
+                device=device)
\ No newline at end of file
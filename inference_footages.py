@@ -1,32 +1,21 @@
+"""
+Lean entry point of the video conversion, only the model & the conversion are imported:
+not `inference_model_list` (evaluation cores, metrics & plots), the optional features of `convert_video` are imported when used.
+Check the import time by `python startup_time.py`
+"""
 from argparse import ArgumentParser
-from inference_model_list import inference_model_list
 from inference_footages_util import convert_video
-from model.which_model import get_model_by_string
-import torch
+from model.which_model import load_model as load_model_by_id
+from util.device import add_device_args, setup_device
 import os
 
 
-if __name__ == '__main__':
-
-    parser = ArgumentParser()
-    parser.add_argument('--root', help='input video root', required=True, type=str)
-    parser.add_argument('--out_root', help='output video root', required=True, type=str)
-    parser.add_argument('--gpu', help='gpu id', default=0, type=int)
-    parser.add_argument('--target_size', help='downsample the video by ratio of the larger width to target_size, and upsampled back by FGF', default=1024, type=int)
-    parser.add_argument('--seq_chunk', help='the frames to process in a batch', default=4, type=int)
-
-    args = parser.parse_args()
-    os.environ['CUDA_VISIBLE_DEVICES']=str(args.gpu)
-
-    root = args.root
-    outroot = args.out_root
-    model_name = 'FTPVM'
-    os.makedirs(outroot, exist_ok=True)
-    model_attr = inference_model_list[model_name]
-    model = get_model_by_string(model_attr[1])().to(device='cuda')
-    model.load_state_dict(torch.load(model_attr[3]))
-
+def load_model(device, refiner_kwargs=None):
+    return load_model_by_id('FTPVM', device, refiner_kwargs=refiner_kwargs)
 
+def list_jobs(root, outroot):
+    """ return kwargs of `convert_video` for each video & memory trimap pair under `root` """
+    jobs = []
     files = os.listdir(root)
     for vid in files:
         name, ext = os.path.splitext(vid)
@@ -47,9 +36,7 @@ if __name__ == '__main__':
             # if not os.path.isfile(mem_mask):
             #     print('Memory mask not found, skip: ', mem_mask)
 
-
-            convert_video(
-                model,
+            jobs.append(dict(
                 input_source=os.path.join(root, vid),
                 memory_img=mem_img,
                 memory_mask=mem_mask,
@@ -58,7 +45,36 @@ if __name__ == '__main__':
                 output_alpha = os.path.join(outroot, output_name+"_pha.mp4"),
                 output_foreground = os.path.join(outroot, output_name+"_fgr.mp4"),
                 output_video_mbps=8,
-                seq_chunk=args.seq_chunk,
-                num_workers=0,
-                target_size=args.target_size,
-            )
\ No newline at end of file
+            ))
+    return jobs
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument('--root', help='input video root', required=True, type=str)
+    parser.add_argument('--out_root', help='output video root', required=True, type=str)
+    parser.add_argument('--gpu', help='gpu id', default=0, type=int)
+    parser.add_argument('--target_size', help='downsample the video by ratio of the larger width to target_size, and upsampled back by FGF', default=1024, type=int)
+    parser.add_argument('--seq_chunk', help='the frames to process in a batch', default=4, type=int)
+    parser.add_argument('--box_filter', help='box filter of the guided filter, integral: constant cost of any radius', default='conv', type=str, choices=['conv', 'integral'])
+    parser.add_argument('--refiner_radius', help='radius of the guided filter box', default=1, type=int)
+    add_device_args(parser)
+
+    args = parser.parse_args()
+    os.environ['CUDA_VISIBLE_DEVICES']=str(args.gpu)
+    device = setup_device(args)
+
+    root = args.root
+    outroot = args.out_root
+    os.makedirs(outroot, exist_ok=True)
+    model = load_model(device, refiner_kwargs={'box_filter': args.box_filter, 'radius': args.refiner_radius})
+
+    for job in list_jobs(root, outroot):
+        convert_video(
+            model,
+            **job,
+            seq_chunk=args.seq_chunk,
+            num_workers=0,
+            target_size=args.target_size,
+        )
@@ -0,0 +1,143 @@
+"""
+Multi-instance CPU throughput mode of inference_footages.py
+N model instances are pinned to disjoint sets of cores, each with its own intra-op threads,
+and pull the videos from a shared queue.
+`--instances 0` chooses N by a short calibration run of every candidate.
+"""
+import os
+import time
+import multiprocessing as mp
+from argparse import ArgumentParser
+
+import torch
+
+from util.device import physical_cores
+
+def split_cores(n_instances, cores=None):
+    """ split the usable cores into `n_instances` disjoint & contiguous sets """
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0))[:physical_cores()]
+    assert 0 < n_instances <= len(cores), f'{n_instances} instances on {len(cores)} cores'
+    size, remain = divmod(len(cores), n_instances)
+    sets, start = [], 0
+    for i in range(n_instances):
+        end = start + size + (i < remain)
+        sets.append(cores[start:end])
+        start = end
+    return sets
+
+def pin_instance(cores, threads=0):
+    """ pin the current process to `cores` with 1 inter-op thread """
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads if threads > 0 else len(cores))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+def instance_worker(rank, cores, threads, jobs, results, convert_kwargs):
+    pin_instance(cores, threads)
+    torch.set_grad_enabled(False)
+    from inference_footages import load_model
+    from inference_footages_util import convert_video
+    try:
+        model = load_model('cpu').eval()
+        while (job := jobs.get()) is not None:
+            t = time.time()
+            frames = convert_video(model, **job, **convert_kwargs, progress=False, device='cpu')
+            results.put((rank, job['input_source'], frames, time.time()-t))
+    finally:
+        # the launcher waits for 1 sentinel of each instance
+        results.put((rank, None, 0, 0))
+
+def calibration_worker(cores, threads, size, seq_chunk, iters, start, results):
+    pin_instance(cores, threads)
+    torch.set_grad_enabled(False)
+    from inference_footages import load_model
+    model = load_model('cpu').eval()
+    qimgs = torch.rand((1, seq_chunk, 3, *size))
+    memory = model.encode_imgs_to_value(qimgs[:, :1], torch.rand((1, 1, 1, *size)))
+    rec = model.forward_with_memory(qimgs, *memory)[-1] # warm up
+    start.wait()
+    t = time.time()
+    for _ in range(iters):
+        rec = model.forward_with_memory(qimgs, *memory, *rec)[-1]
+    results.put(iters * seq_chunk / (time.time()-t))
+
+def calibrate(candidates, threads, size, seq_chunk, iters):
+    """ return {N: aggregate FPS} of running N instances at the same time """
+    ctx = mp.get_context('spawn')
+    fps = {}
+    for n in candidates:
+        start = ctx.Barrier(n)
+        results = ctx.Queue()
+        procs = [
+            ctx.Process(target=calibration_worker, args=(cores, threads, size, seq_chunk, iters, start, results))
+            for cores in split_cores(n)
+        ]
+        for p in procs:
+            p.start()
+        fps[n] = sum(results.get() for _ in procs)
+        for p in procs:
+            p.join()
+        print(f'Calibration: {n} instances, {fps[n]:.2f} FPS')
+    return fps
+
+def run(jobs, n_instances, threads, convert_kwargs):
+    ctx = mp.get_context('spawn')
+    job_queue, results = ctx.Queue(), ctx.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    for _ in range(n_instances):
+        job_queue.put(None)
+
+    t = time.time()
+    procs = [
+        ctx.Process(target=instance_worker, args=(rank, cores, threads, job_queue, results, convert_kwargs))
+        for rank, cores in enumerate(split_cores(n_instances))
+    ]
+    for p in procs:
+        p.start()
+    total_frames, finished = 0, 0
+    while finished < n_instances:
+        rank, name, frames, dt = results.get()
+        if name is None:
+            finished += 1
+            continue
+        total_frames += frames
+        print(f'[instance {rank}] {name}: {frames} frames, {frames/dt:.2f} FPS')
+    for p in procs:
+        p.join()
+    t = time.time()-t
+    print(f'{len(jobs)} videos, {total_frames} frames in {t:.1f}s, aggregate FPS: {total_frames/t:.2f}')
+    return total_frames / t
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--root', help='input video root', required=True, type=str)
+    parser.add_argument('--out_root', help='output video root', required=True, type=str)
+    parser.add_argument('--target_size', help='downsample the video by ratio of the larger width to target_size, and upsampled back by FGF', default=1024, type=int)
+    parser.add_argument('--seq_chunk', help='the frames to process in a batch', default=4, type=int)
+    parser.add_argument('--instances', help='number of model instances, 0 to choose by calibration', default=0, type=int)
+    parser.add_argument('--threads', help='intra-op threads of each instance, 0 for its cores', default=0, type=int)
+    parser.add_argument('--calib_size', help='(h, w) of the calibration frames before downsampling', default=[1080, 1920], type=int, nargs=2)
+    parser.add_argument('--calib_iters', help='timed iterations of the calibration', default=10, type=int)
+    args = parser.parse_args()
+
+    from inference_footages import list_jobs
+    from inference_footages_util import auto_downsample_ratio
+
+    os.makedirs(args.out_root, exist_ok=True)
+    jobs = list_jobs(args.root, args.out_root)
+    n_cores = len(split_cores(1)[0])
+
+    n_instances = args.instances
+    if n_instances <= 0:
+        ratio = auto_downsample_ratio(*args.calib_size, target=args.target_size)
+        size = [int(s*ratio)//16*16 for s in args.calib_size]
+        candidates = [n for n in [1, 2, 4, 8, 16, 32, 64] if n <= min(n_cores, max(len(jobs), 1))]
+        fps = calibrate(candidates, args.threads, size, args.seq_chunk, args.calib_iters)
+        n_instances = max(fps, key=fps.get)
+    print(f'Run {n_instances} instances on {n_cores} cores: {split_cores(n_instances)}')
+
+    run(jobs, n_instances, args.threads, dict(seq_chunk=args.seq_chunk, num_workers=0, target_size=args.target_size))
@@ -9,13 +9,17 @@ from tqdm.auto import tqdm
 from PIL import Image
 
 from inference_io import VideoReader, VideoWriter, ImageSequenceReader, ImageSequenceWriter
-from inference_model_list import inference_model_list
-from model.which_model import get_model_by_string
+from model.which_model import load_model
 from torch.nn import functional as F
+from FTPVM.util import autocast_context, to_channels_last
+from FTPVM.memory_bank import MemoryBank
+from FTPVM.session import MattingSession, load_session
+# optional features (ROI, temporal shortcuts, adaptive ratio, torch.compile) are imported when used, see `convert_video`
+from util.device import add_device_args, setup_device
 
 def convert_video(model,
                   input_source: str,
-                  memory_img: str,
+                  memory_img: Optional[str],
                   memory_mask: Optional[str] = None,
                   input_resize: Optional[Tuple[int, int]] = None,
                   downsample_ratio: Optional[float] = None,
@@ -23,13 +27,29 @@ def convert_video(model,
                   output_composition: Optional[str] = None,
                   output_alpha: Optional[str] = None,
                   output_foreground: Optional[str] = None,
+                  output_trimap: Optional[str] = None,
                   output_video_mbps: Optional[float] = None,
                   seq_chunk: int = 1,
                   num_workers: int = 0,
                   progress: bool = True,
                   device: Optional[str] = None,
                   dtype: Optional[torch.dtype] = torch.float32,
-                  target_size: int = 1024):
+                  target_size: int = 1024,
+                  channels_last: bool = False,
+                  autocast_dtype: Optional[torch.dtype] = None,
+                  tran_threshold: Optional[float] = None,
+                  roi: bool = False,
+                  static_threshold: Optional[float] = None,
+                  static_max_run: int = 30,
+                  keyframe_interval: int = 1,
+                  target_ms: Optional[float] = None,
+                  ratio_bounds: Tuple[float, float] = (0.25, 1.),
+                  ratio_log: Optional[str] = None,
+                  compile: bool = False,
+                  compile_cache: Optional[str] = None,
+                  cuda_graph: bool = False,
+                  session_in: Optional[str] = None,
+                  session_out: Optional[str] = None):
     
     """
     Args:
@@ -43,18 +63,62 @@ def convert_video(model,
             If output_type == 'png_sequence'. the composition is RGBA png images.
         output_alpha: The alpha output from the model.
         output_foreground: The foreground output from the model.
+        output_trimap: The trimap output from the model in {0, 0.5, 1}, at the downsampled working resolution.
+            Only the requested outputs are computed, e.g. the matting decoder is skipped for the trimap only
+            and the composition is skipped for the alpha only.
         seq_chunk: Number of frames to process at once. Increase it for better parallelism.
         num_workers: PyTorch's DataLoader workers. Only use >0 for image input.
         progress: Show progress bar.
         device: Only need to manually provide if model is a TorchScript freezed model.
         dtype: Only need to manually provide if model is a TorchScript freezed model.
+        channels_last: Convert the model & frames to channels-last memory format.
+        autocast_dtype: Run the model under autocast, e.g. torch.bfloat16 for modern x86 CPUs.
+            The memory softmax, the trimap fusion and the guided filter stay in float32.
+        tran_threshold: Skip the matting decoder for the chunks whose fraction of transition pixels is below it,
+            the number of frames taking the fast path is shown in the progress bar.
+        roi: Run the model on a crop around the subject of the previous frame with the same working size,
+            falls back to the full frame when the subject is lost or large.
+        static_threshold: Reuse the outputs & the RNN memories of the last computed frame for the frames
+            whose downsampled difference to it is below the threshold, at most `static_max_run` frames in a row.
+        keyframe_interval: Run the network every k-th frame (and the last frame) only, the other alphas are
+            interpolated from the neighbouring keyframes by optical flow, for high frame rate videos.
+        target_ms: Adjust the downsample ratio within `ratio_bounds` during the video to meet this time per frame,
+            starting from `downsample_ratio`. The RNN memories are resampled and the memory frame is re-encoded
+            whenever the working size changes, which are written to `ratio_log` (csv) if given.
+        compile: Run the model by torch.compile, the frames are padded into resolution buckets
+            so only a few graphs are compiled. `compile_cache` is a directory to reuse the compiled artifacts between runs.
+        cuda_graph: Replay the chunks by a CUDA graph over preallocated buffers, so the steady-state chunks allocate nothing.
+            Without the ROI, the fast path, the temporal shortcuts & torch.compile.
+        session_in: Resume from a saved session state (encoded memory, recurrent memory & downsample ratio)
+            instead of encoding `memory_img`, which can be `None` then.
+        session_out: Save the session state at the end, to continue the stream in another run.
+            With `roi`, only the encoded memory is saved.
+    Returns:
+        The number of processed frames.
     """
     
     assert downsample_ratio is None or (downsample_ratio > 0 and downsample_ratio <= 1), 'Downsample ratio must be between 0 (exclusive) and 1 (inclusive).'
-    assert any([output_composition, output_alpha, output_foreground]), 'Must provide at least one output.'
+    assert any([output_composition, output_alpha, output_foreground, output_trimap]), 'Must provide at least one output.'
     assert output_type in ['video', 'png_sequence'], 'Only support "video" and "png_sequence" output modes.'
     assert seq_chunk >= 1, 'Sequence chunk must be >= 1'
     assert num_workers >= 0, 'Number of workers must be >= 0'
+    assert keyframe_interval >= 1, 'Keyframe interval must be >= 1'
+    assert static_threshold is None or keyframe_interval == 1, 'Static frame gate & keyframes are exclusive'
+    assert target_ms is None or not roi, 'Adaptive downsample ratio & ROI are exclusive'
+    assert not cuda_graph or not (roi or compile or tran_threshold is not None or static_threshold is not None or keyframe_interval > 1), \
+        'CUDA graphs need fixed chunks without the ROI, the fast path, the temporal shortcuts & torch.compile'
+    assert memory_img is not None or session_in is not None, 'Must provide a memory frame or a session state'
+    assert memory_img is not None or input_resize is None, 'Input resize needs the memory frame'
+    # requested outputs, the others are not computed
+    outputs = set()
+    if output_alpha is not None:
+        outputs |= {'alpha'}
+    if output_foreground is not None:
+        outputs |= {'alpha', 'fgr'}
+    if output_trimap is not None:
+        outputs |= {'trimap'}
+    if output_composition is not None:
+        outputs |= {'alpha', 'fgr', 'trimap'}
     # Initialize transform
     if input_resize is not None:
         s = Image.open(memory_img).size
@@ -76,7 +140,8 @@ def convert_video(model,
     else:
         source = ImageSequenceReader(input_source, transform)
     
-    reader = DataLoader(source, batch_size=seq_chunk, pin_memory=True, num_workers=num_workers)
+    is_cuda = torch.device(device).type == 'cuda' if device is not None else next(model.parameters()).is_cuda
+    reader = DataLoader(source, batch_size=seq_chunk, pin_memory=is_cuda, num_workers=num_workers)
     
 
     # Initialize writers
@@ -98,6 +163,11 @@ def convert_video(model,
                 path=output_foreground,
                 frame_rate=frame_rate,
                 bit_rate=int(output_video_mbps * 1000000))
+        if output_trimap is not None:
+            writer_tri = VideoWriter(
+                path=output_trimap,
+                frame_rate=frame_rate,
+                bit_rate=int(output_video_mbps * 1000000))
     else:
         if output_composition is not None:
             writer_com = ImageSequenceWriter(output_composition, 'png')
@@ -105,44 +175,122 @@ def convert_video(model,
             writer_pha = ImageSequenceWriter(output_alpha, 'png')
         if output_foreground is not None:
             writer_fgr = ImageSequenceWriter(output_foreground, 'png')
+        if output_trimap is not None:
+            writer_tri = ImageSequenceWriter(output_trimap, 'png')
+
+    # optional features, imported only when used to keep the startup short
+    if roi or target_ms is not None:
+        from FTPVM.roi import ROIInference
+        from FTPVM.adaptive import AdaptiveDownsampler
+    if static_threshold is not None or keyframe_interval > 1:
+        from FTPVM.temporal import StaticFrameGate, KeyframeInterpolator
+    if compile:
+        from FTPVM.compiled import CompiledMatting
 
     # Inference
     model = model.eval()
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if compile:
+        model = CompiledMatting(model, cache_dir=compile_cache)
     if device is None or dtype is None:
         param = next(model.parameters())
         dtype = param.dtype
         device = param.device
-    m_img = transform(Image.open(memory_img)).unsqueeze(0).unsqueeze(0).to(device)
-    if memory_mask is not None and memory_mask != '':
-        m_mask = transform(Image.open(memory_mask).convert(mode='L')).unsqueeze(0).unsqueeze(0).to(device)
-    else:
-        print("Memory frame is background!")
-        shape = list(m_img.shape) # b t c h w
-        shape[2] = 1
-        m_mask = torch.zeros(shape, dtype=m_img.dtype, device=m_img.device)
-    bgr = torch.tensor([120, 255, 155], device=device, dtype=dtype).div(255).view(1, 1, 3, 1, 1)
+    session = load_session(session_in, model, device, dtype) if session_in is not None else None
+    m_img = m_mask = None
+    if memory_img is not None:
+        m_img = transform(Image.open(memory_img)).unsqueeze(0).unsqueeze(0).to(device)
+        if memory_mask is not None and memory_mask != '':
+            m_mask = transform(Image.open(memory_mask).convert(mode='L')).unsqueeze(0).unsqueeze(0).to(device)
+        else:
+            print("Memory frame is background!")
+            shape = list(m_img.shape) # b t c h w
+            shape[2] = 1
+            m_mask = torch.zeros(shape, dtype=m_img.dtype, device=m_img.device)
+    if channels_last and m_img is not None:
+        m_img, m_mask = to_channels_last(m_img), to_channels_last(m_mask)
     
     try:
-        with torch.no_grad():
+        with torch.no_grad(), autocast_context(torch.device(device).type, autocast_dtype):
             bar = tqdm(total=len(source), disable=not progress, dynamic_ncols=True)
-            rec = model.default_rec
-            memory = None
+            # memory bank, RNN memories & reusable output buffers of the stream
+            # the trimaps are made after the static gate & the keyframes, from the logits
+            stream = MattingSession(model, downsample_ratio, memory_bank_size=1, outputs=outputs & {'alpha'}, cuda_graph=cuda_graph, tran_threshold=tran_threshold)
+            frames = 0
+            roi_inference = None
+            gate = StaticFrameGate(static_threshold, static_max_run) if static_threshold is not None else None
+            interpolator = KeyframeInterpolator(keyframe_interval, len(source)) if keyframe_interval > 1 else None
+            controller = None
+            if session is not None:
+                stream.memory_bank = session['memory_bank']
+                stream.set_rec(session['rec'])
+                if downsample_ratio is not None and downsample_ratio != session['downsample_ratio']:
+                    print(f"Downsample ratio {downsample_ratio} -> {session['downsample_ratio']} of the session")
+                downsample_ratio = session['downsample_ratio']
+            frame_size = None
             for src in reader:
+                if frame_size is None:
+                    frame_size = tuple(src.shape[2:])
+                    if session is not None and session['frame_size'] not in (None, frame_size):
+                        print(f"Frame size {frame_size} != {session['frame_size']} of the session, clean recurrent memory")
+                        stream.reset()
                 
                 if downsample_ratio is None:
                     downsample_ratio = auto_downsample_ratio(*src.shape[2:], target=target_size)
                     print(downsample_ratio)
-                if memory is None:
-                    memory = model.encode_imgs_to_value(m_img, m_mask, downsample_ratio=downsample_ratio)
+                if target_ms is not None:
+                    if controller is None:
+                        # the compiled model runs padded frames at quantized ratios, 1 graph per ratio
+                        controller = AdaptiveDownsampler(
+                            model, model.padded_size(*src.shape[2:]) if compile else src.shape[2:], target_ms, *ratio_bounds,
+                            ratio=downsample_ratio, device=device, quantize=model.quantize_ratio if compile else None)
+                        downsample_ratio = controller.ratio
+                    elif controller.ratio != downsample_ratio:
+                        # the working size is changed
+                        downsample_ratio = controller.ratio
+                        stream.set_rec(controller.adapt_rec(stream.rec))
+                        if m_img is not None:
+                            # re-encode, or keep the restored memory
+                            stream.memory_bank = MemoryBank(1)
+                    controller.start()
+                stream.downsample_ratio = downsample_ratio
+                if stream.memory_bank.get_memory() is None:
+                    stream.add_memory(m_img, m_mask)
 
                 src = src.to(device, dtype, non_blocking=True).unsqueeze(0) # [B, T, C, H, W]
+                if channels_last:
+                    src = to_channels_last(src)
                 
-                trimap, matte, pha, rec = model.forward_with_memory(src, *memory, *rec, downsample_ratio=downsample_ratio)
-
-                pha = pha.clamp(0, 1)
-                trimap = seg_to_trimap(trimap)
+                keep = gate.select(src) if gate is not None \
+                    else interpolator.select(src) if interpolator is not None \
+                    else None
+                if keep is None or len(keep) > 0:
+                    x = src if keep is None else src[:, keep]
+                    if roi:
+                        if roi_inference is None:
+                            roi_inference = ROIInference(model, src.shape[-2:], target_size=downsample_ratio*max(src.shape[-2:]))
+                        trimap, matte, pha = roi_inference(x, *stream.memory_bank.get_memory(), tran_threshold=tran_threshold)
+                    else:
+                        out = stream.push(x)
+                        trimap, matte, pha = out['seg'], out['mat'], out['pha']
+                    if controller is not None:
+                        controller.stop(src.size(1))
+                if gate is not None:
+                    trimap, matte, pha = gate.assemble(keep, src.size(1), [trimap, matte, pha] if keep else None)
+                elif interpolator is not None:
+                    # the in-between frames are held until the next keyframe
+                    src, held = interpolator.assemble(keep, src, [trimap, matte, pha] if keep else None)
+                    if src is None:
+                        continue
+                    trimap, matte, pha = held
 
-                fgr = src * pha + bgr * (1 - pha)
+                if 'alpha' in outputs:
+                    pha = pha.clamp_(0, 1)
+                if 'trimap' in outputs:
+                    trimap = stream.to_trimap(trimap)
+                if 'fgr' in outputs:
+                    fgr = stream.compose(src, pha)
                 
                 if output_foreground is not None:
                     writer_fgr.write(fgr[0])
@@ -150,6 +298,9 @@ def convert_video(model,
                 if output_alpha is not None:
                     writer_pha.write(pha[0])
 
+                if output_trimap is not None:
+                    writer_tri.write(trimap[0])
+
                 if output_composition is not None:
                     # t, c, h, w
                     target_height = 540
@@ -172,6 +323,40 @@ def convert_video(model,
                     writer_com.write(out)
                 
                 bar.update(src.size(1))
+                frames += src.size(1)
+                postfix = {}
+                if tran_threshold is not None and not roi:
+                    postfix['fast_path'] = stream.mat_stats['fast']
+                if roi:
+                    postfix.update(roi_inference.stats)
+                if gate is not None:
+                    postfix['reused'] = gate.stats['reused']
+                if interpolator is not None:
+                    postfix['interpolated'] = interpolator.stats['interpolated']
+                if controller is not None:
+                    postfix['ratio'] = round(controller.ratio, 3)
+                if postfix:
+                    bar.set_postfix(postfix)
+            if tran_threshold is not None:
+                fast = roi_inference.stats['fast'] if roi_inference is not None else stream.mat_stats['fast']
+                print(f"Fast path: {fast} / {frames} frames")
+            if gate is not None:
+                print(f"Static frames reused: {gate.stats['reused']} / {frames} frames")
+            if interpolator is not None:
+                print(f"Keyframes: {interpolator.stats['key']}, interpolated: {interpolator.stats['interpolated']} / {frames} frames")
+            if controller is not None:
+                print(f"Downsample ratio changes: {controller.stats['changes']}, final ratio: {controller.ratio:.3f}")
+                if ratio_log is not None:
+                    controller.save_log(ratio_log)
+            if compile:
+                print(f"Compiled shapes: {sorted(model.shapes)}")
+                model.save_cache()
+            if session_out is not None and stream.memory_bank.get_memory() is not None:
+                if roi:
+                    stream.reset()
+                stream.frames = frames + (session['frames'] if session is not None else 0)
+                stream.save(session_out, frame_size=frame_size)
+                print(f"Session saved to {session_out}")
 
     finally:
         # Clean up
@@ -181,6 +366,9 @@ def convert_video(model,
             writer_pha.close()
         if output_foreground is not None:
             writer_fgr.close()
+        if output_trimap is not None:
+            writer_tri.close()
+    return frames
 
 def seg_to_trimap(logit):
     val, idx = torch.sigmoid(logit).max(dim=2, keepdim=True) # ch
@@ -204,34 +392,47 @@ if __name__ == '__main__':
     
     parser = argparse.ArgumentParser()
     parser.add_argument('--model', type=str, required=False, default='FTPVM')
+    parser.add_argument('--box-filter', help='box filter of the guided filter, integral: constant cost of any radius', type=str, default='conv', choices=['conv', 'integral'])
+    parser.add_argument('--refiner-radius', help='radius of the guided filter box', type=int, default=1)
     # parser.add_argument('--checkpoint', type=str, required=True)
     parser.add_argument('--gpu', type=int, default=0)
     parser.add_argument('--input-source', type=str, required=True)
     parser.add_argument('--input-resize', type=int, default=None, nargs=2)
-    parser.add_argument('--memory_img', type=str, required=True)
+    parser.add_argument('--memory_img', type=str, default=None)
     parser.add_argument('--memory_mask', type=str, default='')
     parser.add_argument('--downsample-ratio', type=float)
     parser.add_argument('--output-composition', type=str)
     parser.add_argument('--output-alpha', type=str)
     parser.add_argument('--output-foreground', type=str)
+    parser.add_argument('--output-trimap', type=str)
     parser.add_argument('--output-type', type=str, default='video', choices=['video', 'png_sequence'])
     parser.add_argument('--output-video-mbps', type=int, default=1)
     parser.add_argument('--seq-chunk', type=int, default=1)
     parser.add_argument('--num-workers', type=int, default=0)
     parser.add_argument('--disable-progress', action='store_true')
     parser.add_argument('--target_size', type=int, default=1024)
+    parser.add_argument('--channels-last', help='channels-last memory format', action='store_true')
+    parser.add_argument('--autocast-dtype', help='run under autocast, e.g. bfloat16 on CPU', type=str, default=None, choices=['bfloat16', 'float16'])
+    parser.add_argument('--tran-threshold', help='skip the matting decoder below this fraction of transition pixels', type=float, default=None)
+    parser.add_argument('--roi', help='run on a crop around the subject', action='store_true')
+    parser.add_argument('--static-threshold', help='reuse the last outputs for frames whose difference is below it', type=float, default=None)
+    parser.add_argument('--static-max-run', help='max. reused frames in a row', type=int, default=30)
+    parser.add_argument('--keyframe-interval', help='run the network every k-th frame, interpolate the others by optical flow', type=int, default=1)
+    parser.add_argument('--target-ms', help='adjust the downsample ratio to meet this time per frame', type=float, default=None)
+    parser.add_argument('--ratio-bounds', help='(min, max) downsample ratio of --target-ms', type=float, nargs=2, default=[0.25, 1.])
+    parser.add_argument('--ratio-log', help='csv of the downsample ratio over time', type=str, default=None)
+    parser.add_argument('--compile', help='run the model by torch.compile with resolution buckets', action='store_true')
+    parser.add_argument('--compile-cache', help='directory of the persistent compile cache', type=str, default=None)
+    parser.add_argument('--cuda-graph', help='replay the chunks by a CUDA graph, no allocation per chunk', action='store_true')
+    parser.add_argument('--session-in', help='resume from a saved session state instead of encoding --memory_img', type=str, default=None)
+    parser.add_argument('--session-out', help='save the session state at the end', type=str, default=None)
+    add_device_args(parser)
     args = parser.parse_args()
     
-    device = 'cuda:%d' % args.gpu
-    model_attr = inference_model_list[args.model]
-    model = get_model_by_string(model_attr[1])().to(device=device)
-    def check_and_load_model_dict(model, state_dict: dict):
-        for k in set(state_dict.keys()) - set(model.state_dict().keys()):
-            if 'refiner' in k:
-                print('remove refiner', k)
-                state_dict.pop(k)
-        model.load_state_dict(state_dict)
-    check_and_load_model_dict(model, torch.load(model_attr[3]))
+    if args.device is None and torch.cuda.is_available():
+        args.device = 'cuda:%d' % args.gpu
+    device = setup_device(args)
+    model = load_model(args.model, device, refiner_kwargs={'box_filter': args.box_filter, 'radius': args.refiner_radius})
     # print(model)
     # converter = Converter(args.variant, args.checkpoint, args.device)
     convert_video(
@@ -245,12 +446,28 @@ if __name__ == '__main__':
         output_composition=args.output_composition,
         output_alpha=args.output_alpha,
         output_foreground=args.output_foreground,
+        output_trimap=args.output_trimap,
         output_video_mbps=args.output_video_mbps,
         seq_chunk=args.seq_chunk,
         num_workers=args.num_workers,
         progress=not args.disable_progress,
         device=device,
         target_size=args.target_size,
+        channels_last=args.channels_last,
+        autocast_dtype=None if args.autocast_dtype is None else getattr(torch, args.autocast_dtype),
+        tran_threshold=args.tran_threshold,
+        roi=args.roi,
+        static_threshold=args.static_threshold,
+        static_max_run=args.static_max_run,
+        keyframe_interval=args.keyframe_interval,
+        target_ms=args.target_ms,
+        ratio_bounds=args.ratio_bounds,
+        ratio_log=args.ratio_log,
+        compile=args.compile,
+        compile_cache=args.compile_cache,
+        cuda_graph=args.cuda_graph,
+        session_in=args.session_in,
+        session_out=args.session_out,
     )
     
     
@@ -9,7 +9,9 @@ import torch
 torch.set_grad_enabled(False)
 
 from FTPVM.inference_model import *
+from FTPVM.artifact import load_weights, build_model
 from evalutation.evaluate_lr import Evaluator
+from util.timeline import Timeline
 
 
 class TimeStamp:
@@ -41,28 +43,37 @@ def run_evaluation(
     gt_name='GT', downsample_ratio=1, save_video=True, 
     memory_save_iter=-1, memory_bank_size=5,
     replace_by_given_tri=False,
+    model=None, device='cuda', dtype=torch.float32,
+    trace_path=None,
     ):
-    """ Evaluate the dataset """
+    """
+    Evaluate the dataset\n
+    `model`: a constructed model to evaluate instead of loading `model_func` with `model_path`\n
+    `device`, `dtype`: where & in which dtype the model runs\n
+    `trace_path`: save the per-chunk spans as a Chrome trace JSON & print their summary, the device is synchronized around the spans\n
+    return the `Evaluator` and the mean inference FPS
+    """
     print(f"=" * 30)
     print(f"[ Current model: {model_name}, memory gt freq: {memory_freq}, memory save freq: {memory_save_iter}, memory bank size: {memory_bank_size} save video: {save_video}]")
  
     pred_path = os.path.join(root, model_name)
     gt_path = os.path.join(root, gt_name)
-    model = model_func()
-    model.load_state_dict(torch.load(model_path))
-    model = model.cuda()
+    if model is None:
+        model = build_model(model_func, load_weights(model_path), device)
+    model = model.to(device, dtype)
     
     inference_core: InferenceCoreRecurrent = None
     last_data = None
     loader_iter = iter(dataloader)
     ts = TimeStamp()
+    timeline = Timeline(device) if trace_path else None
     fps = []
     while True:
         inference_core = inference_core_func(
             model, dataset, loader_iter, last_data=last_data,
             memory_iter=memory_freq, memory_gt=memory_gt, memory_bg=memory_bg, 
             memory_save_iter=memory_save_iter, memory_bank_size=memory_bank_size,
-            downsample_ratio=downsample_ratio, replace_by_given_tri=replace_by_given_tri)
+            downsample_ratio=downsample_ratio, replace_by_given_tri=replace_by_given_tri, device=device, dtype=dtype, timeline=timeline)
         
         fps.append(run_inference(inference_core, pred_path, gt_path, dataset_name, save_video=save_video))
         
@@ -86,12 +97,17 @@ def run_evaluation(
         # break
 
     print(f"[ Inference time: {ts.count()} ]")
+    if timeline is not None:
+        timeline.save(trace_path)
+        print(f"[ Trace: {trace_path} ]")
+        timeline.print_summary()
     
-    Evaluator(
+    evaluator = Evaluator(
         pred_dir=pred_path,
         true_dir=gt_path,
         num_workers=4, is_eval_fgr=False
     )
     print(f"[ Computer score time: {ts.count()} ]")
-    print(f"[ Inference GPU FPS: {np.mean(fps)} ]")
+    print(f"[ Inference {device} FPS: {np.mean(fps)} ]")
+    return evaluator, np.mean(fps)
 
@@ -1,6 +1,5 @@
 import av
 import os
-import pims
 import numpy as np
 from torch.utils.data import Dataset
 from torchvision.transforms.functional import to_pil_image
@@ -9,6 +8,7 @@ from PIL import Image
 
 class VideoReader(Dataset):
     def __init__(self, path, transform=None):
+        import pims # slow to import, only for video files
         self.video = pims.PyAVVideoReader(path)
         self.rate = self.video.frame_rate
         self.transform = transform
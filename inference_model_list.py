@@ -3,12 +3,13 @@ from inference_func import *
 from FTPVM.model import *
 from FTPVM.module import *
 from FTPVM.inference_model import *
+from model.which_model import inference_models
 
 
 # id, model name defined in model/which_model.py, Inference class, model path
 inference_model_list = [
     ('FTPVM', 'FTPVM', InferenceCoreRecurrentMemory, 
-	'./saves/ftpvm.pth'),
+	inference_models['FTPVM'][1]),
 ]
 
 
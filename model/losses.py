@@ -8,6 +8,8 @@ import kornia as K
 import einops
 from functools import lru_cache
 
+from util.device import get_device
+
 class FocalLoss(nn.Module):
     # https://github.com/AdeelH/pytorch-multi-class-focal-loss/blob/master/focal_loss.py
     """ Focal Loss, as described in https://arxiv.org/abs/1708.02002.
@@ -101,19 +103,20 @@ class SegLossComputer:
     def __init__(self, para):
         super().__init__()
         self.para = para
+        self.device = get_device(para['device'])
         self.bce = nn.BCEWithLogitsLoss()
         celoss_type=para['celoss_type']
         self.ce = {
             'focal': FocalLoss,
             'normal': nn.CrossEntropyLoss,
-            'normal_weight': lambda: nn.CrossEntropyLoss(weight=torch.FloatTensor([1, 3, 1])).cuda(),
-            'focal_weight': lambda: FocalLoss(alpha=torch.FloatTensor([1, 3, 1])).cuda(),
-            'focal_gamma1': lambda: FocalLoss(gamma=1).cuda(),
-            'focal_gamma5': lambda: FocalLoss(gamma=5).cuda(),
-            'focal_gamma0.5': lambda: FocalLoss(gamma=0.5).cuda(),
+            'normal_weight': lambda: nn.CrossEntropyLoss(weight=torch.FloatTensor([1, 3, 1])).to(self.device),
+            'focal_weight': lambda: FocalLoss(alpha=torch.FloatTensor([1, 3, 1])).to(self.device),
+            'focal_gamma1': lambda: FocalLoss(gamma=1).to(self.device),
+            'focal_gamma5': lambda: FocalLoss(gamma=5).to(self.device),
+            'focal_gamma0.5': lambda: FocalLoss(gamma=0.5).to(self.device),
         }[celoss_type]()
         self.avg2d = nn.AvgPool3d((1, 2, 2))
-        self.tvloss = TotalVariationLoss(para['tvloss_type']).cuda()
+        self.tvloss = TotalVariationLoss(para['tvloss_type']).to(self.device)
         self.lambda_tvloss = para['lambda_segtv']
         self.start_tvloss = para['start_segtv']
 
@@ -147,21 +150,22 @@ class MatLossComputer:
     def __init__(self, para):
         super().__init__()
         self.para = para
-        self.lapla_loss = LapLoss(max_levels=5).cuda()
+        self.device = get_device(para['device'])
+        self.lapla_loss = LapLoss(max_levels=5).to(self.device)
         # assert (celoss_type:=para['celoss_type']) in ['focal', 'normal', 'normal_weight', 'focal_weight']
         celoss_type=para['celoss_type']
         self.ce = {
             'focal': FocalLoss,
             'normal': nn.CrossEntropyLoss,
-            'normal_weight': lambda: nn.CrossEntropyLoss(weight=torch.FloatTensor([1, 3, 1])).cuda(),
-            'focal_weight': lambda: FocalLoss(alpha=torch.FloatTensor([1, 3, 1])).cuda(),
-            'focal_gamma1': lambda: FocalLoss(gamma=1).cuda(),
-            'focal_gamma5': lambda: FocalLoss(gamma=5).cuda(),
-            'focal_gamma0.5': lambda: FocalLoss(gamma=0.5).cuda(),
+            'normal_weight': lambda: nn.CrossEntropyLoss(weight=torch.FloatTensor([1, 3, 1])).to(self.device),
+            'focal_weight': lambda: FocalLoss(alpha=torch.FloatTensor([1, 3, 1])).to(self.device),
+            'focal_gamma1': lambda: FocalLoss(gamma=1).to(self.device),
+            'focal_gamma5': lambda: FocalLoss(gamma=5).to(self.device),
+            'focal_gamma0.5': lambda: FocalLoss(gamma=0.5).to(self.device),
         }[celoss_type]()
         self.spatial_grad = K.filters.SpatialGradient()
         self.avg2d = nn.AvgPool3d((1, 2, 2))
-        self.tvloss = TotalVariationLoss(para['tvloss_type']).cuda()
+        self.tvloss = TotalVariationLoss(para['tvloss_type']).to(self.device)
         self.lambda_tvloss = para['lambda_segtv']
         self.start_tvloss = para['start_segtv']
         self.full_matte = para['full_matte']
@@ -23,6 +23,7 @@ from model.which_model import get_model_by_string
 from model.losses import MatLossComputer, SegLossComputer
 from util.log_integrator import Integrator
 from util.image_saver import pool_pairs
+from util.device import get_device
 
 from warmup_scheduler import GradualWarmupScheduler
 
@@ -31,7 +32,8 @@ class PropagationModel:
         self.para = para
         print("Using model: ", para['which_model'])
         # "which_model=which_module"
-        self.PNet = get_model_by_string(para['which_model'])().cuda()
+        self.device = get_device(para['device'])
+        self.PNet = get_model_by_string(para['which_model'])().to(self.device)
         
         print("Net Parameters: ", summary(self.PNet, verbose=0).total_params)
         self.logger = logger
@@ -214,7 +216,7 @@ class PropagationModel:
         
         for k, v in data.items():
             if type(v) != list and type(v) != dict and type(v) != int:
-                data[k] = v.cuda(non_blocking=True)
+                data[k] = v.to(self.device, non_blocking=True)
 
         data, out = self.seg_pass(data, it) if segmentation_pass else self.mat_pass(data, it)
 
@@ -283,7 +285,7 @@ class PropagationModel:
         print('Checkpoint saved to %s.' % checkpoint_path)
 
     def load_model(self, path, extra_keys=[]):
-        checkpoint: dict = torch.load(path)
+        checkpoint: dict = torch.load(path, map_location=self.device)
 
         it = checkpoint['it']
         network = checkpoint['network']
@@ -300,7 +302,7 @@ class PropagationModel:
         return it, extra_dict
 
     def load_network(self, path):
-        self.check_and_load_model_dict(self.PNet, torch.load(path))
+        self.check_and_load_model_dict(self.PNet, torch.load(path, map_location=self.device))
         
         
         print('Network weight loaded:', path)
@@ -1,4 +1,10 @@
 from FTPVM.model import *
+from FTPVM.artifact import load_weights, is_artifact, build_model, from_artifact
+
+# id: (model name, weights), the lean registry of `inference_model_list.py` without the evaluation cores
+inference_models = {
+    'FTPVM': ('FTPVM', './saves/ftpvm.pth'),
+}
 
 def get_model_by_string(input_string):
     # which_model=which_module
@@ -10,3 +16,17 @@ def get_model_by_string(input_string):
         'FTPVM': FastTrimapPropagationVideoMatting,
     }[which_model]
 
+def load_model(model_id='FTPVM', device='cpu', path=None, refiner_kwargs=None):
+    """
+    build the model `model_id` of `inference_models` & load its weights (or `path`) offline & memory-mapped,
+    `path` can be a model artifact (see `FTPVM/artifact.py`), the stale refiner weights are removed\n
+    `refiner_kwargs`: options of the guided filter, e.g. {'box_filter': 'integral'}, override those of an artifact
+    """
+    model_name, weights = inference_models[model_id]
+    state = load_weights(weights if path is None else path)
+    if is_artifact(state):
+        if refiner_kwargs is not None:
+            state = {**state, 'config': {**state['config'], 'refiner_kwargs': refiner_kwargs}}
+        return from_artifact(state, device)
+    config = {} if refiner_kwargs is None else {'refiner_kwargs': refiner_kwargs}
+    return build_model(get_model_by_string(model_name), state, device, drop=('refiner',), **config)
@@ -0,0 +1,60 @@
+"""
+Fill the trimap cache of the validation datasets in parallel (only the GT is read), e.g.
+python precompute_trimaps.py --trimap_cache ../trimap_cache --size 1024 --trimap_width 25
+and run the evaluation with the same `--trimap_cache`
+"""
+import os
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from tqdm import tqdm
+
+from dataset.vm108_dataset import VM108ValidationDataset, ValidationDataset
+
+_dataset = None # of each worker, set by `_init_worker` (forked or spawned)
+
+def _init_worker(dataset):
+    global _dataset
+    _dataset = dataset
+
+def _cache_trimaps(idx):
+    return _dataset.cache_trimaps(idx)
+
+def precompute(dataset, workers):
+    """ return the number of frames """
+    with Pool(workers, initializer=_init_worker, initargs=(dataset,)) as pool:
+        return sum(tqdm(pool.imap_unordered(_cache_trimaps, range(len(dataset))), total=len(dataset)))
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--trimap_cache', help='cache directory of the generated trimaps', required=True, type=str)
+    parser.add_argument('--size', help='eval video size: sd, 1024, hd, 4k', default='1024', type=str)
+    parser.add_argument('--trimap_width', default=25, type=int)
+    parser.add_argument('--dataset_root', default="../dataset_mat", type=str)
+    parser.add_argument('--frames_per_item', help='frames per task', default=32, type=int)
+    parser.add_argument('--workers', help='processes, default: all CPUs', default=os.cpu_count(), type=int)
+    parser.add_argument('--disable_vm108', help='Without VM108', action='store_true')
+    parser.add_argument('--disable_vm240k', help='Without VM240k', action='store_true')
+    args = parser.parse_args()
+
+    # as `inference_dataset.py`
+    size = {
+        'sd': [144, 256],
+        '1024': [576, 1024],
+        'hd': [1080, 1920],
+        '4k': [2160, 3840],
+    }[args.size]
+    datasets = []
+    if not args.disable_vm108 and args.size != '4k':
+        datasets.append(('vm108', VM108ValidationDataset(
+            root=os.path.join(args.dataset_root, 'VideoMatting108'),
+            size=size, frames_per_item=args.frames_per_item, mode='val',
+            trimap_width=args.trimap_width, trimap_cache=args.trimap_cache)))
+    if not args.disable_vm240k:
+        datasets.append(('vm240k', ValidationDataset(
+            root=os.path.join(args.dataset_root, 'videomatte_motion_4k'),
+            frames_per_item=args.frames_per_item, trimap_width=args.trimap_width, size=size,
+            trimap_cache=args.trimap_cache)))
+
+    for name, dataset in datasets:
+        frames = precompute(dataset, args.workers)
+        print(f'{name}: {frames} trimaps in {args.trimap_cache}')
@@ -0,0 +1,95 @@
+"""
+Post-training int8 quantization of FTPVM for CPU inference
+Calibrate on the validation clips, save the quantized model,
+and optionally evaluate both the float and the int8 models to report the speed & accuracy deltas
+"""
+from argparse import ArgumentParser
+
+parser = ArgumentParser()
+parser.add_argument('--model', default='FTPVM', type=str)
+parser.add_argument('--checkpoint', default='./saves/ftpvm.pth', type=str)
+parser.add_argument('--dataset', help='calibration / evaluation data: vm108, vm240k', default='vm108', type=str)
+parser.add_argument('--dataset_root', default="../dataset_mat", type=str)
+parser.add_argument('--size', help='video size: sd, 1024', default='sd', type=str)
+parser.add_argument('--frames_per_item', help='frames in a batch', default=8, type=int)
+parser.add_argument('--trimap_width', default=25, type=int)
+parser.add_argument('--calib_items', help='number of items (chunks of frames) for calibration', default=32, type=int)
+parser.add_argument('--downsample_ratio', default=1, type=float)
+parser.add_argument('--out', default='./saves/ftpvm_int8.pth', type=str)
+parser.add_argument('--eval', help='Evaluate the float & int8 models on CPU', action='store_true')
+parser.add_argument('--out_root', default=".", type=str)
+parser.add_argument('--threads', help='CPU threads, 0 for the physical cores', default=0, type=int)
+parser.add_argument('--interop_threads', help='inter-op CPU threads, 0 for the torch default', default=0, type=int)
+args = parser.parse_args()
+
+import os
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from dataset.vm108_dataset import *
+from inference_func import *
+from model.which_model import load_model
+from FTPVM.quantize import quantize_model, save_quantized
+from inference_model_list import inference_model_list
+from util.device import setup_threads
+
+print(args)
+setup_threads('cpu', args.threads, args.interop_threads)
+
+size = {
+    'sd': [144, 256],
+    '1024': [576, 1024],
+}[args.size]
+
+def get_size_name(size):
+    return str(size) if type(size) == int else f'{size[1]}x{size[0]}'
+
+def get_dataset():
+    if args.dataset == 'vm108':
+        return VM108ValidationDataset(
+            root=os.path.join(args.dataset_root, 'VideoMatting108'),
+            size=size, frames_per_item=args.frames_per_item, mode='val', trimap_width=args.trimap_width)
+    return ValidationDataset(
+        root=os.path.join(args.dataset_root, 'videomatte_motion_4k'),
+        frames_per_item=args.frames_per_item, trimap_width=args.trimap_width, size=size)
+
+def summarize(evaluator):
+    """ return {metric: mean over all frames of all clips} """
+    values = {}
+    for _, _, metrics in evaluator.results:
+        for k, v in metrics.items():
+            values.setdefault(k, []).extend(v)
+    return {k: np.mean(v) for k, v in values.items()}
+
+model = load_model(args.model, 'cpu', args.checkpoint).eval()
+
+dataset = get_dataset()
+loader = DataLoader(dataset, batch_size=1, num_workers=4, shuffle=False)
+qmodel, prepared = quantize_model(model, loader, num_items=args.calib_items, downsample_ratio=args.downsample_ratio)
+print('Quantized blocks: ', prepared)
+save_quantized(qmodel, args.out)
+print('Quantized model saved to %s.' % args.out)
+
+if args.eval:
+    inference_core = inference_model_list[args.model][2]
+    root = os.path.join(args.out_root, f'{args.dataset}_val_tri{args.trimap_width}_'+get_size_name(size))
+    results = {}
+    for name, m in [(args.model+'_cpu', model), (args.model+'_int8', qmodel)]:
+        evaluator, fps = run_evaluation(
+            root=root,
+            model_name=name, model_func=None, model_path=None,
+            inference_core_func=inference_core,
+            dataset_name=args.dataset, dataset=dataset,
+            dataloader=DataLoader(dataset, batch_size=1, num_workers=4, shuffle=False),
+            downsample_ratio=args.downsample_ratio, save_video=False,
+            model=m, device='cpu')
+        results[name] = (summarize(evaluator), fps)
+
+    (float_metrics, float_fps), (int8_metrics, int8_fps) = results.values()
+    print("=" * 50)
+    print(f"{'metric':<12}{'float':>12}{'int8':>12}{'delta':>12}")
+    for k in float_metrics:
+        print(f"{k:<12}{float_metrics[k]:>12.4f}{int8_metrics[k]:>12.4f}{int8_metrics[k]-float_metrics[k]:>+12.4f}")
+    print(f"{'FPS':<12}{float_fps:>12.2f}{int8_fps:>12.2f}{int8_fps-float_fps:>+12.2f}")
+    print(f"Speedup: {int8_fps/float_fps:.2f}x")
@@ -0,0 +1,227 @@
+"""
+Local matting server of many concurrent sessions sharing 1 engine, see `FTPVM/serving.py`
+HTTP:
+    POST   /sessions                {"downsample_ratio": 1., "memory_bank_size": 5} -> {"id": ID}
+    POST   /sessions/ID/memory      {"image": base64 image, "trimap": base64 image} -> {"memory": frames}
+    POST   /sessions/ID/frame       encoded image -> alpha png
+    POST   /sessions/ID/reset       clear the recurrent memory
+    DELETE /sessions/ID
+    GET    /stats
+WebSocket:
+    /sessions/ID/ws                 binary message: encoded image -> binary message: alpha png,
+                                    text message: {"type": "reset"}
+"""
+import base64
+import hashlib
+import json
+import struct
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+import torch
+
+from FTPVM.serving import MattingEngine
+from util.device import add_device_args, setup_device
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WS_TEXT, WS_BINARY, WS_CLOSE, WS_PING, WS_PONG = 0x1, 0x2, 0x8, 0x9, 0xA
+
+def decode_image(data: bytes, gray=False):
+    """ encoded image -> (c, h, w) in [0, 1] """
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE if gray else cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError('Invalid image')
+    if gray:
+        return torch.from_numpy(img)[None].float().div(255)
+    return torch.from_numpy(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)).permute(2, 0, 1).float().div(255)
+
+def encode_alpha(pha: torch.Tensor):
+    """ (1, h, w) in [0, 1] -> png """
+    _, data = cv2.imencode('.png', (pha[0].numpy()*255).round().astype(np.uint8))
+    return data.tobytes()
+
+def ws_recv(rfile, wfile):
+    """ read a message, return (opcode, payload), pings are answered """
+    message, opcode = b'', None
+    while True:
+        head = rfile.read(2)
+        if len(head) < 2:
+            return WS_CLOSE, b''
+        fin, op = head[0] & 0x80, head[0] & 0x0F
+        masked, length = head[1] & 0x80, head[1] & 0x7F
+        if length == 126:
+            length = struct.unpack('>H', rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('>Q', rfile.read(8))[0]
+        mask = rfile.read(4) if masked else None
+        payload = rfile.read(length)
+        if mask is not None:
+            payload = (np.frombuffer(payload, np.uint8) ^ np.resize(np.frombuffer(mask, np.uint8), length)).tobytes()
+        if op == WS_PING:
+            ws_send(wfile, payload, WS_PONG)
+            continue
+        if op == WS_CLOSE:
+            return WS_CLOSE, payload
+        if op != 0:
+            # not a continuation
+            opcode = op
+        message += payload
+        if fin:
+            return opcode, message
+
+def ws_send(wfile, payload: bytes, opcode=WS_BINARY):
+    n = len(payload)
+    if n < 126:
+        header = struct.pack('>BB', 0x80 | opcode, n)
+    elif n < (1 << 16):
+        header = struct.pack('>BBH', 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack('>BBQ', 0x80 | opcode, 127, n)
+    wfile.write(header + payload)
+    wfile.flush()
+
+class MattingHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    engine: MattingEngine = None
+    timeout_s = 30.
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body: bytes, content_type='application/json', code=200):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, obj, code=200):
+        self.send_body(json.dumps(obj).encode(), code=code)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def route(self):
+        """ ['sessions', ID, action] """
+        parts = [p for p in self.path.split('?')[0].split('/') if p]
+        return parts + [None]*(3-len(parts))
+
+    def handle_errors(self, func):
+        try:
+            func()
+        except KeyError:
+            self.send_json({'error': 'unknown session'}, 404)
+        except ValueError as e:
+            self.send_json({'error': str(e)}, 400)
+        except FutureTimeoutError:
+            self.send_json({'error': f'no result within {self.timeout_s} s'}, 504)
+
+    def do_GET(self):
+        root, sid, action = self.route()
+        if root == 'stats':
+            self.send_json({**self.engine.stats, 'sessions': len(self.engine.sessions)})
+        elif root == 'sessions' and action == 'ws':
+            self.handle_errors(lambda: self.websocket(sid))
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        root, sid, action = self.route()
+        if root != 'sessions':
+            self.send_json({'error': 'not found'}, 404)
+        elif sid is None:
+            params = json.loads(self.read_body() or b'{}')
+            self.send_json({'id': self.engine.create_session(
+                params.get('downsample_ratio', 1.), params.get('memory_bank_size', 5))})
+        elif action == 'memory':
+            self.handle_errors(lambda: self.add_memory(sid, json.loads(self.read_body())))
+        elif action == 'frame':
+            self.handle_errors(lambda: self.send_body(self.matting(sid, self.read_body()), 'image/png'))
+        elif action == 'reset':
+            self.handle_errors(lambda: self.reset(sid))
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def do_DELETE(self):
+        root, sid, _ = self.route()
+        if root == 'sessions' and self.engine.close_session(sid):
+            self.send_json({})
+        else:
+            self.send_json({'error': 'unknown session'}, 404)
+
+    def add_memory(self, sid, params):
+        img = decode_image(base64.b64decode(params['image']))
+        mask = decode_image(base64.b64decode(params['trimap']), gray=True)
+        self.engine.add_memory(sid, img, mask)
+        self.send_json({'memory': self.engine.get_session(sid).memory_bank.mem_k.size(1)})
+
+    def reset(self, sid):
+        self.engine.get_session(sid).reset()
+        self.send_json({})
+
+    def matting(self, sid, data):
+        return encode_alpha(self.engine.submit(sid, decode_image(data)).result(self.timeout_s))
+
+    def websocket(self, sid):
+        self.engine.get_session(sid)
+        key = self.headers.get('Sec-WebSocket-Key')
+        if key is None or self.headers.get('Upgrade', '').lower() != 'websocket':
+            raise ValueError('WebSocket upgrade required')
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', base64.b64encode(hashlib.sha1((key+WS_GUID).encode()).digest()).decode())
+        self.end_headers()
+        self.wfile.flush()
+
+        while True:
+            opcode, payload = ws_recv(self.rfile, self.wfile)
+            if opcode == WS_CLOSE:
+                ws_send(self.wfile, payload[:2], WS_CLOSE)
+                break
+            try:
+                if opcode == WS_TEXT:
+                    if json.loads(payload).get('type') == 'reset':
+                        self.engine.get_session(sid).reset()
+                    ws_send(self.wfile, b'{}', WS_TEXT)
+                else:
+                    ws_send(self.wfile, self.matting(sid, payload))
+            except (KeyError, ValueError) as e:
+                ws_send(self.wfile, json.dumps({'error': str(e)}).encode(), WS_TEXT)
+            except FutureTimeoutError:
+                ws_send(self.wfile, json.dumps({'error': f'no result within {self.timeout_s} s'}).encode(), WS_TEXT)
+        self.close_connection = True
+
+if __name__ == '__main__':
+    import argparse
+    from model.which_model import load_model
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='FTPVM')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-batch', help='max. frames of different sessions in a batch', type=int, default=8)
+    parser.add_argument('--window-ms', help='time to gather the frames of a batch', type=float, default=5.)
+    parser.add_argument('--session-timeout', help='seconds of inactivity before a session is dropped, 0 to keep', type=float, default=300.)
+    parser.add_argument('--autocast-dtype', help='run under autocast, e.g. bfloat16 on CPU', type=str, default=None, choices=['bfloat16', 'float16'])
+    add_device_args(parser)
+    args = parser.parse_args()
+    device = setup_device(args)
+    torch.set_grad_enabled(False)
+
+    model = load_model(args.model, device)
+
+    MattingHandler.engine = MattingEngine(model, device,
+        autocast_dtype=None if args.autocast_dtype is None else getattr(torch, args.autocast_dtype),
+        max_batch=args.max_batch, window_ms=args.window_ms, session_timeout=args.session_timeout)
+    server = ThreadingHTTPServer((args.host, args.port), MattingHandler)
+    print(f'Serving on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        MattingHandler.engine.close()
@@ -3,14 +3,29 @@ import torch
 from tqdm import tqdm
 from time import time
 from FTPVM.model import FastTrimapPropagationVideoMatting
+from FTPVM.optimize import optimize_for_inference
+from FTPVM.export import load_torchscript, zero_rec_from_meta
+from FTPVM.compiled import CompiledMatting
+from FTPVM.session import MattingSession, check_steady_state
+from FTPVM.util import autocast_context, to_channels_last
 from model.which_model import get_model_by_string
+from util.device import add_device_args, setup_device, synchronize
 
 torch.backends.cudnn.benchmark = True
 
 class InferenceSpeedTest:
     def __init__(self):
         self.parse_args()
+        if self.args.torchscript is not None:
+            self.loop_torchscript()
+            return
         self.init_model()
+        if self.args.compile:
+            self.loop_compiled()
+            return
+        if self.args.check_alloc:
+            self.check_alloc()
+            return
         self.loop()
         
     def parse_args(self):
@@ -18,22 +33,40 @@ class InferenceSpeedTest:
         parser.add_argument('--model_name', type=str, required=True)
         parser.add_argument('--resolution', type=int, nargs=2, default=[512, 512])
         parser.add_argument('--downsample-ratio', type=float, default=1)
-        parser.add_argument('--precision', type=str, default='float32')
+        parser.add_argument('--precision', help='bfloat16: float32 weights under bfloat16 autocast', type=str, default='float32', choices=['float32', 'float16', 'bfloat16'])
+        parser.add_argument('--channels-last', help='channels-last memory format', action='store_true')
+        add_device_args(parser)
         parser.add_argument('--disable-refiner', action='store_true')
         parser.add_argument('--gpu', type=int, default=0)
         parser.add_argument('--pad', type=int, default=16)
+        parser.add_argument('--refiner_radius', help='radius of the guided filter box', type=int, default=1)
+        parser.add_argument('--box_filter', help='box filter of the guided filter', type=str, default='conv', choices=['conv', 'integral'])
+        parser.add_argument('--torchscript', help='test an exported model from export_torchscript.py', type=str, default=None)
+        parser.add_argument('--optimize', help='fold BatchNorm & strip no-op modules before the test', action='store_true')
+        parser.add_argument('--compile', help='test forward_with_memory by torch.compile, startup & steady-state', action='store_true')
+        parser.add_argument('--compile-cache', help='directory of the persistent compile cache', type=str, default=None)
+        parser.add_argument('--compile-mode', type=str, default=None, choices=['default', 'reduce-overhead', 'max-autotune'])
+        parser.add_argument('--bucket', help='resolution bucket of the compiled model', type=int, default=128)
+        parser.add_argument('--seq-chunk', help='frames per chunk of the compiled model', type=int, default=1)
+        parser.add_argument('--check-alloc', help='count the steady-state allocations of MattingSession, nothing with --cuda-graph', action='store_true')
+        parser.add_argument('--cuda-graph', help='replay the MattingSession chunks by a CUDA graph', action='store_true')
         self.args = parser.parse_args()
+        self.device = setup_device(self.args)
         
     def init_model(self):
         print(self.args)
-        self.device = f'cuda'
         # self.device = f'cuda:{self.args.gpu}'
-        self.precision = {'float32': torch.float32, 'float16': torch.float16}[self.args.precision]
-        self.model = get_model_by_string(self.args.model_name)()
+        self.precision = {'float32': torch.float32, 'float16': torch.float16, 'bfloat16': torch.float32}[self.args.precision]
+        self.autocast_dtype = torch.bfloat16 if self.args.precision == 'bfloat16' else None
+        # random weights, no pretrained download
+        self.model = get_model_by_string(self.args.model_name)(backbone_pretrained=False,
+            refiner_kwargs={'radius': self.args.refiner_radius, 'box_filter': self.args.box_filter})
         # self.model = STCNFuseMatting()
         self.model = self.model.to(device=self.device, dtype=self.precision).eval()
-        # self.model = torch.jit.script(self.model)
-        # self.model = torch.jit.freeze(self.model)
+        if self.args.optimize:
+            self.model = optimize_for_inference(self.model, downsample_ratio=self.args.downsample_ratio)
+        if self.args.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
     
     def loop(self):
         # w, h = (512, 512)
@@ -46,9 +79,11 @@ class InferenceSpeedTest:
         qimg = torch.randn((1, 1, 3, h, w), device=self.device, dtype=self.precision)
         mimg = torch.randn((1, 1, 3, h, w), device=self.device, dtype=self.precision)
         mask = torch.randn((1, 1, 1, h, w), device=self.device, dtype=self.precision)
+        if self.args.channels_last:
+            qimg, mimg, mask = [to_channels_last(x) for x in [qimg, mimg, mask]]
         N = 1000
         downsample_ratio = self.args.downsample_ratio
-        with torch.no_grad():
+        with torch.no_grad(), autocast_context(self.device.type, self.autocast_dtype):
             if 'default_rec' in dir(self.model):
                 rec = self.model.default_rec
             else:
@@ -60,10 +95,90 @@ class InferenceSpeedTest:
             for _ in tqdm(range(N)):
                 # rec = self.model.forward_with_memory(qimg, mk, mv, *rec)[-1]
                 rec = self.model(qimg, mimg, mask, *rec, downsample_ratio=downsample_ratio)[-1]
-                torch.cuda.synchronize()
+                synchronize(self.device)
             t = time()-t
             
         print("FPS: ", N / t)
 
+    def loop_compiled(self):
+        """
+        startup: compile (or load from the cache) & run the first chunk,
+        steady-state: FPS afterwards
+        """
+        w, h = self.args.resolution
+        print('H, W = ', h, w)
+        qimg = torch.rand((1, self.args.seq_chunk, 3, h, w), device=self.device, dtype=self.precision)
+        mimg = torch.rand((1, 1, 3, h, w), device=self.device, dtype=self.precision)
+        mask = torch.rand((1, 1, 1, h, w), device=self.device, dtype=self.precision)
+        if self.args.channels_last:
+            qimg, mimg, mask = [to_channels_last(x) for x in [qimg, mimg, mask]]
+        N = 1000
+        downsample_ratio = self.args.downsample_ratio
+        with torch.no_grad(), autocast_context(self.device.type, self.autocast_dtype):
+            t = time()
+            model = CompiledMatting(self.model, bucket=self.args.bucket, max_chunk=self.args.seq_chunk,
+                cache_dir=self.args.compile_cache, mode=self.args.compile_mode)
+            memory = model.encode_imgs_to_value(mimg, mask, downsample_ratio)
+            rec = model.forward_with_memory(qimg, *memory, downsample_ratio=downsample_ratio)[-1]
+            synchronize(self.device)
+            startup = time()-t
+            # warm up the remaining graphs (e.g. CUDA graphs of reduce-overhead)
+            for _ in range(3):
+                rec = model.forward_with_memory(qimg, *memory, *rec, downsample_ratio=downsample_ratio)[-1]
+            synchronize(self.device)
+
+            t = time()
+            for _ in tqdm(range(N)):
+                rec = model.forward_with_memory(qimg, *memory, *rec, downsample_ratio=downsample_ratio)[-1]
+                synchronize(self.device)
+            t = time()-t
+
+        if model.save_cache():
+            print(f'Compile cache saved to {self.args.compile_cache}')
+        print(f'Compiled shapes: {sorted(model.shapes)}')
+        print(f'Startup: {startup:.2f}s (cache loaded: {model.cache_loaded})')
+        print("FPS: ", N * self.args.seq_chunk / t)
+
+    def check_alloc(self):
+        """ new buffers & device allocations of MattingSession after the warm up, the whole push allocates nothing with --cuda-graph """
+        w, h = self.args.resolution
+        print('H, W = ', h, w)
+        qimg = torch.rand((1, self.args.seq_chunk, 3, h, w), device=self.device, dtype=self.precision)
+        mimg = torch.rand((1, 1, 3, h, w), device=self.device, dtype=self.precision)
+        mask = torch.rand((1, 1, 1, h, w), device=self.device, dtype=self.precision)
+        if self.args.channels_last:
+            qimg, mimg, mask = [to_channels_last(x) for x in [qimg, mimg, mask]]
+        with torch.no_grad(), autocast_context(self.device.type, self.autocast_dtype):
+            session = MattingSession(self.model, self.args.downsample_ratio, cuda_graph=self.args.cuda_graph)
+            session.add_memory(mimg, mask)
+            diff = check_steady_state(session, qimg, warmup=3, iters=20)
+        print(f"Buffers: {session.allocations}, new after warm up: {diff['buffers']}")
+        print(f"Device allocations per chunk: push {diff['push']:.1f}, trimap & composition {diff['post']:.1f}")
+        assert diff['buffers'] == 0 and diff['post'] == 0, 'Steady-state outputs allocate new memory'
+        assert not self.args.cuda_graph or diff['push'] == 0, 'Steady-state CUDA graph chunks allocate new memory'
+
+    def loop_torchscript(self):
+        print(self.args)
+        model, meta = load_torchscript(self.args.torchscript, self.device)
+        print(meta)
+        h, w = meta['size']
+        b, t = meta['batch'], meta['seq_chunk']
+        qimg = torch.rand((b, t, 3, h, w), device=self.device)
+        mimg = torch.rand((b, 1, 3, h, w), device=self.device)
+        mask = torch.rand((b, 1, 1, h, w), device=self.device)
+        N = 1000
+        with torch.no_grad():
+            memory = model.encode(mimg, mask)
+            rec = zero_rec_from_meta(meta, self.device)
+            rec = model(qimg, *memory, *rec)[3:]
+
+            t = time()
+            for _ in tqdm(range(N)):
+                rec = model(qimg, *memory, *rec)[3:]
+                synchronize(self.device)
+            t = time()-t
+
+        print("FPS: ", N * meta['seq_chunk'] / t)
+
 if __name__ == '__main__':
     InferenceSpeedTest()
\ No newline at end of file
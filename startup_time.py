@@ -0,0 +1,52 @@
+"""
+Startup time of the lean conversion entry point (`inference_footages.py`),
+the import time of fresh interpreters beyond `torch` itself, and the evaluation / optional modules it should not import.
+Details of every import by `python -X importtime inference_footages.py -h`
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# evaluation, training & optional dependencies which the conversion should not import
+HEAVY_MODULES = [
+    'inference_model_list', 'inference_func', 'FTPVM.inference_model', 'evalutation', 'dataset',
+    'matplotlib', 'mediapy', 'xlsxwriter', 'cv2', 'pims',
+    'FTPVM.roi', 'FTPVM.temporal', 'FTPVM.adaptive', 'FTPVM.compiled',
+]
+
+PROBE = """
+import json, sys, time
+t = time.perf_counter()
+import {module}
+t = time.perf_counter()-t
+print(json.dumps({{'time': t, 'heavy': [m for m in {heavy} if m in sys.modules]}}))
+"""
+
+def measure(module, repeat=5):
+    """ median import time (s) of `module` in fresh interpreters & the heavy modules imported with it """
+    times, heavy = [], []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            capture_output=True, text=True, check=True)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        times.append(result['time'])
+        heavy = result['heavy']
+    return statistics.median(times), heavy
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', help='entry point to be measured', type=str, default='inference_footages')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--target-ms', help='max. import time beyond torch', type=float, default=500)
+    args = parser.parse_args()
+
+    base, _ = measure('torch', args.repeat)
+    total, heavy = measure(args.module, args.repeat)
+    overhead = (total-base)*1000
+    print(f'torch: {base*1000:.0f} ms, {args.module}: {total*1000:.0f} ms, overhead: {overhead:.0f} ms (target {args.target_ms:.0f} ms)')
+    if heavy:
+        print('Unexpected imports:', ', '.join(heavy))
+    if heavy or overhead > args.target_ms:
+        sys.exit(1)
@@ -0,0 +1,21 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from FTPVM.adaptive import AdaptiveDownsampler
+from FTPVM.model import FastTrimapPropagationVideoMatting
+
+def test_adapt_rec_to_full_ratio():
+    """ the resampled RNN memories fit the unpadded working size at ratio 1 """
+    torch.manual_seed(0)
+    model = FastTrimapPropagationVideoMatting(backbone_pretrained=False).eval()
+    h, w = 72, 100 # not multiples of 16
+    src = torch.rand(1, 1, 3, h, w)
+    controller = AdaptiveDownsampler(model, (h, w), 10., ratio=0.5, device='cpu', verbose=False)
+    with torch.no_grad():
+        memory = model.encode_imgs_to_value(src, torch.rand(1, 1, 1, h, w))
+        *_, rec = model.forward_with_memory(src, *memory, downsample_ratio=0.5)
+        controller.prev_ratio, controller.ratio = 0.5, 1.
+        rec = controller.adapt_rec(rec)
+        _, _, pha, _ = model.forward_with_memory(src, *memory, *rec, downsample_ratio=1.)
+    assert pha.shape == (1, 1, 1, h, w)
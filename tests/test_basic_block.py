@@ -0,0 +1,20 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from FTPVM.basic_block import BatchedConvGRU, ConvGRU
+
+@pytest.mark.parametrize('initial', [False, True])
+def test_batched_conv_gru_parity(initial):
+    """ the split kernels give the outputs of the per-step ConvGRU """
+    torch.manual_seed(0)
+    ref = ConvGRU(4)
+    gru = BatchedConvGRU(4)
+    gru.load_state_dict(ref.state_dict())
+    x = torch.randn(2, 5, 4, 12, 10)
+    h = torch.randn(2, 4, 12, 10) if initial else None
+    with torch.no_grad():
+        o_ref, h_ref = ref(x, h)
+        o, h = gru(x, h)
+    torch.testing.assert_close(o, o_ref, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(h, h_ref, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,25 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+if not hasattr(torch, 'compile'):
+    pytest.skip('torch.compile needs torch >= 2.0', allow_module_level=True)
+from torch._dynamo.utils import counters
+
+from FTPVM.compiled import CompiledMatting
+from FTPVM.model import FastTrimapPropagationVideoMatting
+from FTPVM.session import MattingSession
+
+def test_no_recompile_after_first_chunk():
+    """ `default_rec` of the first chunk is replaced by zeros, so the next chunks of the bucket reuse its graph """
+    torch.manual_seed(0)
+    torch._dynamo.reset()
+    model = CompiledMatting(FastTrimapPropagationVideoMatting(backbone_pretrained=False).eval(), bucket=32, backend='eager')
+    frames = torch.rand(1, 2, 3, 56, 80)
+    session = MattingSession(model)
+    with torch.no_grad():
+        session.add_memory(frames[:, :1], torch.rand(1, 1, 1, 56, 80))
+        session.push(frames)
+        graphs, shapes = counters['stats']['unique_graphs'], set(model.shapes)
+        session.push(frames)
+    assert counters['stats']['unique_graphs'] == graphs
+    assert model.shapes == shapes
@@ -0,0 +1,39 @@
+import os
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('cv2')
+from PIL import Image
+
+from FTPVM.model import FastTrimapPropagationVideoMatting
+from inference_footages_util import convert_video
+
+def write_frames(root, n, size=(64, 96)):
+    os.makedirs(root)
+    rng = np.random.default_rng(0)
+    for i in range(n):
+        Image.fromarray(rng.integers(0, 255, (*size, 3), dtype=np.uint8)).save(os.path.join(root, f'{i:04d}.png'))
+
+def read_frames(root):
+    return [np.asarray(Image.open(os.path.join(root, f))) for f in sorted(os.listdir(root))]
+
+def test_keyframes_with_output_selection(tmp_path):
+    """ the held keyframe outputs do not replace the requested outputs """
+    torch.manual_seed(0)
+    model = FastTrimapPropagationVideoMatting(backbone_pretrained=False).eval()
+    src = str(tmp_path/'src')
+    write_frames(src, 5)
+    out = {k: str(tmp_path/k) for k in ['alpha', 'trimap', 'fgr', 'com']}
+    frames = convert_video(
+        model, src, os.path.join(src, '0000.png'), output_type='png_sequence', downsample_ratio=1.,
+        output_alpha=out['alpha'], output_trimap=out['trimap'], output_foreground=out['fgr'], output_composition=out['com'],
+        seq_chunk=2, keyframe_interval=2, progress=False, device='cpu')
+    assert frames == 5
+    for k in out:
+        assert len(os.listdir(out[k])) == 5, k
+    # trimaps in {0, 0.5, 1} with 1 channel, not the logits
+    for tri in read_frames(out['trimap']):
+        assert tri.ndim == 2
+        assert set(np.unique(tri)) <= {0, 127, 255}
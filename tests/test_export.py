@@ -0,0 +1,35 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from FTPVM.export import StreamingMatting, flat_zero_rec
+from FTPVM.model import FastTrimapPropagationVideoMatting
+
+@pytest.mark.parametrize('downsample_ratio', [1., 0.5])
+def test_frozen_parity(downsample_ratio):
+    """ the traced & frozen streaming model carries its state like eager `forward_with_memory` """
+    torch.manual_seed(0)
+    model = FastTrimapPropagationVideoMatting(backbone_pretrained=False).eval()
+    wrapper = StreamingMatting(model, downsample_ratio).eval()
+    qimgs = torch.rand(1, 2, 3, 64, 96)
+    mimgs, masks = torch.rand(1, 1, 3, 64, 96), torch.rand(1, 1, 1, 64, 96)
+    with torch.no_grad():
+        memory = wrapper.encode(mimgs, masks)
+        traced = torch.jit.trace_module(wrapper, {
+            'forward': (qimgs, *memory, *flat_zero_rec(model, qimgs, downsample_ratio)),
+            'encode': (mimgs, masks),
+        }, check_trace=False)
+        frozen = torch.jit.freeze(traced.eval(), preserved_attrs=['encode'])
+
+        memory_s = frozen.encode(mimgs, masks)
+        torch.testing.assert_close(memory_s, memory, rtol=1e-4, atol=1e-4)
+        rec, rec_s = model.default_rec, flat_zero_rec(model, qimgs, downsample_ratio)
+        for _ in range(3):
+            q = torch.rand(qimgs.shape)
+            seg, mat, collab, rec = model.forward_with_memory(q, *memory, *rec, downsample_ratio=downsample_ratio)
+            seg_s, mat_s, collab_s, *rec_s = frozen(q, *memory_s, *rec_s)
+            torch.testing.assert_close(seg_s, seg, rtol=1e-3, atol=1e-3)
+            torch.testing.assert_close(mat_s, mat, rtol=1e-3, atol=1e-3)
+            # trimap classes can flip on ties after freezing, compare the full mattes on average
+            assert (collab_s-collab).abs().mean().item() < 1e-3
+            torch.testing.assert_close(rec_s, [*rec[0], *rec[1]], rtol=1e-3, atol=1e-3)
@@ -0,0 +1,28 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from FTPVM.fast_guided_filter import FastGuidedFilterRefiner
+from FTPVM.util import collaborate_fuse
+
+def inputs(dtype):
+    torch.manual_seed(0)
+    return torch.rand(1, 2, 3, 32, 48).to(dtype), torch.rand(1, 2, 3, 16, 24).to(dtype), torch.rand(1, 2, 1, 16, 24).to(dtype)
+
+@pytest.mark.parametrize('box_filter', ['conv', 'integral'])
+def test_refiner_dtype(box_filter):
+    """ half models get half mattes, computed in float32 """
+    refiner = FastGuidedFilterRefiner(radius=2, box_filter=box_filter)
+    ref = refiner(*inputs(torch.float32))
+    out = refiner(*inputs(torch.bfloat16))
+    assert out.dtype == torch.bfloat16
+    torch.testing.assert_close(out.float(), ref, rtol=0, atol=2e-2)
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        assert refiner(*inputs(torch.float32)).dtype == torch.float32
+
+def test_collaborate_fuse_dtype():
+    seg = torch.randn(1, 2, 3, 16, 24).bfloat16()
+    mat = torch.rand(1, 2, 1, 16, 24).bfloat16()
+    assert collaborate_fuse(seg, mat).dtype == torch.bfloat16
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        assert collaborate_fuse(seg, mat).dtype == torch.float32
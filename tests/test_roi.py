@@ -0,0 +1,22 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from FTPVM.model import FastTrimapPropagationVideoMatting
+from FTPVM.roi import ROIInference
+
+@pytest.mark.parametrize('box', [None, (16, 32, 112, 144)])
+def test_downsampled_roi(box):
+    """ the outputs are pasted at the full resolution when the crops are downsampled """
+    torch.manual_seed(0)
+    model = FastTrimapPropagationVideoMatting(backbone_pretrained=False).eval()
+    h, w = 136, 200 # not multiples of 16
+    src = torch.rand(1, 2, 3, h, w)
+    roi = ROIInference(model, (h, w), target_size=0.5*w)
+    roi.box = box
+    with torch.no_grad():
+        memory = model.encode_imgs_to_value(src[:, :1], torch.rand(1, 1, 1, h, w), downsample_ratio=0.5)
+        for _ in range(2):
+            seg, mat, pha = roi(src, *memory)
+            assert seg.shape == (1, 2, 3, h, w)
+            assert mat.shape == pha.shape == (1, 2, 1, h, w)
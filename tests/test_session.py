@@ -0,0 +1,66 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from FTPVM.model import FastTrimapPropagationVideoMatting
+from FTPVM.session import MattingSession, check_steady_state, model_hash
+
+def make_session(device='cpu', **kwargs):
+    torch.manual_seed(0)
+    model = FastTrimapPropagationVideoMatting(backbone_pretrained=False).eval().to(device)
+    frames = torch.rand(1, 2, 3, 64, 96, device=device)
+    session = MattingSession(model, **kwargs)
+    with torch.no_grad():
+        session.add_memory(frames[:, :1], torch.rand(1, 1, 1, 64, 96, device=device))
+    return session, frames
+
+def test_reused_buffers():
+    """ the RNN memories & outputs of every chunk are written into the same buffers """
+    session, frames = make_session()
+    with torch.no_grad():
+        first = session.push(frames)
+        rec = [r for recs in session.rec for r in recs]
+        diff = check_steady_state(session, frames, warmup=1, iters=2)
+        out = session.push(frames)
+    assert diff['buffers'] == 0
+    assert diff['post'] == 0
+    assert all(out[k] is first[k] for k in ['seg', 'mat', 'pha', 'trimap'])
+    assert all(a is b for a, b in zip(rec, [r for recs in session.rec for r in recs]))
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA graphs')
+def test_cuda_graph_steady_state():
+    """ the replayed chunks allocate nothing & match the eager chunks """
+    session, frames = make_session('cuda', cuda_graph=True)
+    eager, _ = make_session('cuda')
+    with torch.no_grad():
+        for _ in range(3):
+            out, ref = session.push(frames), eager.push(frames)
+            for k in ['seg', 'mat', 'pha', 'trimap']:
+                torch.testing.assert_close(out[k], ref[k], rtol=1e-3, atol=1e-4)
+        diff = check_steady_state(session, frames, warmup=1, iters=3)
+    assert diff == {'buffers': 0, 'push': 0, 'post': 0}
+
+def test_to_trimap():
+    session = MattingSession(FastTrimapPropagationVideoMatting(backbone_pretrained=False))
+    seg = torch.tensor([[10., 0., 0.], [0., 10., 0.], [0., 0., 10.], [30., 0., 30.]]).view(1, 4, 3, 1, 1)
+    # saturated ties of the probabilities resolve to the first class, as `seg_to_trimap`
+    assert session.to_trimap(seg).flatten().tolist() == [0., 0.5, 1., 0.]
+
+def test_model_hash_follows_weights():
+    """ the cached hash is recomputed after the weights change """
+    model = FastTrimapPropagationVideoMatting(backbone_pretrained=False)
+    h = model_hash(model)
+    assert model_hash(model) == h
+    state = {k: v + 1 if v.is_floating_point() else v for k, v in model.state_dict().items()}
+    model.load_state_dict(state)
+    assert model_hash(model) != h
+
+def test_save_frame_size(tmp_path):
+    """ the session saves the size of the pushed frames by default """
+    session, frames = make_session()
+    assert session.frame_size is None
+    with torch.no_grad():
+        session.push(frames)
+    session.save(tmp_path / 'session.pt')
+    loaded = MattingSession.load(tmp_path / 'session.pt', session.model)
+    assert loaded.frame_size == (64, 96)
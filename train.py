@@ -20,6 +20,7 @@ from dataset.augmentation import *
 
 from util.logger import TensorboardLogger
 from util.hyper_para import HyperParameters
+from util.device import get_device, setup_threads
 
 
 """
@@ -36,6 +37,7 @@ para.parse()
 
 if para['benchmark']:
     torch.backends.cudnn.benchmark = True
+setup_threads(get_device(para['device']))
 
 """
 Model related
@@ -212,7 +214,8 @@ def get_extra_dict():
 
 try:
     for e in range(current_epoch, total_epoch): 
-        torch.cuda.empty_cache()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
         time.sleep(2)
         if total_iter >= para['iterations']:
             break
@@ -0,0 +1,52 @@
+"""
+device.py - device & CPU thread configuration shared by the entry points
+"""
+import os
+import torch
+
+def add_device_args(parser):
+    parser.add_argument('--device', help='cuda, cuda:1, cpu, ... default: cuda if available', default=None, type=str)
+    parser.add_argument('--threads', help='intra-op CPU threads, 0 for the physical cores', default=0, type=int)
+    parser.add_argument('--interop_threads', help='inter-op CPU threads, 0 for the torch default', default=0, type=int)
+    return parser
+
+def get_device(device=None):
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+def physical_cores():
+    """ CPU cores usable by this process, hyper-threads are counted once if psutil is available """
+    n = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    try:
+        import psutil
+        n = min(n, psutil.cpu_count(logical=False) or n)
+    except ImportError:
+        pass
+    return max(n, 1)
+
+def setup_threads(device, threads=0, interop_threads=0):
+    """
+    Intra-op threads default to the physical cores on CPU (hyper-threads slow down the convolutions),
+    inter-op threads are left to torch unless given, it can only be set before any parallel work
+    """
+    if get_device(device).type != 'cpu' and threads <= 0 and interop_threads <= 0:
+        return
+    threads = threads if threads > 0 else physical_cores()
+    torch.set_num_threads(threads)
+    if interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            print('Inter-op threads are not set: ', repr(e))
+    print(f'CPU threads: intra-op {torch.get_num_threads()}, inter-op {torch.get_num_interop_threads()}')
+
+def setup_device(args):
+    """ `args` from a parser with `add_device_args`, return the device after setting up the threads """
+    device = get_device(args.device)
+    setup_threads(device, args.threads, args.interop_threads)
+    return device
+
+def synchronize(device):
+    if get_device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
@@ -25,6 +25,7 @@ class HyperParameters():
         # Enable torch.backends.cudnn.benchmark -- Faster in some cases, test in your own environment
         parser.add_argument('--benchmark', action='store_true')
         parser.add_argument('--num_worker', help='num_workers of dataloader', default=16, type=int)
+        parser.add_argument('--device', help='cuda, cpu, ... default: cuda if available', default=None, type=str)
 
         # Dataset setting
         parser.add_argument('--use_background_dataset', help='Composite data with background video as well', action='store_true')
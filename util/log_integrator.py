@@ -68,7 +68,8 @@ class Integrator:
 
             if self.distributed:
                 # Inplace operation
-                avg = torch.tensor(avg).cuda()
+                # NCCL only reduces CUDA tensors
+                avg = torch.tensor(avg, device='cuda' if torch.distributed.get_backend() == 'nccl' else 'cpu')
                 torch.distributed.reduce(avg, dst=0)
 
                 if self.local_rank == 0:
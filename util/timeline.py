@@ -0,0 +1,73 @@
+"""
+timeline.py - spans of the inference stages (load, transfer, encode, forward, readback, store) per chunk,
+exported as a Chrome trace (chrome://tracing or https://ui.perfetto.dev) & summarized as a table
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from util.device import synchronize
+
+STAGES = ['load', 'transfer', 'encode', 'forward', 'readback', 'store']
+
+class Timeline:
+    """
+    `device`: synchronized around the spans (if `sync`), so the asynchronous GPU work is counted in its own span
+    """
+    def __init__(self, device=None, sync=True):
+        self.device = device
+        self.sync = sync
+        self.events = []
+        self.start = time.perf_counter()
+        self.pid = os.getpid()
+
+    @contextmanager
+    def span(self, name, **args):
+        """ `args`: shown in the trace, e.g. the video & the frame range of the chunk """
+        if self.sync:
+            synchronize(self.device)
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync:
+                synchronize(self.device)
+            end = time.perf_counter()
+            self.events.append({
+                'name': name, 'cat': 'inference', 'ph': 'X',
+                'ts': (t-self.start)*1e6, 'dur': (end-t)*1e6,
+                'pid': self.pid, 'tid': threading.get_ident(), 'args': args,
+            })
+
+    def save(self, path):
+        """ Chrome trace JSON """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self):
+        """ {name: {'count', 'total', 'mean', 'max'}} in seconds, the stages first """
+        stats = {}
+        for e in self.events:
+            s = stats.setdefault(e['name'], {'count': 0, 'total': 0., 'max': 0.})
+            s['count'] += 1
+            s['total'] += e['dur'] / 1e6
+            s['max'] = max(s['max'], e['dur'] / 1e6)
+        for s in stats.values():
+            s['mean'] = s['total'] / s['count']
+        order = [n for n in STAGES if n in stats] + sorted(n for n in stats if n not in STAGES)
+        return {n: stats[n] for n in order}
+
+    def print_summary(self):
+        stats = self.summary()
+        total = sum(s['total'] for s in stats.values())
+        print(f"{'stage':<10} {'count':>7} {'total s':>9} {'mean ms':>9} {'max ms':>9} {'share':>7}")
+        for name, s in stats.items():
+            print(f"{name:<10} {s['count']:>7} {s['total']:>9.3f} {s['mean']*1000:>9.2f} {s['max']*1000:>9.2f} {s['total']/max(total, 1e-9):>7.1%}")
+        print(f"{'traced':<10} {'':>7} {total:>9.3f}, wall {time.perf_counter()-self.start:.3f} s")
+
+def span(timeline: Timeline, name, **args):
+    """ `timeline.span`, or nothing without a timeline """
+    return nullcontext() if timeline is None else timeline.span(name, **args)
@@ -1,3 +1,6 @@
+import os
+import time
+import threading
 import numpy as np
 import cv2
 import torch
@@ -8,6 +11,9 @@ from torchvision import transforms
 from model.which_model import get_model_by_string
 from inference_model_list import inference_model_list
 from FTPVM.memory_bank import MemoryBank
+from FTPVM.adaptive import AdaptiveDownsampler
+from FTPVM.session import MattingSession, load_session
+from util.device import add_device_args, setup_device
 
 class TrimapScribbler:
     def __init__(self, callback, display_ratio=1.):
@@ -147,53 +153,181 @@ class TrimapScribbler:
         elif self.srb_mode == self.MODE_BG:
             self.srb_mode = self.MODE_FG
 
+class LatestSlot:
+    """ single-item handoff between threads, `put` replaces the unread item (counted in `dropped`) """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.item = None
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self.cond:
+            if self.item is not None:
+                self.dropped += 1
+            self.item = item
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """ the newest item, `None` if timeout or closed """
+        with self.cond:
+            if self.item is None and not self.closed:
+                self.cond.wait(timeout)
+            item, self.item = self.item, None
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class StageMeter:
+    """ moving averages of the latency & the rate of a pipeline stage """
+    def __init__(self, smoothing=0.1):
+        self.smoothing = smoothing
+        self.latency = None
+        self.interval = None
+        self.last = None
+
+    def update(self, latency):
+        now = time.perf_counter()
+        ema = lambda old, new: new if old is None else (1-self.smoothing)*old + self.smoothing*new
+        self.latency = ema(self.latency, latency)
+        if self.last is not None:
+            self.interval = ema(self.interval, now-self.last)
+        self.last = now
+
+    @property
+    def fps(self):
+        return 1/self.interval if self.interval else 0.
+
 class WebcamMatting:
-    def __init__(self, model: torch.nn.Module, trimap_scribbler: TrimapScribbler):
+    def __init__(self, model: torch.nn.Module, trimap_scribbler: TrimapScribbler, device=None, target_ms=None, ratio_bounds=(0.25, 1.), session_path=None):
+        self.device = next(model.parameters()).device if device is None else device
         self.transform = transforms.ToTensor()
         self.trimap_scribbler = trimap_scribbler
         self.memory = None
         self.model = model
-        self.rec = self.model.default_rec
-        self.downsample_ratio = 1
+        # memory bank, RNN memories, downsample ratio & reusable output buffers
+        self.stream = MattingSession(model, 1, outputs={'alpha'})
         self.name = 'WebcamMatting'
         # memory = model.encode_imgs_to_value(m_img, m_mask, downsample_ratio=downsample_ratio)
         # cv2.namedWindow(self.name, cv2.WINDOW_NORMAL)
-        self.bg_color = torch.tensor([120, 255, 155], device='cuda').div(255).view(1, 1, 3, 1, 1)
-        self.memory_bank = MemoryBank()
+        self.memory_frames = [] # (img, mask) to re-encode the memory at a new downsample ratio
+        # adjust the downsample ratio to `target_ms` per frame, created at the first frame
+        self.target_ms = target_ms
+        self.ratio_bounds = ratio_bounds
+        self.controller = None
+        self.lock = threading.Lock() # model & memories, shared by the inference & display threads
+        self.img = None # last displayed frame
+        self.mcomp = None # memory frame & trimap to display
+        # session state file, saved by 's' & loaded by 'l' (and at start if it exists)
+        self.session_path = session_path
+        self.rec_frame_size = None # frame size of the loaded RNN memories
+        if session_path is not None and os.path.isfile(session_path):
+            self.load_session()
         
     def run(self, mirror=False):
+        """
+        capture & inference threads, display (& keyboard) in this thread,
+        each stage takes the newest frame of the previous stage and drops the stale ones
+        """
+        self.mirror = mirror
+        self.running = True
+        self.frames = LatestSlot() # (capture time, img)
+        self.results = LatestSlot() # (capture time, img, out)
+        self.meters = {name: StageMeter() for name in ['capture', 'inference', 'display']}
+        self.latency = StageMeter() # capture -> display
+        threads = [
+            threading.Thread(target=self.capture_loop, daemon=True),
+            threading.Thread(target=self.inference_loop, daemon=True),
+        ]
+        for t in threads:
+            t.start()
+        try:
+            self.display_loop()
+        finally:
+            self.running = False
+            self.frames.close()
+            self.results.close()
+            for t in threads:
+                t.join()
+            cv2.destroyAllWindows()
+
+    def capture_loop(self):
         cam = cv2.VideoCapture(0)
-        while True:
-            available, self.img = cam.read()
-            # print(available, self.img)
+        # don't queue frames inside the capture device
+        cam.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        while self.running:
+            t = time.perf_counter()
+            available, img = cam.read()
             if not available:
                 continue
+            if self.mirror:
+                img = cv2.flip(img, 1)
+            self.meters['capture'].update(time.perf_counter()-t)
+            self.frames.put((time.perf_counter(), img))
+        cam.release()
 
-            if mirror: 
-                self.img = cv2.flip(self.img, 1)
-            self.shape = self.img.shape[:2]
-            self.qimg = self.transform(self.img).cuda().unsqueeze(0).unsqueeze(0)
+    def inference_loop(self):
+        while self.running:
+            item = self.frames.get(timeout=0.1)
+            if item is None:
+                continue
+            t_capture, img = item
+            t = time.perf_counter()
+            with self.lock:
+                out = self.infer(img)
+            self.meters['inference'].update(time.perf_counter()-t)
+            self.results.put((t_capture, img, out))
 
-            if self.control():
-                break
-                
-            # else:
-            # if self.memory is None:
-            #     print(self.qimg.shape)
-            #     self.encode_value(self.qimg, torch.ones(1, 1, 1, *self.shape).cuda()*0.5)
-            memory = self.memory_bank.get_memory()
-            if memory is not None:
-            # if self.memory is not None:
-                trimap, matte, pha, self.rec, _ = self.model.forward_with_memory(self.qimg, *memory, *self.rec, downsample_ratio=self.downsample_ratio)
-                # trimap, matte, pha, self.rec, _ = self.model.forward_with_memory(self.qimg, *self.memory, *self.rec, downsample_ratio=self.downsample_ratio)
-                out = (self.qimg*pha+self.bg_color*(1-pha)).squeeze().permute(1, 2, 0).cpu().numpy()
-                out = np.concatenate([out, self.mcomp], axis=1)
-            else:
-                out = self.img
+    @torch.no_grad() # the grad mode is thread-local
+    def infer(self, img):
+        self.shape = img.shape[:2]
+        if self.rec_frame_size is not None and tuple(self.rec_frame_size) != self.shape:
+            print(f"Frame size {self.shape} != {tuple(self.rec_frame_size)} of the session, clean recurrent memory")
+            self.stream.reset()
+        self.rec_frame_size = None
+        self.qimg = self.transform(img).to(self.device).unsqueeze(0).unsqueeze(0)
+        if self.target_ms is not None and self.controller is None:
+            self.controller = AdaptiveDownsampler(self.model, self.shape, self.target_ms, *self.ratio_bounds, ratio=self.stream.downsample_ratio, device=self.device)
+            self.stream.downsample_ratio = self.controller.ratio
+
+        memory = self.stream.memory_bank.get_memory()
+        if memory is None:
+            return img
+        if self.controller is not None:
+            self.controller.start()
+        pha = self.stream.push(self.qimg)['pha'].clamp_(0, 1)
+        if self.controller is not None and self.controller.stop(1):
+            self.set_downsample_ratio(self.controller.ratio)
+        out = self.stream.compose(self.qimg, pha).squeeze().permute(1, 2, 0).mul_(255).byte().cpu().numpy()
+        return np.concatenate([out, self.mcomp if self.mcomp is not None else np.zeros_like(out)], axis=1)
+
+    def display_loop(self):
+        while not self.control():
+            item = self.results.get(timeout=0.01)
+            if item is None:
+                continue
+            t_capture, self.img, out = item
+            t = time.perf_counter()
             scale = 800/out.shape[0]
             out = cv2.resize(out, None, fx=scale, fy=scale)
+            self.latency.update(time.perf_counter()-t_capture)
+            self.draw_stats(out)
             cv2.imshow(self.name, out)
-        cv2.destroyAllWindows()
+            self.meters['display'].update(time.perf_counter()-t)
+
+    def draw_stats(self, out):
+        """ per-stage latency & FPS, capture-to-display latency and dropped frames """
+        lines = [f'{name:<9} {m.latency*1000:6.1f} ms {m.fps:5.1f} fps' for name, m in self.meters.items() if m.latency is not None]
+        lines.append(f'latency   {self.latency.latency*1000:6.1f} ms')
+        lines.append(f'dropped   {self.frames.dropped} / {self.results.dropped}')
+        if self.controller is not None:
+            lines.append(f'ratio     {self.stream.downsample_ratio:.3f}')
+        for i, line in enumerate(lines):
+            for color, thickness in [((0, 0, 0), 3), ((255, 255, 255), 1)]:
+                cv2.putText(out, line, (10, 24+i*22), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, thickness, cv2.LINE_AA)
     
     def control(self):
         key = cv2.waitKey(1) & 0xFF
@@ -208,25 +342,69 @@ class WebcamMatting:
             # cv2.imshow('draw trimap', self.img)
         elif key == ord('c'):
             print("Clean recurrent memory")
-            self.rec = self.model.default_rec
+            with self.lock:
+                self.stream.reset()
         elif key == ord('v'):
             print("Clean trimap memory")
-            self.memory_bank = MemoryBank()
+            with self.lock:
+                self.stream.memory_bank = MemoryBank()
+                self.memory_frames = []
+        elif key == ord('s') and self.session_path is not None:
+            self.save_session()
+        elif key == ord('l') and self.session_path is not None:
+            self.load_session()
         return False
 
+    def save_session(self):
+        with self.lock:
+            if self.stream.memory_bank.get_memory() is None:
+                print("No trimap memory to save")
+                return
+            self.stream.save(self.session_path, frame_size=getattr(self, 'shape', None))
+        print(f"Session saved to {self.session_path}")
+
+    def load_session(self):
+        """ restore the encoded memory, the recurrent memory & the downsample ratio """
+        state = load_session(self.session_path, self.model, self.device, strict=False)
+        with self.lock:
+            self.stream.memory_bank = state['memory_bank']
+            self.memory_frames = [] # not saved, the memory is kept when the ratio changes
+            self.stream.set_rec(state['rec'])
+            self.rec_frame_size = state['frame_size']
+            self.stream.downsample_ratio = state['downsample_ratio']
+            if self.controller is not None:
+                self.controller.ratio = self.controller.prev_ratio = self.stream.downsample_ratio
+            self.mcomp = None
+        print(f"Session loaded from {self.session_path}, downsample ratio {self.stream.downsample_ratio}")
+
     def encode_value(self, img, mask):
         # self.memory = self.model.encode_imgs_to_value(img, mask, downsample_ratio=self.downsample_ratio)
-        self.memory_bank.add_memory(*self.model.encode_imgs_to_value(img, mask, downsample_ratio=self.downsample_ratio))
+        self.memory_frames.append((img, mask))
+        self.stream.add_memory(img, mask)
+
+    def set_downsample_ratio(self, ratio):
+        """ resample the recurrent memory & re-encode the trimap memory at the new working size """
+        self.stream.downsample_ratio = ratio
+        self.stream.set_rec(self.controller.adapt_rec(self.stream.rec))
+        if len(self.memory_frames) == 0:
+            # restored session, `MemoryReader` also reads memory of another size
+            return
+        self.stream.memory_bank = MemoryBank()
+        for img, mask in self.memory_frames:
+            self.stream.memory_bank.add_memory(*self.model.encode_imgs_to_value(img, mask, downsample_ratio=ratio))
         
     def draw_trimap(self):
+        if self.img is None:
+            return
         mask = self.trimap_scribbler.start(self.img) # (h, w)
         self.mmask = mask
         self.ming = self.img
-        self.mcomp = ((self.img * 0.5) + (mask[..., None]*0.5))/255
-        mask = (torch.from_numpy(mask)/255.).cuda().unsqueeze(0).unsqueeze(0).unsqueeze(0)
-        img = self.transform(self.img).cuda().unsqueeze(0).unsqueeze(0)
+        mask = (torch.from_numpy(mask)/255.).to(self.device).unsqueeze(0).unsqueeze(0).unsqueeze(0)
+        img = self.transform(self.img).to(self.device).unsqueeze(0).unsqueeze(0)
         
-        self.encode_value(img, mask)
+        with self.lock:
+            self.mcomp = ((self.img * 0.5) + (self.mmask[..., None]*0.5)).astype(np.uint8)
+            self.encode_value(img, mask)
         
         
 
@@ -253,20 +431,31 @@ def mouse_callback(event, x, y, flags, *args):
 
 
 if __name__ == '__main__':
+    import argparse
+    parser = add_device_args(argparse.ArgumentParser())
+    parser.add_argument('--target-ms', help='adjust the downsample ratio to meet this time per frame', type=float, default=None)
+    parser.add_argument('--ratio-bounds', help='(min, max) downsample ratio of --target-ms', type=float, nargs=2, default=[0.25, 1.])
+    parser.add_argument('--ratio-log', help='csv of the downsample ratio over time', type=str, default=None)
+    parser.add_argument('--session', help='session state file, saved by "s" & loaded by "l" (and at start if it exists)', type=str, default=None)
+    args = parser.parse_args()
+    device = setup_device(args)
+
     model_name = 'STCNFuseMatting_fullres_matnaive'
     model_attr = inference_model_list[model_name]
-    model = get_model_by_string(model_attr[1])().cuda()
+    model = get_model_by_string(model_attr[1])().to(device)
     def check_and_load_model_dict(model, state_dict: dict):
         for k in set(state_dict.keys()) - set(model.state_dict().keys()):
             if 'refiner' in k:
                 print('remove refiner', k)
                 state_dict.pop(k)
         model.load_state_dict(state_dict)
-    check_and_load_model_dict(model, torch.load(model_attr[3]))
+    check_and_load_model_dict(model, torch.load(model_attr[3], map_location=device))
     
     trimap_srb = TrimapScribbler(callback=mouse_callback)
-    webcam = WebcamMatting(model, trimap_srb)
+    webcam = WebcamMatting(model, trimap_srb, device, target_ms=args.target_ms, ratio_bounds=args.ratio_bounds, session_path=args.session)
     
     
 
-    webcam.run()
\ No newline at end of file
+    webcam.run()
+    if webcam.controller is not None and args.ratio_log is not None:
+        webcam.controller.save_log(args.ratio_log)
\ No newline at end of file